@@ -0,0 +1,118 @@
+"""
+Бенчмарк подготовки изображений перед отправкой модели.
+
+Для каждого документа сравнивает отправку исходного файла и подготовленного
+(серый, целевой DPI, JPEG; для PDF — растеризация нужных страниц):
+размер запроса, время подготовки, а с --extract — задержку извлечения
+и совпадение извлечённых полей.
+
+Без аргументов генерирует синтетические документы: фото счёта 12 Мп
+с EXIF-поворотом и трёхстраничный скан в PDF.
+
+Запуск:
+    python benchmarks/bench_image_preprocessing.py
+    python benchmarks/bench_image_preprocessing.py scans/*.jpg scans/*.pdf --extract
+(с --extract вызывается модель из конфигурации; MODEL_BACKEND=fake — без реального API)
+"""
+import argparse
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from PIL import Image, ImageDraw
+
+from modules.document_parser import DocumentPayload, extract_invoice_data
+
+COMPARED_FIELDS = ["ИНН поставщика", "Название контрагента", "Сумма", "Дата", "Назначение платежа"]
+
+def draw_invoice(size, lines=40):
+    """Имитация фото счёта: шумный цветной фон и строки реквизитов"""
+    image = Image.effect_noise(size, 40).convert("RGB")
+    image = Image.blend(image, Image.new("RGB", size, (235, 225, 200)), 0.7)
+    draw = ImageDraw.Draw(image)
+    step = size[1] // (lines + 2)
+    for i in range(lines):
+        inn = "".join(random.choice("0123456789") for _ in range(10))
+        draw.text((size[0] // 20, step * (i + 1)), f"INN {inn}  SUM {random.randint(100, 99999)}.00  01.03.2024",
+                  fill=(20, 20, 40))
+    return image
+
+def make_samples(folder):
+    """Синтетические документы для прогона без реальных сканов"""
+    photo = draw_invoice((4000, 3000))
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Ориентация: повёрнуто на 90°
+    photo_path = folder / "photo_12mp.jpg"
+    photo.save(photo_path, "JPEG", quality=92, exif=exif)
+
+    png_path = folder / "scan_300dpi.png"
+    draw_invoice((2480, 3508)).save(png_path, "PNG", dpi=(300, 300))
+
+    pages = [draw_invoice((2480, 3508)) for _ in range(2)] + [Image.new("RGB", (2480, 3508), "white")]
+    pdf_path = folder / "scan_3pages.pdf"
+    pages[0].save(pdf_path, "PDF", save_all=True, append_images=pages[1:], resolution=300, quality=90)
+    return [photo_path, png_path, pdf_path]
+
+def field_agreement(before, after):
+    """Доля совпавших полей между двумя результатами извлечения (по порядку транзакций)"""
+    before = [t for t in before if isinstance(t, dict) and "error" not in t]
+    after = [t for t in after if isinstance(t, dict) and "error" not in t]
+    total = max(len(before), len(after)) * len(COMPARED_FIELDS)
+    if total == 0:
+        return 1.0
+    matched = 0
+    for a, b in zip(before, after):
+        for field in COMPARED_FIELDS:
+            if str(a.get(field) or "").strip().lower() == str(b.get(field) or "").strip().lower():
+                matched += 1
+    return matched / total
+
+def measure(path, preprocess, repeat, extract):
+    sizes, prepare_times, extract_times, results = [], [], [], []
+    for _ in range(repeat):
+        payload = DocumentPayload(path, preprocess=preprocess, rasterize_pdf=preprocess)
+        started = time.perf_counter()
+        payload.as_part()
+        prepare_times.append(time.perf_counter() - started)
+        sizes.append(payload.payload_bytes)
+        if extract:
+            started = time.perf_counter()
+            results.append(extract_invoice_data(path, payload))
+            extract_times.append(time.perf_counter() - started)
+    return {
+        "bytes": sizes[-1],
+        "prepare_ms": statistics.median(prepare_times) * 1000,
+        "extract_ms": statistics.median(extract_times) * 1000 if extract_times else None,
+        "result": results[-1] if results else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк подготовки изображений")
+    parser.add_argument("files", nargs="*", help="изображения и PDF (по умолчанию — синтетические)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--extract", action="store_true", help="также извлекать транзакции через модель")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = [Path(f) for f in args.files] or make_samples(Path(tmp))
+        print(f"{'файл':<24}{'исходный, КБ':>14}{'подготовл., КБ':>16}{'сжатие':>8}"
+              f"{'подгот., мс':>13}{'извл. до, мс':>14}{'извл. после, мс':>17}{'совпадение':>12}")
+        for path in files:
+            raw = measure(path, False, args.repeat, args.extract)
+            prepared = measure(path, True, args.repeat, args.extract)
+            agreement = (
+                f"{field_agreement(raw['result'], prepared['result']):.0%}" if args.extract else "-"
+            )
+            print(
+                f"{path.name[:23]:<24}{raw['bytes'] / 1024:>14.0f}{prepared['bytes'] / 1024:>16.0f}"
+                f"{raw['bytes'] / prepared['bytes']:>7.1f}x{prepared['prepare_ms']:>13.0f}"
+                f"{raw['extract_ms'] or 0:>14.0f}{prepared['extract_ms'] or 0:>17.0f}{agreement:>12}"
+            )
+
+if __name__ == "__main__":
+    main()
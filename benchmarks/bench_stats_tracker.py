@@ -0,0 +1,74 @@
+"""
+Бенчмарк StatsTracker на 100 000 имитированных сессий.
+
+Сравнивает текущую реализацию (упорядоченная очередь + троттлинг)
+с прежней, которая на каждом запросе просматривала все сессии.
+
+Запуск: python benchmarks/bench_stats_tracker.py [--sessions 100000] [--requests 200000]
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+from threading import Lock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules.stats_tracker import StatsTracker
+
+class LegacyStatsTracker:
+    """Прежняя реализация: полный проход по active_users на каждом обновлении"""
+    def __init__(self, user_timeout=60):
+        self.lock = Lock()
+        self.active_users = {}
+        self.user_timeout = user_timeout
+
+    def update_user_activity(self, session_id):
+        with self.lock:
+            self.active_users[session_id] = time.time()
+            current_time = time.time()
+            inactive = [
+                sid for sid, last_active in self.active_users.items()
+                if current_time - last_active > self.user_timeout
+            ]
+            for sid in inactive:
+                del self.active_users[sid]
+
+    def get_online_users_count(self):
+        with self.lock:
+            return len(self.active_users)
+
+def run(tracker, session_ids, requests):
+    """Прогрев всеми сессиями, затем случайные запросы. Возвращает мкс на запрос"""
+    for sid in session_ids:
+        tracker.update_user_activity(sid)
+    started = time.perf_counter()
+    for _ in range(requests):
+        tracker.update_user_activity(random.choice(session_ids))
+    elapsed = time.perf_counter() - started
+    return elapsed / requests * 1e6, tracker.get_online_users_count()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--legacy-requests", type=int, default=200,
+                        help="прежняя реализация O(N) на запрос, поэтому запросов меньше")
+    args = parser.parse_args()
+
+    random.seed(42)
+    session_ids = [f"session-{i}" for i in range(args.sessions)]
+
+    per_request, online = run(StatsTracker(), session_ids, args.requests)
+    print(f"StatsTracker:               {per_request:10.2f} мкс/запрос, онлайн {online}")
+
+    # Без троттлинга каждый запрос проходит через очередь и очистку
+    per_request, online = run(StatsTracker(activity_throttle=0), session_ids, args.requests)
+    print(f"StatsTracker (no throttle): {per_request:10.2f} мкс/запрос, онлайн {online}")
+
+    per_request, online = run(LegacyStatsTracker(), session_ids, args.legacy_requests)
+    print(f"LegacyStatsTracker:         {per_request:10.2f} мкс/запрос, онлайн {online}")
+
+if __name__ == "__main__":
+    main()
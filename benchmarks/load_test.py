@@ -0,0 +1,378 @@
+"""
+Нагрузочный прогон HTTP-эндпоинтов приложения с локальной заглушкой модели.
+
+Запускает приложение под gunicorn с заданным числом воркеров и потоков
+(MODEL_BACKEND=fake, база — копия data/accounting.db во временном каталоге)
+и нагружает его виртуальными пользователями. Каждый пользователь — отдельная
+сессия (cookie): выбирает эндпоинт по весам смеси и делает паузу «на раздумье».
+
+Эндпоинты смеси: index (/), history (/history), file (/file/<id>),
+stats (/api/stats), chat (POST /chat), upload (POST /upload, каждый раз новый документ).
+
+Отчёт по каждому эндпоинту: число запросов, пропускная способность, p50/p95/p99,
+доля ошибок (5xx, сетевые ошибки и таймауты) и отказов допуска (429/503 с Retry-After).
+Случайность задаётся --seed: прогон с теми же параметрами повторяет ту же
+последовательность запросов. С --output результат и параметры прогона
+сохраняются в JSON, с --compare — сравниваются с сохранённым прогоном.
+
+Клиент и сервер на одной машине делят процессор: для точной оценки
+запускайте клиент на другой машине с --url.
+
+Запуск:
+    python benchmarks/load_test.py --workers 2 --threads 8 --users 20 --duration 60
+    python benchmarks/load_test.py --mix "chat=5,upload=1,stats=4" --latency 1.5,8 --output run_a.json
+    python benchmarks/load_test.py --workers 4 --threads 4 --compare run_a.json
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 --duration 30
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime
+from http.cookiejar import CookieJar
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from PIL import Image, ImageDraw
+
+DEFAULT_MIX = "index=3,history=2,file=2,stats=4,chat=3,upload=1"
+
+CHAT_QUESTIONS = [
+    "Сколько мы заплатили АльфаПлюс в октябре 2024?",
+    "Какие были работы по клинингу?",
+    "Сколько всего потратили за 2024 год?",
+    "Как учитывать НДС при УСН?",
+    "Какие операции были с 01.10.2024 по 20.10.2024?",
+    "Кто наш крупнейший контрагент?",
+    "Что такое счёт-фактура?",
+]
+UPLOAD_QUESTION_SHARE = 0.3
+
+# Переменные окружения сервера, которые попадают в отчёт: от них зависит результат
+REPORTED_ENV = (
+    "MODEL_RATE_LIMIT", "MODEL_RATE_BURST", "MODEL_MAX_CONCURRENT", "ADMISSION_MAX_CONCURRENT",
+    "ADMISSION_QUEUE_SIZE", "STATS_BACKEND", "ANSWER_CACHE_DB",
+)
+
+def parse_mix(text):
+    """Смесь вида "chat=3,upload=1" -> {эндпоинт: вес}"""
+    mix = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Неизвестный эндпоинт в смеси: {name} (доступны: {', '.join(ENDPOINTS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+def make_document(rng):
+    """Небольшой «скан» счёта с уникальными реквизитами, чтобы загрузки не совпадали по содержимому"""
+    image = Image.new("L", (600, 400), 245)
+    draw = ImageDraw.Draw(image)
+    for i in range(8):
+        inn = "".join(rng.choice("0123456789") for _ in range(10))
+        draw.text((20, 30 + i * 40), f"INN {inn}  SUM {rng.randint(100, 999999)}.00  0{rng.randint(1, 9)}.10.2024", fill=0)
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+def multipart(fields, files):
+    """Тело multipart/form-data: fields — {имя: значение}, files — {имя: (имя файла, байты, тип)}"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+        )
+    for name, (filename, data, mime_type) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {mime_type}\r\n\r\n'.encode("utf-8") + data + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+class VirtualUser:
+    """Один пользователь: своя сессия, свой генератор случайных чисел"""
+    def __init__(self, index, base_url, mix, file_ids, think_time, timeout, seed):
+        self.index = index
+        self.base_url = base_url
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.file_ids = file_ids
+        self.think_time = think_time
+        self.timeout = timeout
+        self.rng = random.Random(seed * 1000003 + index)
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+
+    def request(self, method, path, body=None, content_type=None):
+        """Выполнить запрос. Возвращает (HTTP-код или None, есть ли Retry-After)"""
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        if content_type:
+            request.add_header("Content-Type", content_type)
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                response.read()
+                return response.status, False
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code, e.headers.get("Retry-After") is not None
+        except (OSError, urllib.error.URLError):
+            return None, False
+
+    def run(self, deadline, warmup_until, started, results):
+        # Как браузер: сначала главная страница, чтобы получить сессию
+        self.request("GET", "/")
+        while time.monotonic() < deadline:
+            name = self.rng.choices(self.names, self.weights)[0]
+            method, path, body, content_type = ENDPOINTS[name](self)
+            request_started = time.monotonic()
+            status, retry_after = self.request(method, path, body, content_type)
+            finished = time.monotonic()
+            if request_started >= warmup_until and finished <= deadline:
+                results.append((name, request_started - started, finished - request_started, classify(status, retry_after)))
+            if self.think_time:
+                time.sleep(min(self.rng.expovariate(1 / self.think_time), max(0.0, deadline - time.monotonic())))
+
+def classify(status, retry_after):
+    """Исход запроса: ok, rejected (отказ допуска с Retry-After) или error"""
+    if status in (429, 503) and retry_after:
+        return "rejected"
+    if status is None or status >= 400:
+        return "error"
+    return "ok"
+
+def request_file(user):
+    if not user.file_ids:
+        return "GET", "/history", None, None
+    return "GET", f"/file/{user.rng.choice(user.file_ids)}", None, None
+
+def request_chat(user):
+    body = urllib.parse.urlencode({"message": user.rng.choice(CHAT_QUESTIONS)}).encode()
+    return "POST", "/chat", body, "application/x-www-form-urlencoded"
+
+def request_upload(user):
+    fields = {}
+    if user.rng.random() < UPLOAD_QUESTION_SHARE:
+        fields["question"] = "Какая сумма к оплате?"
+    body, content_type = multipart(fields, {"file": (f"scan_{user.index}.png", make_document(user.rng), "image/png")})
+    return "POST", "/upload", body, content_type
+
+ENDPOINTS = {
+    "index": lambda user: ("GET", "/", None, None),
+    "history": lambda user: ("GET", "/history", None, None),
+    "file": request_file,
+    "stats": lambda user: ("GET", "/api/stats", None, None),
+    "chat": request_chat,
+    "upload": request_upload,
+}
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+def summarize(results, duration):
+    """Метрики по эндпоинтам и в целом из записей (эндпоинт, старт, задержка, исход)"""
+    groups = {}
+    for name, _, latency, outcome in results:
+        groups.setdefault(name, []).append((latency, outcome))
+    groups["всего"] = [(latency, outcome) for _, _, latency, outcome in results]
+    summary = {}
+    for name, items in groups.items():
+        # Перцентили — по успешным запросам: быстрые отказы не должны «улучшать» задержку
+        latencies = sorted(latency for latency, outcome in items if outcome == "ok")
+        errors = sum(1 for _, outcome in items if outcome == "error")
+        rejected = sum(1 for _, outcome in items if outcome == "rejected")
+        summary[name] = {
+            "requests": len(items),
+            "rps": round(len(items) / duration, 3) if duration else None,
+            "error_rate": round(errors / len(items), 4) if items else 0.0,
+            "rejected_rate": round(rejected / len(items), 4) if items else 0.0,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        }
+    return summary
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_ready(base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(base_url + "/api/stats", timeout=2) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def start_server(args, workdir):
+    """gunicorn с приложением в отдельном каталоге: база и загрузки не затрагивают рабочие данные"""
+    data_dir = workdir / "data"
+    data_dir.mkdir()
+    if (ROOT / "data" / "accounting.db").exists():
+        shutil.copy(ROOT / "data" / "accounting.db", data_dir / "accounting.db")
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": str(ROOT),
+        "MODEL_BACKEND": "fake",
+        "FAKE_BACKEND_LATENCY": args.latency,
+        "FAKE_BACKEND_LATENCY_DIST": args.latency_dist,
+        "FAKE_BACKEND_DOCUMENT_FACTOR": str(args.document_factor),
+        "FAKE_BACKEND_FAILURE_RATE": str(args.failure_rate),
+        # Общий ключ сессий: иначе у каждого воркера свой, и cookie теряется между воркерами
+        "SECRET_KEY": env.get("SECRET_KEY") or "load-test",
+    })
+    port = free_port()
+    log = open(workdir / "server.log", "wb")
+    process = subprocess.Popen([
+        sys.executable, "-m", "gunicorn", "--workers", str(args.workers), "--threads", str(args.threads),
+        "--bind", f"127.0.0.1:{port}", "--timeout", "300", "modules.chatbot_interface:app",
+    ], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process, f"http://127.0.0.1:{port}", log
+
+def stop_server(process, log):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    log.close()
+
+def known_file_ids(base_url):
+    try:
+        with urllib.request.urlopen(base_url + "/api/files?per_page=200", timeout=10) as response:
+            return [item["id"] for item in json.load(response)["items"]]
+    except (OSError, ValueError, KeyError):
+        return []
+
+def run_load(args, base_url):
+    mix = parse_mix(args.mix)
+    file_ids = known_file_ids(base_url)
+    results = []
+    started = time.monotonic()
+    warmup_until = started + args.warmup
+    deadline = warmup_until + args.duration
+    users = [
+        VirtualUser(i, base_url, mix, file_ids, args.think, args.timeout, args.seed) for i in range(args.users)
+    ]
+    threads = []
+    for user in users:
+        # Пользователи подключаются равномерно в течение разогрева, а не все разом
+        thread = threading.Thread(target=user.run, args=(deadline, warmup_until, started, results), daemon=True)
+        threads.append(thread)
+    for thread in threads:
+        thread.start()
+        if args.warmup and args.users > 1:
+            time.sleep(min(args.warmup / args.users, 1.0))
+    for thread in threads:
+        thread.join(timeout=max(0.0, deadline - time.monotonic()) + args.timeout + 5)
+    return summarize(results, args.duration)
+
+def print_report(summary, baseline=None):
+    print(f"{'эндпоинт':<10}{'запросов':>10}{'RPS':>9}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}"
+          f"{'ошибки':>9}{'отказы':>9}" + ("   Δ RPS   Δ p95   Δ p99" if baseline else ""))
+    for name, row in summary.items():
+        line = (
+            f"{name:<10}{row['requests']:>10}{row['rps'] or 0:>9.2f}{_ms(row['p50_ms']):>10}{_ms(row['p95_ms']):>10}"
+            f"{_ms(row['p99_ms']):>10}{row['error_rate']:>9.1%}{row['rejected_rate']:>9.1%}"
+        )
+        before = (baseline or {}).get(name)
+        if before:
+            line += f"{_delta(before['rps'], row['rps']):>8}{_delta(before['p95_ms'], row['p95_ms']):>8}" \
+                    f"{_delta(before['p99_ms'], row['p99_ms']):>8}"
+        print(line)
+
+def _ms(value):
+    return "-" if value is None else f"{value:.0f}"
+
+def _delta(before, after):
+    """Изменение относительно сохранённого прогона в процентах"""
+    if not before or after is None:
+        return "-"
+    return f"{(after - before) / before:+.0%}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="адрес уже запущенного приложения (иначе запускается gunicorn)")
+    parser.add_argument("--workers", type=int, default=2, help="воркеров gunicorn")
+    parser.add_argument("--threads", type=int, default=4, help="потоков на воркер gunicorn")
+    parser.add_argument("--users", type=int, default=10, help="виртуальных пользователей")
+    parser.add_argument("--duration", type=float, default=30, help="длительность замера, сек")
+    parser.add_argument("--warmup", type=float, default=5, help="разогрев без замера, сек")
+    parser.add_argument("--think", type=float, default=1.0, help="средняя пауза пользователя между запросами, сек")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"веса эндпоинтов (по умолчанию {DEFAULT_MIX})")
+    parser.add_argument("--latency", default="0.8,6", help="задержка модели: медиана,p99 (lognormal) или min,max")
+    parser.add_argument("--latency-dist", default="lognormal", choices=["lognormal", "uniform"])
+    parser.add_argument("--document-factor", type=float, default=3.0,
+                        help="во сколько раз дольше вызов модели с документом")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="доля временных ошибок модели")
+    parser.add_argument("--timeout", type=float, default=120, help="таймаут одного запроса, сек")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="сохранить результат и параметры прогона в JSON")
+    parser.add_argument("--compare", help="JSON сохранённого прогона для сравнения")
+    args = parser.parse_args()
+    parse_mix(args.mix)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["endpoints"]
+
+    workdir = None
+    process = log = None
+    base_url = args.url.rstrip("/") if args.url else None
+    try:
+        if base_url is None:
+            workdir = Path(tempfile.mkdtemp(prefix="load_test_"))
+            process, base_url, log = start_server(args, workdir)
+            if not wait_ready(base_url):
+                stop_server(process, log)
+                process = None
+                print((workdir / "server.log").read_text(errors="replace")[-3000:])
+                raise SystemExit("Приложение не запустилось")
+        target = base_url if args.url else f"gunicorn {args.workers}×{args.threads}"
+        print(f"Цель: {target}; пользователей: {args.users}, замер {args.duration:.0f} с после разогрева {args.warmup:.0f} с, "
+              f"модель: {args.latency_dist} {args.latency}")
+        summary = run_load(args, base_url)
+    finally:
+        if process is not None:
+            stop_server(process, log)
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(summary, baseline)
+    if args.output:
+        report = {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "config": {
+                key: value for key, value in vars(args).items() if key not in ("output", "compare")
+            },
+            "server_env": {name: os.environ[name] for name in REPORTED_ENV if name in os.environ},
+            "endpoints": summary,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результат сохранён в {args.output}")
+
+if __name__ == "__main__":
+    main()
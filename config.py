@@ -5,3 +5,136 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 UPLOAD_DIR = "data/uploads/"
 OUTPUT_DIR = "data/outputs/"
 DB_PATH = "data/accounting.db"
+
+# Токен для административных эндпоинтов (без него они отключены)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Кэш ответов /chat
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+# Путь к общему SQLite-хранилищу кэша для всех воркеров (пусто — только память процесса)
+ANSWER_CACHE_DB = os.environ.get("ANSWER_CACHE_DB") or None
+
+# Контекст /chat из учётной базы: бюджет токенов на выдержку в промпте и число строк-кандидатов
+CHAT_RETRIEVAL_ENABLED = os.environ.get("CHAT_RETRIEVAL_ENABLED", "1") == "1"
+CHAT_CONTEXT_TOKENS = int(os.environ.get("CHAT_CONTEXT_TOKENS", "1500"))
+CHAT_RETRIEVAL_TOP_K = int(os.environ.get("CHAT_RETRIEVAL_TOP_K", "30"))
+# История разговора /chat: бюджет токенов на последние реплики, на сводку старых и число хранимых сессий.
+# При STATS_BACKEND=sqlite история общая для воркеров (в STATS_DB), иначе — в памяти каждого процесса
+CHAT_HISTORY_TOKENS = int(os.environ.get("CHAT_HISTORY_TOKENS", "1200"))
+CHAT_HISTORY_SUMMARY_TOKENS = int(os.environ.get("CHAT_HISTORY_SUMMARY_TOKENS", "300"))
+CHAT_HISTORY_MAX_SESSIONS = int(os.environ.get("CHAT_HISTORY_MAX_SESSIONS", "5000"))
+
+# Слой вызовов модели: "gemini" или "fake" (локальный бэкенд для тестов)
+MODEL_BACKEND = os.environ.get("MODEL_BACKEND", "gemini")
+# Общее для воркеров состояние лимитера запросов
+MODEL_STATE_DB = os.environ.get("MODEL_STATE_DB", "data/model_state.db")
+MODEL_RATE_LIMIT = float(os.environ.get("MODEL_RATE_LIMIT", "2"))
+MODEL_RATE_BURST = int(os.environ.get("MODEL_RATE_BURST", "5"))
+MODEL_TIMEOUT = float(os.environ.get("MODEL_TIMEOUT", "120"))
+MODEL_MAX_RETRIES = int(os.environ.get("MODEL_MAX_RETRIES", "4"))
+MODEL_BACKOFF_BASE = float(os.environ.get("MODEL_BACKOFF_BASE", "1"))
+MODEL_BACKOFF_MAX = float(os.environ.get("MODEL_BACKOFF_MAX", "30"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "30"))
+# Планировщик вызовов модели: одновременных вызовов на процесс и веса классов вида "interactive=8,upload=3,batch=1"
+MODEL_MAX_CONCURRENT = int(os.environ.get("MODEL_MAX_CONCURRENT", "4"))
+MODEL_PRIORITY_WEIGHTS = {
+    name.strip(): float(value)
+    for name, value in (
+        item.split("=", 1) for item in os.environ.get("MODEL_PRIORITY_WEIGHTS", "interactive=8,upload=3,batch=1").split(",")
+        if "=" in item
+    )
+}
+# Параметры локального бэкенда-заглушки: диапазон задержки (сек) и доля ошибок
+FAKE_BACKEND_LATENCY = tuple(float(x) for x in os.environ.get("FAKE_BACKEND_LATENCY", "0.2,1.0").split(","))
+# Распределение задержки: "uniform" — равномерно в диапазоне FAKE_BACKEND_LATENCY,
+# "lognormal" — длинный хвост, как у реального API: FAKE_BACKEND_LATENCY задаёт медиану и 99-й перцентиль
+FAKE_BACKEND_LATENCY_DIST = os.environ.get("FAKE_BACKEND_LATENCY_DIST", "uniform")
+# Во сколько раз дольше отвечает вызов с документом (извлечение), чем текстовый вопрос
+FAKE_BACKEND_DOCUMENT_FACTOR = float(os.environ.get("FAKE_BACKEND_DOCUMENT_FACTOR", "1"))
+FAKE_BACKEND_FAILURE_RATE = float(os.environ.get("FAKE_BACKEND_FAILURE_RATE", "0"))
+
+# Сколько ждать одинаковое извлечение, выполняемое другим запросом или воркером (сек)
+SINGLE_FLIGHT_TIMEOUT = float(os.environ.get("SINGLE_FLIGHT_TIMEOUT", "600"))
+
+# Максимальный размер загружаемого файла
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+# Файлы крупнее передаются модели через File API, а не встроенным base64
+INLINE_PAYLOAD_MAX_BYTES = int(os.environ.get("INLINE_PAYLOAD_MAX_BYTES", str(4 * 1024 * 1024)))
+
+# Статистика: "sqlite" — общая для всех воркеров gunicorn, "memory" — только процесс
+STATS_BACKEND = os.environ.get("STATS_BACKEND", "sqlite")
+STATS_DB = os.environ.get("STATS_DB", "data/stats.db")
+
+# Ключ подписи сессий; должен совпадать у всех воркеров, иначе сессия теряется при смене воркера
+SECRET_KEY = os.environ.get("SECRET_KEY")
+# Поток статистики /api/stats/stream: частота опроса, heartbeat и максимальная длительность (сек)
+STATS_POLL_INTERVAL = float(os.environ.get("STATS_POLL_INTERVAL", "1"))
+STATS_HEARTBEAT_INTERVAL = float(os.environ.get("STATS_HEARTBEAT_INTERVAL", "15"))
+STATS_STREAM_MAX_DURATION = float(os.environ.get("STATS_STREAM_MAX_DURATION", "300"))
+
+# Размер пула потоков для блокирующих этапов асинхронного конвейера
+ASYNC_EXECUTOR_WORKERS = int(os.environ.get("ASYNC_EXECUTOR_WORKERS", "16"))
+
+# Наблюдатель за папкой (watch_folder.py): папка, воркеры, размер очереди, время стабилизации файла и интервал опроса (сек)
+WATCH_FOLDER = os.environ.get("WATCH_FOLDER", UPLOAD_DIR)
+WATCH_WORKERS = int(os.environ.get("WATCH_WORKERS", "2"))
+WATCH_QUEUE_SIZE = int(os.environ.get("WATCH_QUEUE_SIZE", "8"))
+WATCH_SETTLE_SECONDS = float(os.environ.get("WATCH_SETTLE_SECONDS", "2"))
+WATCH_POLL_INTERVAL = float(os.environ.get("WATCH_POLL_INTERVAL", "1"))
+
+# Учёт расхода модели: цены в USD за 1 млн токенов (вход, выход)
+MODEL_PRICES = {
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-1.5-pro": (1.25, 5.00),
+}
+# Дневной бюджет арендатора в USD (0 — без ограничения) и индивидуальные бюджеты вида "acme=5,beta=20"
+TENANT_DAILY_BUDGET = float(os.environ.get("TENANT_DAILY_BUDGET", "0"))
+TENANT_BUDGETS = {
+    name.strip(): float(value)
+    for name, value in (item.split("=", 1) for item in os.environ.get("TENANT_BUDGETS", "").split(",") if "=" in item)
+}
+# Арендаторы по API-токенам вида "token1=acme,token2=beta"; токен передаётся в заголовке X-Api-Token.
+# Запросы без известного токена учитываются как "default"
+TENANT_TOKENS = {
+    token.strip(): name.strip()
+    for token, name in (item.split("=", 1) for item in os.environ.get("TENANT_TOKENS", "").split(",") if "=" in item)
+}
+
+# Подготовка изображений перед отправкой модели: включение, целевой DPI, качество JPEG, оттенки серого
+IMAGE_PREPROCESSING = os.environ.get("IMAGE_PREPROCESSING", "1") == "1"
+IMAGE_TARGET_DPI = int(os.environ.get("IMAGE_TARGET_DPI", "150"))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "80"))
+IMAGE_GRAYSCALE = os.environ.get("IMAGE_GRAYSCALE", "1") == "1"
+# Растеризация PDF: только страницы с реквизитами, не больше PDF_MAX_RASTER_PAGES
+PDF_RASTERIZE = os.environ.get("PDF_RASTERIZE", "0") == "1"
+PDF_MAX_RASTER_PAGES = int(os.environ.get("PDF_MAX_RASTER_PAGES", "10"))
+
+# Переобработка сохранённых ответов модели (reprocess.py, /admin/reprocess): файлов в пачке и процессов классификации
+REPROCESS_BATCH_SIZE = int(os.environ.get("REPROCESS_BATCH_SIZE", "200"))
+REPROCESS_WORKERS = int(os.environ.get("REPROCESS_WORKERS", "1"))
+
+# Сортировка документов перед извлечением: включение, отказ от нефинансовых документов,
+# сколько страниц текстового слоя читать, OCR первой страницы сканов через tesseract (язык, таймаут в сек)
+TRIAGE_ENABLED = os.environ.get("TRIAGE_ENABLED", "1") == "1"
+TRIAGE_REJECT_IRRELEVANT = os.environ.get("TRIAGE_REJECT_IRRELEVANT", "1") == "1"
+TRIAGE_MAX_PAGES = int(os.environ.get("TRIAGE_MAX_PAGES", "2"))
+TRIAGE_OCR = os.environ.get("TRIAGE_OCR", "1") == "1"
+TRIAGE_OCR_LANG = os.environ.get("TRIAGE_OCR_LANG", "rus+eng")
+TRIAGE_OCR_TIMEOUT = float(os.environ.get("TRIAGE_OCR_TIMEOUT", "10"))
+
+# Допуск загрузок (на процесс): одновременных обработок, на одну сессию, мест в очереди ожидания,
+# сколько ждать в очереди (сек) и Retry-After по умолчанию, пока нет статистики времени обработки
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", "4"))
+ADMISSION_MAX_PER_SESSION = int(os.environ.get("ADMISSION_MAX_PER_SESSION", "2"))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "8"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "30"))
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", "5"))
+
+# Трассировка запросов: доля трассируемых запросов (0 — выключена), файл спанов,
+# размер файла до ротации (байт) и число хранимых старых файлов
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE = os.environ.get("TRACE_FILE", "data/traces/spans.jsonl")
+TRACE_MAX_BYTES = int(os.environ.get("TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.environ.get("TRACE_BACKUP_COUNT", "5"))
@@ -1,21 +1,126 @@
-from modules.document_parser import extract_invoice_data
-from modules.accounting_logic import classify_transaction
-from pathlib import Path
-import json
-from config import OUTPUT_DIR
-
-def main():
-    file_path = Path("data/uploads/test.pdf")  # Пример файла
-    result = extract_invoice_data(file_path)
-
-    if "error" not in result:
-        result["Счет"] = classify_transaction(result.get("Назначение", ""))
-    output_path = Path(OUTPUT_DIR) / "invoice_data.json"
-
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
-
-    print("✅ Обработка завершена. Результат сохранён в:", output_path)
-
-if __name__ == "__main__":
-    main()
+"""
+Пакетная обработка документов через полный конвейер.
+
+Примеры:
+    python main.py data/uploads
+    python main.py "scans/2024-*/*.pdf" --workers 8 --save-db
+    python main.py scans --executor process --output data/outputs/march.jsonl
+
+Результат по каждому файлу пишется строкой JSONL. Файлы, чьё содержимое
+уже есть в выходном файле, пропускаются, поэтому прерванный запуск можно
+просто повторить.
+"""
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from pathlib import Path
+from config import OUTPUT_DIR
+
+SUPPORTED_EXTENSIONS = {".pdf", ".jpg", ".jpeg", ".png"}
+
+def collect_files(inputs, recursive=False):
+    """Раскрывает каталоги и glob-шаблоны в список поддерживаемых файлов."""
+    files = []
+    seen = set()
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            candidates = path.rglob("*") if recursive else path.iterdir()
+        else:
+            candidates = (Path(p) for p in glob.glob(item, recursive=True))
+        for candidate in sorted(candidates):
+            if candidate.is_file() and candidate.suffix.lower() in SUPPORTED_EXTENSIONS:
+                resolved = candidate.resolve()
+                if resolved not in seen:
+                    seen.add(resolved)
+                    files.append(candidate)
+    return files
+
+def load_processed_hashes(output_path):
+    """Хэши содержимого, уже записанные в выходной JSONL."""
+    hashes = set()
+    if not output_path.exists():
+        return hashes
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Последняя строка могла оборваться при аварийной остановке
+                continue
+            if record.get("content_hash") and not record.get("error"):
+                hashes.add(record["content_hash"])
+    return hashes
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Пакетная обработка счетов и выписок",
+        epilog=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("inputs", nargs="+", help="каталоги, файлы или glob-шаблоны")
+    parser.add_argument("-o", "--output", default=str(Path(OUTPUT_DIR) / "invoice_data.jsonl"),
+                        help="выходной JSONL-файл (дописывается)")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="размер пула")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread",
+                        help="пул потоков (по умолчанию) или процессов")
+    parser.add_argument("-r", "--recursive", action="store_true", help="обходить подкаталоги")
+    parser.add_argument("--save-db", action="store_true", help="сохранять результаты в базу данных")
+    args = parser.parse_args()
+
+    from modules.document_parser import file_content_hash
+    from modules.pipeline import process_document_file
+
+    output_path = Path(args.output)
+    os.makedirs(output_path.parent, exist_ok=True)
+    processed_hashes = load_processed_hashes(output_path)
+    if args.save_db:
+        from modules.database import get_processed_content_hashes
+        processed_hashes |= get_processed_content_hashes()
+
+    files = collect_files(args.inputs, args.recursive)
+    pending = []
+    skipped = 0
+    for file_path in files:
+        content_hash = file_content_hash(file_path)
+        if content_hash in processed_hashes:
+            skipped += 1
+            continue
+        # Одинаковые файлы внутри одного запуска обрабатываются один раз
+        processed_hashes.add(content_hash)
+        pending.append((file_path, content_hash))
+
+    print(f"Найдено файлов: {len(files)}, к обработке: {len(pending)}, пропущено: {skipped}")
+
+    pool_class = ProcessPoolExecutor if args.executor == "process" else ThreadPoolExecutor
+    started = time.perf_counter()
+    done = failed = transactions_total = 0
+    with pool_class(max_workers=args.workers) as pool, open(output_path, "a", encoding="utf-8") as out:
+        futures = {
+            pool.submit(process_document_file, file_path, content_hash, args.save_db): file_path
+            for file_path, content_hash in pending
+        }
+        for future in as_completed(futures):
+            record = future.result()
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            done += 1
+            if record.get("error"):
+                failed += 1
+                print(f"[{done}/{len(pending)}] ❌ {record['file']}: {record['error']}")
+            else:
+                transactions_total += record["saved_transactions"]
+                print(f"[{done}/{len(pending)}] ✅ {record['file']}: {record['saved_transactions']} тр., {record['seconds']} с")
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"\nОбработано: {done} (ошибок: {failed}), транзакций: {transactions_total}\n"
+        f"Время: {elapsed:.1f} с, {done / elapsed if elapsed else 0:.2f} файл/с, "
+        f"{transactions_total / elapsed if elapsed else 0:.2f} тр./с\n"
+        f"✅ Результаты сохранены в: {output_path}"
+    )
+
+if __name__ == "__main__":
+    main()
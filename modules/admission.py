@@ -0,0 +1,230 @@
+"""
+Допуск запросов на загрузку документов (admission control).
+
+- Глобальный лимит одновременно обрабатываемых загрузок и лимит на одну сессию
+- Ограниченная очередь ожидания (FIFO) с таймаутом
+- Сверх лимитов запрос сразу получает отказ с Retry-After, а не висит:
+  429 — превышен лимит сессии, 503 — очередь заполнена или ожидание истекло
+- Retry-After оценивается по среднему времени обработки и длине очереди
+
+Лимиты действуют в пределах процесса: при нескольких воркерах gunicorn
+общий предел равен лимиту, умноженному на число воркеров.
+"""
+import asyncio
+import itertools
+import math
+import threading
+import time
+from collections import deque
+from config import (
+    ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_PER_SESSION, ADMISSION_QUEUE_SIZE,
+    ADMISSION_QUEUE_TIMEOUT, ADMISSION_RETRY_AFTER
+)
+from modules.stats_tracker import stats_tracker
+
+class AdmissionRejected(Exception):
+    """Запрос не допущен: status — HTTP-код ответа, retry_after — через сколько секунд повторить,
+    code — ключ причины из REJECTION_MESSAGES"""
+    def __init__(self, status, reason, retry_after, code=None):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+        self.code = code
+
+    def as_dict(self):
+        return {'error': self.reason, 'retry_after': self.retry_after}
+
+REJECTION_MESSAGES = {
+    'session_limit': "Слишком много одновременных загрузок из этой сессии",
+    'queue_full': "Сервер перегружен, очередь загрузок заполнена",
+    'queue_timeout': "Сервер перегружен, загрузка не дождалась очереди",
+}
+
+class Admission:
+    """Разрешение на обработку; освобождается ровно один раз"""
+    def __init__(self, controller, session_key):
+        self.controller = controller
+        self.session_key = session_key
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class AdmissionController:
+    def __init__(self, max_concurrent=4, max_per_session=2, queue_size=8, queue_timeout=30.0,
+                 default_retry_after=5):
+        self.max_concurrent = max_concurrent
+        self.max_per_session = max_per_session
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.default_retry_after = default_retry_after
+        self.condition = threading.Condition()
+        self.active = 0
+        # Сессия -> число её загрузок в обработке и в очереди
+        self.per_session = {}
+        # Номера ожидающих в порядке прихода: допускается только голова очереди
+        self.waiting = deque()
+        self.tickets = itertools.count()
+        # Скользящее среднее времени обработки (сек) для оценки Retry-After
+        self.avg_hold_seconds = None
+        self.max_wait_seconds = 0.0
+
+    def _retry_after(self):
+        """Через сколько секунд освободится место для нового запроса"""
+        if self.avg_hold_seconds is None:
+            return self.default_retry_after
+        rounds = (len(self.waiting) + 1) / max(1, self.max_concurrent)
+        return max(1, min(300, math.ceil(self.avg_hold_seconds * rounds)))
+
+    def _reject(self, status, reason):
+        """Отказ под блокировкой; счётчик отказов увеличивает вызывающий, уже отпустив её"""
+        raise AdmissionRejected(status, REJECTION_MESSAGES[reason], self._retry_after(), reason)
+
+    def _enter(self, session_key):
+        """Постановка в очередь под блокировкой. Возвращает номер ожидающего или None, если допущен сразу"""
+        if self.per_session.get(session_key, 0) >= self.max_per_session:
+            self._reject(429, 'session_limit')
+        if self.active < self.max_concurrent and not self.waiting:
+            self._admit(session_key)
+            return None
+        if len(self.waiting) >= self.queue_size:
+            self._reject(503, 'queue_full')
+        ticket = next(self.tickets)
+        self.waiting.append(ticket)
+        self.per_session[session_key] = self.per_session.get(session_key, 0) + 1
+        return ticket
+
+    def _admit(self, session_key, queued=False):
+        self.active += 1
+        if not queued:
+            self.per_session[session_key] = self.per_session.get(session_key, 0) + 1
+
+    def _try_leave_queue(self, ticket, session_key):
+        """Допуск ожидающего, если он первый в очереди и есть свободное место"""
+        if self.waiting[0] == ticket and self.active < self.max_concurrent:
+            self.waiting.popleft()
+            self._admit(session_key, queued=True)
+            # Следующий в очереди тоже может пройти, если мест несколько
+            self.condition.notify_all()
+            return True
+        return False
+
+    def _leave_queue(self, ticket, session_key):
+        """Уход из очереди без допуска (таймаут или отмена ожидания)"""
+        self.waiting.remove(ticket)
+        self._decrement_session(session_key)
+        self.condition.notify_all()
+
+    def _abandon(self, ticket, session_key, waited):
+        self._leave_queue(ticket, session_key)
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self._reject(503, 'queue_timeout')
+
+    def _admitted(self, session_key, waited):
+        """Разрешение допущенному; вызывается вне блокировки"""
+        if waited:
+            with self.condition:
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        stats_tracker.increment('admission_admitted')
+        if waited:
+            stats_tracker.increment('admission_queued')
+        return Admission(self, session_key)
+
+    def acquire(self, session_key):
+        """Допуск запроса: сразу, после ожидания в очереди или AdmissionRejected"""
+        started = time.monotonic()
+        waited = 0.0
+        try:
+            with self.condition:
+                ticket = self._enter(session_key)
+                if ticket is not None:
+                    deadline = started + self.queue_timeout
+                    while not self._try_leave_queue(ticket, session_key):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._abandon(ticket, session_key, time.monotonic() - started)
+                        self.condition.wait(remaining)
+                    waited = time.monotonic() - started
+        except AdmissionRejected as e:
+            stats_tracker.increment(f'admission_rejected_{e.code}')
+            raise
+        return self._admitted(session_key, waited)
+
+    async def acquire_async(self, session_key, poll_interval=0.05):
+        """Асинхронный допуск: ожидание в очереди не занимает поток пула.
+
+        Отмена ожидания (клиент отключился) убирает запрос из очереди, иначе
+        он остался бы в её голове и задерживал всех следующих до таймаута.
+        """
+        started = time.monotonic()
+        waited = 0.0
+        try:
+            with self.condition:
+                ticket = self._enter(session_key)
+            if ticket is not None:
+                await self._wait_in_queue(ticket, session_key, started, poll_interval)
+                waited = time.monotonic() - started
+        except AdmissionRejected as e:
+            stats_tracker.increment(f'admission_rejected_{e.code}')
+            raise
+        return self._admitted(session_key, waited)
+
+    async def _wait_in_queue(self, ticket, session_key, started, poll_interval):
+        deadline = started + self.queue_timeout
+        try:
+            while True:
+                with self.condition:
+                    if self._try_leave_queue(ticket, session_key):
+                        return
+                    if time.monotonic() >= deadline:
+                        self._abandon(ticket, session_key, time.monotonic() - started)
+                await asyncio.sleep(poll_interval)
+        except asyncio.CancelledError:
+            # Отмена приходит только в await, когда запрос ещё в очереди
+            with self.condition:
+                self._leave_queue(ticket, session_key)
+            raise
+
+    def _decrement_session(self, session_key):
+        count = self.per_session.get(session_key, 0) - 1
+        if count > 0:
+            self.per_session[session_key] = count
+        else:
+            self.per_session.pop(session_key, None)
+
+    def _release(self, admission):
+        held = time.monotonic() - admission.started
+        with self.condition:
+            self.active -= 1
+            self._decrement_session(admission.session_key)
+            self.avg_hold_seconds = held if self.avg_hold_seconds is None else 0.8 * self.avg_hold_seconds + 0.2 * held
+            self.condition.notify_all()
+
+    def get_stats(self):
+        """Текущее состояние допуска этого процесса"""
+        with self.condition:
+            return {
+                'active': self.active,
+                'waiting': len(self.waiting),
+                'max_concurrent': self.max_concurrent,
+                'max_per_session': self.max_per_session,
+                'queue_size': self.queue_size,
+                'avg_processing_seconds': round(self.avg_hold_seconds, 3) if self.avg_hold_seconds is not None else None,
+                'max_wait_seconds': round(self.max_wait_seconds, 3),
+            }
+
+# Глобальный контроллер допуска загрузок
+upload_admission = AdmissionController(
+    ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_PER_SESSION, ADMISSION_QUEUE_SIZE,
+    ADMISSION_QUEUE_TIMEOUT, ADMISSION_RETRY_AFTER
+)
@@ -0,0 +1,38 @@
+"""
+Реестр причин аномалий. В базе причины хранятся битовой маской в transactions.anomaly_mask,
+в текст они превращаются только при отображении.
+
+Биты нельзя переиспользовать: новые причины получают следующий свободный бит.
+"""
+
+# Код причины -> (бит, подпись)
+ANOMALY_CODES = {
+    'unusual_amount': (1 << 0, "Необычная сумма"),
+    'missing_inn': (1 << 1, "Отсутствует ИНН"),
+    'missing_counterparty': (1 << 2, "Отсутствует контрагент"),
+    'zero_amount': (1 << 3, "Нулевая или отсутствующая сумма"),
+}
+
+# Причины из старых записей, подписи которых нет в реестре
+OTHER_ANOMALY_BIT = 1 << 30
+
+_BIT_BY_LABEL = {label: bit for bit, label in ANOMALY_CODES.values()}
+
+def anomaly_bit(code):
+    return ANOMALY_CODES[code][0]
+
+def labels_to_mask(labels):
+    """Маска по списку подписей (для переноса старых JSON-записей)"""
+    mask = 0
+    for label in labels or []:
+        mask |= _BIT_BY_LABEL.get(label, OTHER_ANOMALY_BIT)
+    return mask
+
+def mask_to_labels(mask):
+    """Подписи причин по маске в порядке реестра"""
+    if not mask:
+        return []
+    labels = [label for bit, label in ANOMALY_CODES.values() if mask & bit]
+    if mask & OTHER_ANOMALY_BIT:
+        labels.append("Другое")
+    return labels
@@ -2,6 +2,7 @@ import pandas as pd
 from sklearn.ensemble import IsolationForest
 import re
 from typing import List, Dict, Any
+from modules.anomaly_codes import anomaly_bit, mask_to_labels
 
 def parse_amount(amount_str: str) -> float:
     """Извлекает числовое значение из строки суммы."""
@@ -25,11 +26,13 @@ def detect_anomalies_in_transactions(transactions: List[Dict[str, Any]]) -> List
     - Подозрительные паттерны
     
     Returns:
-        List с добавленными полями 'is_anomaly' и 'anomaly_reasons'
+        List с добавленными полями 'is_anomaly', 'anomaly_mask' (биты из anomaly_codes)
+        и 'anomaly_reasons' (подписи причин)
     """
     if not transactions or len(transactions) < 3:
         for t in transactions:
             t['is_anomaly'] = False
+            t['anomaly_mask'] = 0
             t['anomaly_reasons'] = []
         return transactions
     
@@ -52,21 +55,22 @@ def detect_anomalies_in_transactions(transactions: List[Dict[str, Any]]) -> List
         predictions = [1] * len(amounts)
     
     for i, transaction in enumerate(transactions):
-        anomaly_reasons = []
+        mask = 0
         
         if predictions[i] == -1 and amounts[i] > 0:
-            anomaly_reasons.append("Необычная сумма")
+            mask |= anomaly_bit('unusual_amount')
         
         if not transaction.get('ИНН поставщика') or transaction.get('ИНН поставщика') == 'Не указан':
-            anomaly_reasons.append("Отсутствует ИНН")
+            mask |= anomaly_bit('missing_inn')
         
         if not transaction.get('Название контрагента') or transaction.get('Название контрагента') == 'Не указано':
-            anomaly_reasons.append("Отсутствует контрагент")
+            mask |= anomaly_bit('missing_counterparty')
         
         if amounts[i] == 0:
-            anomaly_reasons.append("Нулевая или отсутствующая сумма")
+            mask |= anomaly_bit('zero_amount')
         
-        transaction['is_anomaly'] = len(anomaly_reasons) > 0
-        transaction['anomaly_reasons'] = anomaly_reasons
+        transaction['is_anomaly'] = mask != 0
+        transaction['anomaly_mask'] = mask
+        transaction['anomaly_reasons'] = mask_to_labels(mask)
     
     return transactions
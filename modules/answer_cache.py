@@ -0,0 +1,167 @@
+"""
+Кэш ответов ИИ-бухгалтера для повторяющихся вопросов в /chat:
+- Ключ — нормализованный текст вопроса (регистр, пробелы и пунктуация свёрнуты)
+  и выдержка из базы, на которой построен ответ: после изменения данных ответ не повторяется
+- Ограничение по времени жизни (TTL) и по количеству записей (LRU)
+- Необязательное общее SQLite-хранилище для всех воркеров gunicorn
+"""
+import re
+import sqlite3
+import time
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+from config import ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL, ANSWER_CACHE_DB
+
+_PUNCTUATION_RE = re.compile(r'[^\w\s]+', re.UNICODE)
+_WHITESPACE_RE = re.compile(r'\s+', re.UNICODE)
+
+def normalize_question(text):
+    """Приводит вопрос к каноническому виду для поиска в кэше."""
+    if not text:
+        return ""
+    text = text.casefold().replace('ё', 'е')
+    text = _PUNCTUATION_RE.sub(' ', text)
+    text = _WHITESPACE_RE.sub(' ', text)
+    return text.strip()
+
+def make_cache_key(text, context=""):
+    """Ключ кэша: хэш нормализованного вопроса и контекста из базы."""
+    key_text = normalize_question(text)
+    if context:
+        key_text += "\n" + context
+    return hashlib.sha256(key_text.encode('utf-8')).hexdigest()
+
+class AnswerCache:
+    def __init__(self, max_entries=1000, ttl=86400, db_path=None):
+        self.lock = Lock()
+        # Локальный LRU: ключ -> (ответ, время создания)
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Путь к общему SQLite-хранилищу (None — только память процесса)
+        self.db_path = db_path
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        if self.db_path:
+            self._init_shared_store()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def _init_shared_store(self):
+        """Создание таблицы общего кэша"""
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                cache_key TEXT PRIMARY KEY,
+                question TEXT,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                hits INTEGER DEFAULT 0
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_answer_cache_created ON answer_cache (created_at)')
+        conn.commit()
+        conn.close()
+
+    def _remember(self, key, answer, created_at):
+        """Положить запись в локальный LRU с вытеснением старых"""
+        self.entries[key] = (answer, created_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, question, context=""):
+        """Получить ответ из кэша или None"""
+        key = make_cache_key(question, context)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                answer, created_at = entry
+                if now - created_at <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return answer
+                del self.entries[key]
+
+        if self.db_path:
+            try:
+                conn = self._connect()
+                row = conn.execute(
+                    'SELECT answer, created_at FROM answer_cache WHERE cache_key = ? AND created_at >= ?',
+                    (key, now - self.ttl)
+                ).fetchone()
+                if row:
+                    conn.execute('UPDATE answer_cache SET hits = hits + 1 WHERE cache_key = ?', (key,))
+                    conn.commit()
+                conn.close()
+            except sqlite3.Error:
+                row = None
+            if row:
+                with self.lock:
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    self.shared_hits += 1
+                return row[0]
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, question, answer, context=""):
+        """Сохранить ответ в кэш"""
+        if not answer:
+            return
+        key = make_cache_key(question, context)
+        now = time.time()
+        with self.lock:
+            self._remember(key, answer, now)
+
+        if self.db_path:
+            try:
+                conn = self._connect()
+                conn.execute(
+                    'INSERT OR REPLACE INTO answer_cache (cache_key, question, answer, created_at) VALUES (?, ?, ?, ?)',
+                    (key, normalize_question(question), answer, now)
+                )
+                conn.execute('DELETE FROM answer_cache WHERE created_at < ?', (now - self.ttl,))
+                conn.commit()
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def purge(self):
+        """Очистить кэш полностью. Возвращает количество удалённых записей"""
+        with self.lock:
+            removed = len(self.entries)
+            self.entries.clear()
+
+        if self.db_path:
+            conn = self._connect()
+            cursor = conn.execute('DELETE FROM answer_cache')
+            removed = max(removed, cursor.rowcount)
+            conn.commit()
+            conn.close()
+        return removed
+
+    def get_stats(self):
+        """Метрики попаданий в кэш для текущего процесса"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+# Глобальный экземпляр кэша ответов
+answer_cache = AnswerCache(
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    ttl=ANSWER_CACHE_TTL,
+    db_path=ANSWER_CACHE_DB
+)
@@ -0,0 +1,157 @@
+"""
+ASGI-приложение: асинхронные эндпоинты загрузки и чата поверх asyncio-конвейера,
+все остальные маршруты обслуживает существующее Flask-приложение.
+
+Эндпоинты:
+- POST /api/v2/chat     — JSON {"message": "..."} -> {"answer": "..."}
+- POST /api/v2/upload   — тело запроса = содержимое файла,
+                          ?filename=invoice.pdf&question=... -> JSON с результатом
+"""
+import json
+import secrets
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.utils import secure_filename
+from config import UPLOAD_DIR, MAX_UPLOAD_BYTES, ADMIN_TOKEN
+from modules.admission import upload_admission, AdmissionRejected
+from modules.async_pipeline import answer_chat, process_document, run_blocking
+from modules.chatbot_interface import app as flask_app
+from modules.model_client import ModelUnavailableError
+from modules.model_scheduler import current_priority, current_session
+from modules.tracing import span, start_trace, NOOP_SPAN
+from modules.usage_accounting import current_tenant, resolve_tenant
+from modules.upload_storage import UploadWriter, UploadTooLargeError, CHUNK_SIZE
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+def client_key(scope):
+    """Сессий здесь нет: лимиты и очередь к модели считаются по адресу клиента"""
+    return (scope.get('client') or ('unknown',))[0]
+
+def trace_forced(headers):
+    """Администратор может трассировать отдельный запрос заголовком X-Trace: 1"""
+    if not ADMIN_TOKEN or headers.get(b'x-trace') != b'1':
+        return False
+    return secrets.compare_digest(headers.get(b'x-admin-token', b'').decode('latin-1'), ADMIN_TOKEN)
+
+async def send_json(send, status, payload, headers=None):
+    body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json; charset=utf-8'),
+            (b'content-length', str(len(body)).encode()),
+        ] + [(name.encode(), value.encode()) for name, value in (headers or {}).items()],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def read_body(receive, max_bytes):
+    """Тело небольшого запроса целиком (для JSON)"""
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > max_bytes:
+            raise UploadTooLargeError("Слишком большой запрос")
+        if not message.get('more_body'):
+            return body
+
+async def chat_endpoint(scope, receive, send):
+    try:
+        data = json.loads(await read_body(receive, 64 * 1024) or b'{}')
+    except (ValueError, UploadTooLargeError):
+        return await send_json(send, 400, {'error': 'invalid request'})
+    message = (data.get('message') or '').strip()
+    if not message:
+        return await send_json(send, 400, {'error': 'message is required'})
+    try:
+        answer = await answer_chat(message)
+    except ModelUnavailableError as e:
+        return await send_json(send, 503, {'error': str(e)})
+    await send_json(send, 200, {'answer': answer})
+
+async def upload_endpoint(scope, receive, send):
+    params = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+    safe_filename = secure_filename(params.get('filename', [''])[0])
+    if not safe_filename:
+        return await send_json(send, 400, {'error': 'filename is required'})
+    question = params.get('question', [''])[0].strip() or None
+
+    try:
+        admission = await upload_admission.acquire_async(client_key(scope))
+    except AdmissionRejected as e:
+        return await send_json(send, e.status, e.as_dict(), {'Retry-After': str(e.retry_after)})
+    with admission:
+        await process_upload(safe_filename, question, receive, send)
+
+async def process_upload(safe_filename, question, receive, send):
+    # Тело пишется на диск по мере поступления, в памяти только текущая часть
+    writer = await run_blocking(UploadWriter, UPLOAD_DIR, safe_filename, MAX_UPLOAD_BYTES)
+    # Мелкие части тела копятся до CHUNK_SIZE и пишутся в пуле потоков, не блокируя цикл событий
+    buffer = bytearray()
+    try:
+        with span("file.save") as save_span:
+            try:
+                while True:
+                    message = await receive()
+                    if message['type'] == 'http.disconnect':
+                        await run_blocking(writer.abort)
+                        return
+                    buffer += message.get('body', b'')
+                    more_body = message.get('more_body')
+                    if len(buffer) >= CHUNK_SIZE or (buffer and not more_body):
+                        await run_blocking(writer.write, bytes(buffer))
+                        buffer.clear()
+                    if not more_body:
+                        break
+                stored = await run_blocking(writer.commit)
+            except BaseException:
+                # Отмена задачи или ошибка записи на диск не должны оставлять .part в каталоге загрузок
+                await run_blocking(writer.abort)
+                raise
+            save_span.set(bytes=stored.size)
+    except UploadTooLargeError as e:
+        return await send_json(send, 413, {'error': str(e)})
+
+    try:
+        result = await process_document(stored, question)
+    except ModelUnavailableError as e:
+        return await send_json(send, 503, {'error': str(e)})
+    await send_json(send, 200, result)
+
+ROUTES = {
+    ('POST', '/api/v2/chat'): chat_endpoint,
+    ('POST', '/api/v2/upload'): upload_endpoint,
+}
+ROUTE_PRIORITIES = {'/api/v2/chat': 'interactive'}
+
+async def app(scope, receive, send):
+    """Точка входа ASGI"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    handler = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is None:
+        return await wsgi_app(scope, receive, send)
+    headers = dict(scope.get('headers') or [])
+    current_tenant.set(resolve_tenant(headers.get(b'x-api-token', b'').decode('latin-1')))
+    current_session.set(client_key(scope))
+    current_priority.set(ROUTE_PRIORITIES.get(scope['path'], 'upload'))
+    with start_trace(f"{scope['method']} {scope['path']}", force=trace_forced(headers)) as root:
+        if root is not NOOP_SPAN:
+            send = _status_recorder(root, send)
+        await handler(scope, receive, send)
+
+def _status_recorder(root, send):
+    """send, записывающий код ответа в корневой спан"""
+    async def recording_send(message):
+        if message['type'] == 'http.response.start':
+            root.set(status=message['status'])
+        await send(message)
+    return recording_send
@@ -0,0 +1,116 @@
+"""
+Асинхронный конвейер загрузки и чата на asyncio.
+
+Вызовы модели выполняются через асинхронный API и не занимают поток на время
+ожидания, поэтому один процесс держит сотни одновременных извлечений.
+Блокирующие этапы (SQLite, IsolationForest, чтение файлов) уходят в пул потоков.
+"""
+import asyncio
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from config import ASYNC_EXECUTOR_WORKERS
+from modules.answer_cache import answer_cache
+from modules.chat_retrieval import build_chat_prompt
+from modules.database import save_file_and_transactions, record_ingestion, compress_extraction
+from modules.document_parser import DocumentPayload, extract_invoice_data_async
+from modules.model_client import generate_content_async
+from modules.pipeline import enrich_transactions, document_question_prompt, is_rejected
+from modules.single_flight import extraction_flight
+from modules.stats_tracker import stats_tracker
+from modules.tracing import span, propagate
+
+executor = ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS, thread_name_prefix="pipeline")
+
+# Извлечения в процессе в этом цикле событий: хэш содержимого -> задача
+_inflight_extractions = {}
+
+async def run_blocking(fn, *args, **kwargs):
+    """Выполнить блокирующую функцию в пуле потоков конвейера.
+
+    run_in_executor не переносит контекст в поток, поэтому он копируется явно:
+    спаны трассировки в fn становятся дочерними для текущего.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, propagate(partial(fn, *args, **kwargs)))
+
+async def answer_chat(question):
+    """Ответ ИИ-бухгалтера на вопрос с учётом кэша ответов"""
+    with span("retrieval"):
+        prompt, context = await run_blocking(build_chat_prompt, question)
+    answer = await run_blocking(answer_cache.get, question, context)
+    if answer is not None:
+        await run_blocking(stats_tracker.increment, 'chat_cache_hits')
+    else:
+        response = await generate_content_async(prompt, usage={"operation": "chat"})
+        answer = response.text
+        await run_blocking(answer_cache.set, question, answer, context)
+    await run_blocking(stats_tracker.increment, 'chat_answered')
+    return answer
+
+async def extract_shared(content_hash, file_path, payload):
+    """Извлечение транзакций, общее для одновременных загрузок одного содержимого"""
+    task = _inflight_extractions.get(content_hash)
+    if task is None:
+        # Между воркерами — та же блокировка по ключу, что и у /upload
+        task = asyncio.ensure_future(extraction_flight.run_shared_async(
+            f"extract:{content_hash}", lambda: extract_invoice_data_async(file_path, payload)
+        ))
+        _inflight_extractions[content_hash] = task
+        task.add_done_callback(lambda _: _inflight_extractions.pop(content_hash, None))
+    # shield: отмена одного ожидающего не отменяет извлечение для остальных
+    result = await asyncio.shield(task)
+    return copy.deepcopy(result)
+
+async def ask_document_question(payload, question):
+    """Ответ на вопрос по документу; ошибка возвращается текстом, как в /upload"""
+    try:
+        with span("question"):
+            part = await payload.as_part_async()
+            response = await generate_content_async(
+                [part, {"text": document_question_prompt(question)}],
+                usage=payload.usage_info("document_question")
+            )
+        await run_blocking(stats_tracker.increment, 'questions_answered')
+        return response.text
+    except Exception as e:
+        return f"Ошибка при обработке вопроса: {str(e)}"
+
+async def process_document(stored, question=None):
+    """Полная обработка сохранённого файла: вопрос, извлечение, классификация, аномалии, запись в БД"""
+    file_path = Path(stored.path)
+    job_id = await run_blocking(stats_tracker.start_processing, file_path.name)
+    try:
+        await run_blocking(record_ingestion, stored.sha256, file_path, 'web')
+        await run_blocking(stats_tracker.increment, 'uploads_received')
+        payload = await run_blocking(DocumentPayload, file_path)
+
+        # Вопрос и извлечение идут параллельно, а не друг за другом
+        extraction = extract_shared(stored.sha256, file_path, payload)
+        if question:
+            transactions, ai_answer = await asyncio.gather(extraction, ask_document_question(payload, question))
+        else:
+            transactions, ai_answer = await extraction, None
+        await run_blocking(
+            stats_tracker.increment, 'documents_rejected' if is_rejected(transactions) else 'extractions_done'
+        )
+
+        raw_extraction = await run_blocking(compress_extraction, transactions)
+        transactions, successful_transactions = await run_blocking(enrich_transactions, transactions)
+        file_id = await run_blocking(
+            save_file_and_transactions,
+            file_path.name, file_path.suffix.lower(), successful_transactions, question, ai_answer,
+            content_hash=stored.sha256, raw_extraction=raw_extraction
+        )
+        await run_blocking(stats_tracker.increment, 'transactions_saved', len(successful_transactions))
+
+        return {
+            'file_id': file_id,
+            'ai_answer': ai_answer,
+            'transactions': transactions,
+            'saved_transactions': len(successful_transactions),
+            'anomalies': sum(1 for t in successful_transactions if t.get('is_anomaly', False)),
+        }
+    finally:
+        await run_blocking(stats_tracker.finish_processing, job_id)
@@ -0,0 +1,316 @@
+"""
+Контекст из учётной базы для вопросов в чате.
+
+Вместо «голого» вопроса модель получает выдержку из базы:
+- Из вопроса извлекаются отборы: контрагент (по псевдонимам справочника), ИНН,
+  период по дате операции («в марте», «за 2024 год», «с 01.03.2024 по 15.03.2024»,
+  «в прошлом месяце») и остальные значимые слова
+- Итоги (число операций, сумма, крупнейшие контрагенты) считаются в SQL по всем
+  подходящим строкам, поэтому не зависят от объёма базы
+- Строки-примеры подбираются полнотекстовым индексом FTS5 с ранжированием BM25
+  и добавляются, пока укладываются в бюджет токенов
+
+Вопрос без отборов и совпадений (например, об учёте НДС вообще) уходит в модель как раньше.
+"""
+import logging
+import re
+from datetime import date, timedelta
+from config import CHAT_RETRIEVAL_ENABLED, CHAT_CONTEXT_TOKENS, CHAT_RETRIEVAL_TOP_K
+from modules.counterparties import normalize_counterparty_name, normalize_inn
+from modules.database import (
+    count_fulltext_matches, find_counterparty_aliases, get_transaction_aggregates, search_transactions
+)
+
+logger = logging.getLogger(__name__)
+
+BASE_PROMPT = "Ты опытный бухгалтер. Ответь на запрос: {question}"
+GROUNDED_PROMPT = (
+    "Ты опытный бухгалтер. Ниже выдержка из учётной базы пользователя: итоги посчитаны по всем "
+    "подходящим операциям, строки — только наиболее подходящие из них. Если вопрос касается операций "
+    "пользователя, отвечай по этим данным, а если их недостаточно, так и скажи.\n\n{context}\n\nВопрос: {question}"
+)
+HISTORY_PROMPT = "Предыдущие реплики этого разговора:\n{history}\n\n"
+
+MONTHS = (
+    ('январ', 1), ('феврал', 2), ('март', 3), ('апрел', 4), ('ма', 5), ('июн', 6),
+    ('июл', 7), ('август', 8), ('сентябр', 9), ('октябр', 10), ('ноябр', 11), ('декабр', 12),
+)
+MONTH_RE = re.compile(
+    r'\b(январ\w*|феврал\w*|март\w*|апрел\w*|ма[йяе](?!\w)|июн\w*|июл\w*|август\w*|сентябр\w*|октябр\w*|ноябр\w*|декабр\w*)'
+    r'(?:\s+(\d{4}))?'
+)
+DATE_RE = re.compile(r'\b(\d{1,2})\.(\d{1,2})\.(\d{4})\b')
+YEAR_RE = re.compile(r'\b(20\d{2})\b')
+INN_RE = re.compile(r'(?<!\d)(\d{10}|\d{12})(?!\d)')
+WORD_RE = re.compile(r'[а-яa-z0-9]+')
+RELATIVE_PERIOD_RE = re.compile(r'\b(прошл\w*|этом|текущ\w*)\s+(месяц\w*|году?)\b')
+
+# Слова, которые не несут отбора: вопросительные, служебные и про «деньги вообще»
+STOP_WORDS = set("""
+    а без в во все всего всех вы год году года для до за и из или как какая какие каким каких какой когда
+    кто ли мне мы на над нам нас не них о об от по под при про с со сколько там то у уже что чем это эти этот
+    я был была были было есть будет покажи показать скажи назови найди подскажи список перечисли
+    сумма сумму суммы итог итого общая общую всей заплатили платили потратили получили оплатили
+    оплата оплаты платеж платежи платежей операция операции операций транзакция транзакции транзакций
+    контрагент контрагента контрагентов контрагенту поставщик поставщика поставщиков инн ооо оао зао пао ао ип
+    месяц месяце месяца квартал квартале года году прошлом этом текущем самый самые больше меньше
+""".split())
+
+# Признаки вопроса об итогах: без других отборов даём сводку по всей базе
+AGGREGATE_RE = re.compile(r'сколько|сумм|итог|всего|общ\w+ (сумм|расход)|расход|потрат|крупн|больше всего')
+
+MAX_SEARCH_TERMS = 8
+# Доля операций, выше которой слово считается общим и не участвует в отборе
+COMMON_TERM_SHARE = 0.5
+PURPOSE_PREVIEW_CHARS = 120
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов (как у учёта использования локального бэкенда)"""
+    return len(text.encode('utf-8')) // 4
+
+def _stem(word):
+    """Основа слова для поиска по префиксу: отбрасываем окончание у длинных слов"""
+    return word[:max(4, len(word) - 3)] if len(word) > 5 else word
+
+def _same_word(word, other):
+    """Словоформы одного слова: общее начало, различие только в окончании («торговому» и «торговый»)"""
+    common = 0
+    for a, b in zip(word, other):
+        if a != b:
+            break
+        common += 1
+    return common >= min(3, len(word), len(other)) and max(len(word), len(other)) - common <= 3
+
+def _month_number(word):
+    for prefix, number in MONTHS:
+        if word.startswith(prefix):
+            return number
+    return None
+
+def _month_range(year, month):
+    first = date(year, month, 1)
+    last = (first.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    return first.isoformat(), last.isoformat()
+
+def parse_period(text, today=None):
+    """Период по дате операции из текста вопроса.
+
+    Returns:
+        dict с ключами operation_from/operation_to (ГГГГ-ММ-ДД) или operation_month, пустой — без периода
+    """
+    today = today or date.today()
+    dates = []
+    for day, month, year in DATE_RE.findall(text):
+        try:
+            dates.append(date(int(year), int(month), int(day)).isoformat())
+        except ValueError:
+            continue
+    if len(dates) >= 2:
+        return {'operation_from': min(dates), 'operation_to': max(dates)}
+    if dates:
+        return {'operation_from': dates[0], 'operation_to': dates[0]}
+
+    relative = RELATIVE_PERIOD_RE.search(text)
+    if relative:
+        previous = relative.group(1).startswith('прошл')
+        if relative.group(2).startswith('месяц'):
+            first = today.replace(day=1)
+            if previous:
+                first = (first - timedelta(days=1)).replace(day=1)
+            start, end = _month_range(first.year, first.month)
+            return {'operation_from': start, 'operation_to': end}
+        year = today.year - 1 if previous else today.year
+        return {'operation_from': f'{year}-01-01', 'operation_to': f'{year}-12-31'}
+
+    match = MONTH_RE.search(text)
+    if match:
+        month = _month_number(match.group(1))
+        year = match.group(2) or (YEAR_RE.search(text).group(1) if YEAR_RE.search(text) else None)
+        if year:
+            start, end = _month_range(int(year), month)
+            return {'operation_from': start, 'operation_to': end}
+        # Месяц без года — этот месяц в любом году
+        return {'operation_month': month}
+
+    years = YEAR_RE.findall(text)
+    if years:
+        return {'operation_from': f'{min(years)}-01-01', 'operation_to': f'{max(years)}-12-31'}
+    return {}
+
+def _content_words(text):
+    """Значимые слова вопроса: без служебных, месяцев, чисел и ИНН"""
+    words = []
+    for word in WORD_RE.findall(text):
+        if word in STOP_WORDS or word.isdigit() or len(word) < 3:
+            continue
+        if MONTH_RE.fullmatch(word):
+            continue
+        words.append(word)
+    return words
+
+def match_counterparties(words):
+    """Контрагенты, все слова названия которых встречаются в вопросе.
+
+    Returns:
+        (список (id, название), множество слов вопроса, ушедших на названия)
+    """
+    stems = {word: _stem(word) for word in words}
+    candidates = find_counterparty_aliases(sorted({stem for stem in stems.values() if len(stem) >= 4}))
+    matched = {}
+    used_words = set()
+    for alias, counterparty_id, name in candidates:
+        alias_words = [word for word in alias.split() if len(word) > 1]
+        covering = set()
+        for alias_word in alias_words:
+            hits = {word for word in stems if _same_word(word, alias_word)}
+            if not hits:
+                break
+            covering |= hits
+        else:
+            if alias_words:
+                matched.setdefault(counterparty_id, name)
+                used_words |= covering
+    return list(matched.items())[:5], used_words
+
+def fulltext_query(words):
+    """Запрос FTS5: основы слов с поиском по префиксу, объединённые через OR (ранжирует BM25).
+
+    Слова, которые есть в большинстве операций («работы», «договор»), не сужают
+    отбор и только раздувают итоги — они отбрасываются, если осталось что-то ещё.
+
+    Returns:
+        (запрос или None, использованные слова)
+    """
+    terms = {}
+    for word in words:
+        terms.setdefault(f'"{_stem(word)}"*', word)
+    terms = dict(list(terms.items())[:MAX_SEARCH_TERMS])
+    counts, total = count_fulltext_matches(terms)
+    found = {term: word for term, word in terms.items() if counts.get(term)}
+    selective = {term: word for term, word in found.items() if counts[term] <= total * COMMON_TERM_SHARE}
+    terms = selective or found
+    if not terms:
+        return None, []
+    return ' OR '.join(terms), list(terms.values())
+
+def retrieval_filters(question, today=None):
+    """Отборы для поиска по базе и их описание для промпта"""
+    text = question.casefold().replace('ё', 'е')
+    filters = parse_period(text, today)
+    notes = []
+    if 'operation_month' in filters:
+        notes.append(f"месяц {filters['operation_month']:02d} (любого года)")
+    elif filters:
+        notes.append(f"период {_format_date(filters['operation_from'])}–{_format_date(filters['operation_to'])}")
+
+    inn_match = INN_RE.search(text)
+    if inn_match:
+        filters['inn'] = normalize_inn(inn_match.group(1))
+        notes.append(f"ИНН {filters['inn']}")
+        text = text.replace(inn_match.group(1), ' ')
+
+    words = _content_words(normalize_counterparty_name(text))
+    counterparties, used_words = match_counterparties(words) if words else ([], set())
+    if counterparties:
+        filters['counterparty_ids'] = [counterparty_id for counterparty_id, _ in counterparties]
+        notes.append("контрагент " + ", ".join(f"«{name}»" for _, name in counterparties))
+
+    search_words = [word for word in words if word not in used_words]
+    if search_words:
+        match, search_words = fulltext_query(search_words)
+        if match:
+            filters['match'] = match
+    return filters, notes, search_words
+
+def _format_date(value):
+    if not value:
+        return "—"
+    year, month, day = value.split('-')
+    return f"{day}.{month}.{year}"
+
+def _format_amount(value):
+    return f"{value:,.2f}".replace(",", " ").replace(".", ",")
+
+def _row_line(row):
+    purpose = (row.get('purpose') or '').strip()
+    if len(purpose) > PURPOSE_PREVIEW_CHARS:
+        purpose = purpose[:PURPOSE_PREVIEW_CHARS].rstrip() + "…"
+    parts = [row.get('date') or '—', row.get('counterparty') or '—']
+    if row.get('inn'):
+        parts.append(f"ИНН {row['inn']}")
+    parts.append(row.get('amount') or '—')
+    if row.get('account'):
+        parts.append(f"счёт {row['account']}")
+    parts.append(purpose or '—')
+    line = " | ".join(parts)
+    return line + " [аномалия]" if row.get('is_anomaly') else line
+
+def _summary_lines(notes, search_words, aggregates):
+    selection = "; ".join(notes) or "вся база"
+    if search_words:
+        selection += "; со словами: " + ", ".join(search_words[:MAX_SEARCH_TERMS])
+    lines = [f"Отбор: {selection}."]
+    if not aggregates['count']:
+        lines.append("Подходящих операций в базе нет.")
+        return lines
+    lines.append(
+        f"Итого операций: {aggregates['count']}, на сумму {_format_amount(aggregates['total'])} руб., "
+        f"даты операций с {_format_date(aggregates['first_date'])} по {_format_date(aggregates['last_date'])}, "
+        f"аномалий: {aggregates['anomalies']}."
+    )
+    if len(aggregates['by_counterparty']) > 1:
+        lines.append("Крупнейшие контрагенты: " + "; ".join(
+            f"{item['name']} — {item['count']} оп. на {_format_amount(item['total'])} руб."
+            for item in aggregates['by_counterparty']
+        ))
+    return lines
+
+def build_context(question, token_budget=CHAT_CONTEXT_TOKENS, top_k=CHAT_RETRIEVAL_TOP_K, today=None):
+    """Выдержка из базы к вопросу в пределах token_budget или пустая строка, если вопрос не про данные"""
+    filters, notes, search_words = retrieval_filters(question, today)
+    structured = any(key != 'match' for key in filters)
+    if not structured and not AGGREGATE_RE.search(question.casefold()):
+        # Вопрос без отборов: контекст нужен, только если его слова нашлись в операциях
+        if 'match' not in filters:
+            return ""
+
+    aggregates = get_transaction_aggregates(**filters)
+    lines = _summary_lines(notes, search_words, aggregates)
+    used = estimate_tokens("\n".join(lines))
+    if aggregates['count']:
+        rows = search_transactions(limit=top_k, **filters)
+        header = "Операции (дата | контрагент | ИНН | сумма | счёт | назначение):"
+        row_lines = []
+        used += estimate_tokens(header)
+        for row in rows:
+            line = _row_line(row)
+            cost = estimate_tokens(line) + 1
+            if used + cost > token_budget:
+                break
+            row_lines.append(line)
+            used += cost
+        if row_lines:
+            shown = f" (показано {len(row_lines)} из {aggregates['count']})" if len(row_lines) < aggregates['count'] else ""
+            lines.append(header[:-1] + shown + ":")
+            lines.extend(row_lines)
+    return "\n".join(lines)
+
+def build_chat_prompt(question, history=""):
+    """Промпт для вопроса в чате и контекст, на котором он построен (для ключа кэша ответов).
+
+    history — предыдущие реплики разговора; идут в промпт перед вопросом и входят в контекст.
+    """
+    context = ""
+    if CHAT_RETRIEVAL_ENABLED and question.strip():
+        try:
+            context = build_context(question)
+        except Exception:
+            # Поиск по базе не должен ломать чат: отвечаем без контекста
+            logger.exception("Не удалось подобрать контекст для вопроса")
+    if context:
+        prompt = GROUNDED_PROMPT.format(context=context, question=question)
+    else:
+        prompt = BASE_PROMPT.format(question=question)
+    if history:
+        prompt = HISTORY_PROMPT.format(history=history) + prompt
+    return prompt, "\n\n".join(part for part in (history, context) if part)
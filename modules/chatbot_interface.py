@@ -1,32 +1,96 @@
-from flask import Flask, request, render_template_string, session, jsonify
+from flask import Flask, Response, request, render_template, session, jsonify, g
+from jinja2 import DictLoader
 from werkzeug.utils import secure_filename
-import google.generativeai as genai
-from config import GEMINI_API_KEY, UPLOAD_DIR
+from config import UPLOAD_DIR, ADMIN_TOKEN, MAX_UPLOAD_BYTES, SECRET_KEY
 from pathlib import Path
 import os
-from modules.document_parser import extract_invoice_data
+from modules.document_parser import extract_invoice_data, iter_invoice_transactions, DocumentPayload
+from modules.database import (
+    save_file_and_transactions, get_all_files, get_file_with_transactions, get_files_page, get_file,
+    get_transactions_page, iter_transactions, TRANSACTION_COLUMNS,
+    record_ingestion, get_counterparties_page, get_anomaly_counts, compress_extraction
+)
+from modules.reprocessing import reprocess_job
+from modules.admission import upload_admission, AdmissionRejected
+from modules.model_scheduler import model_scheduler, current_priority, current_session
+from modules.anomaly_codes import ANOMALY_CODES, mask_to_labels
+from modules.pipeline import enrich_transactions, document_question_prompt, is_rejected
 from modules.accounting_logic import classify_transaction
-from modules.database import save_file_and_transactions, get_all_files, get_file_with_transactions
-from modules.anomaly_detector import detect_anomalies_in_transactions
 from modules.stats_tracker import stats_tracker
-import base64
+from modules.stats_publisher import stats_publisher
+from modules.answer_cache import answer_cache
+from modules.chat_retrieval import build_chat_prompt
+from modules.conversation_memory import conversation_memory
+from modules.model_client import generate_content, ModelUnavailableError
+from modules.usage_accounting import usage_tracker, current_tenant, resolve_tenant, ROLLUP_GROUPS
+from modules.single_flight import extraction_flight
+from modules.upload_storage import save_upload_stream, UploadTooLargeError
+from modules.http_cache import build_static_fingerprints, apply_http_caching
+from modules.exporters import EXPORTERS, EXPORT_MIMETYPES, ExportUnavailableError
+from modules.tracing import span, start_trace, load_trace, find_traces, waterfall_rows
 import json
 import secrets
 
 app = Flask(__name__)
-app.secret_key = secrets.token_hex(32)
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-2.5-flash")
+app.secret_key = SECRET_KEY or secrets.token_hex(32)
+# Запас на поля формы сверх самого файла
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + 1024 * 1024
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# Класс приоритета вызовов модели по маршруту; остальные маршруты — upload
+ROUTE_PRIORITIES = {'/chat': 'interactive'}
+# Трассируемые маршруты и имена их корневых спанов (/api/upload/stream начинает трейс в генераторе ответа)
+TRACED_ROUTES = {'/upload': 'POST /upload', '/chat': 'POST /chat'}
+
 @app.before_request
 def track_user_activity():
-    """Отслеживание активности пользователей"""
+    """Отслеживание активности пользователей.
+    
+    API и статика активность не отмечают: открытые вкладки остаются онлайн
+    за счёт heartbeat-сообщений потока /api/stats/stream.
+    """
     if 'session_id' not in session:
         session['session_id'] = secrets.token_hex(16)
+    current_tenant.set(resolve_tenant(request.headers.get("X-Api-Token", "")))
+    current_session.set(session['session_id'])
+    current_priority.set(ROUTE_PRIORITIES.get(request.path, 'upload'))
+    if request.path.startswith(('/api/', app.static_url_path + '/')):
+        return
     stats_tracker.update_user_activity(session['session_id'])
 
+def is_admin_request():
+    """Проверка токена администратора из заголовка X-Admin-Token"""
+    if not ADMIN_TOKEN:
+        return False
+    token = request.headers.get("X-Admin-Token", "")
+    return secrets.compare_digest(token, ADMIN_TOKEN)
+
+def trace_forced():
+    """Администратор может трассировать отдельный запрос заголовком X-Trace: 1"""
+    return request.headers.get("X-Trace") == "1" and is_admin_request()
+
+@app.before_request
+def start_request_trace():
+    """Корневой спан запроса к трассируемому маршруту (если запрос попал в выборку)"""
+    name = TRACED_ROUTES.get(request.path)
+    if name is None:
+        return
+    g.trace_span = start_trace(name, force=trace_forced(), session=session['session_id'][:8])
+    g.trace_span.__enter__()
+
+@app.after_request
+def record_trace_status(response):
+    if 'trace_span' in g:
+        g.trace_span.set(status=response.status_code)
+    return response
+
+@app.teardown_request
+def end_request_trace(error=None):
+    root = g.pop('trace_span', None)
+    if root is not None:
+        root.__exit__(type(error) if error else None, error, None)
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
@@ -34,182 +98,7 @@ HTML_TEMPLATE = """
     <meta charset="UTF-8">
     <title>ИИ-бухгалтер</title>
     <script src="https://cdn.jsdelivr.net/npm/marked/marked.min.js"></script>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-            padding: 20px;
-        }
-        .stats-bar {
-            background: rgba(255, 255, 255, 0.95);
-            padding: 15px 30px;
-            border-radius: 15px;
-            margin-bottom: 20px;
-            box-shadow: 0 8px 32px rgba(0, 0, 0, 0.1);
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            gap: 40px;
-            backdrop-filter: blur(10px);
-        }
-        .stat-item {
-            display: flex;
-            align-items: center;
-            gap: 10px;
-            font-size: 16px;
-            color: #333;
-        }
-        .stat-icon {
-            font-size: 24px;
-        }
-        .stat-value {
-            font-weight: bold;
-            color: #7c3aed;
-            font-size: 20px;
-        }
-        .container {
-            max-width: 900px;
-            margin: 0 auto;
-            background: rgba(255, 255, 255, 0.98);
-            padding: 40px;
-            border-radius: 20px;
-            box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
-        }
-        h2 {
-            color: #5b21b6;
-            font-size: 36px;
-            margin-bottom: 30px;
-            text-align: center;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            background-clip: text;
-        }
-        .btn-primary {
-            display: inline-block;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            padding: 14px 30px;
-            border-radius: 10px;
-            text-decoration: none;
-            font-weight: 600;
-            transition: all 0.3s ease;
-            box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-            border: none;
-            cursor: pointer;
-            font-size: 16px;
-        }
-        .btn-primary:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6);
-        }
-        .section {
-            margin: 25px 0;
-            padding: 25px;
-            border-radius: 15px;
-            background: linear-gradient(135deg, #f5f7fa 0%, #f3e7ff 100%);
-            border: 2px solid rgba(124, 58, 237, 0.1);
-        }
-        .section h3 {
-            color: #5b21b6;
-            margin-bottom: 15px;
-            font-size: 20px;
-        }
-        input[type="text"], input[type="file"] {
-            width: 100%;
-            padding: 12px 15px;
-            margin: 8px 0;
-            border: 2px solid #e0d4f7;
-            border-radius: 10px;
-            font-size: 15px;
-            transition: all 0.3s ease;
-            background: white;
-        }
-        input[type="text"]:focus {
-            outline: none;
-            border-color: #7c3aed;
-            box-shadow: 0 0 0 3px rgba(124, 58, 237, 0.1);
-        }
-        input[type="submit"] {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            padding: 14px 30px;
-            border: none;
-            border-radius: 10px;
-            cursor: pointer;
-            font-size: 16px;
-            font-weight: 600;
-            margin-top: 10px;
-            transition: all 0.3s ease;
-            box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-        }
-        input[type="submit"]:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6);
-        }
-        input[type="submit"]:disabled {
-            background: #ccc;
-            cursor: not-allowed;
-            transform: none;
-        }
-        label {
-            display: block;
-            color: #5b21b6;
-            font-weight: 600;
-            margin-bottom: 5px;
-        }
-        .loading-overlay {
-            display: none;
-            position: fixed;
-            top: 0;
-            left: 0;
-            width: 100%;
-            height: 100%;
-            background: rgba(91, 33, 182, 0.7);
-            backdrop-filter: blur(5px);
-            z-index: 9999;
-            justify-content: center;
-            align-items: center;
-        }
-        .loading-overlay.show {
-            display: flex;
-        }
-        .loading-content {
-            background: white;
-            padding: 50px;
-            border-radius: 20px;
-            text-align: center;
-            box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
-        }
-        .spinner {
-            border: 5px solid #f3f3f3;
-            border-top: 5px solid #7c3aed;
-            border-radius: 50%;
-            width: 60px;
-            height: 60px;
-            animation: spin 1s linear infinite;
-            margin: 0 auto 20px;
-        }
-        @keyframes spin {
-            0% { transform: rotate(0deg); }
-            100% { transform: rotate(360deg); }
-        }
-        .loading-text {
-            color: #5b21b6;
-            font-size: 20px;
-            font-weight: bold;
-        }
-        .btn-container {
-            text-align: center;
-            margin-bottom: 30px;
-        }
-    </style>
+    <link rel="stylesheet" href="{{ static_url('css/index.css') }}">
 </head>
 <body>
     <div class="stats-bar" id="statsBar">
@@ -259,39 +148,7 @@ HTML_TEMPLATE = """
         </div>
     </div>
 
-    <script>
-        function updateStats() {
-            fetch('/api/stats')
-                .then(response => response.json())
-                .then(data => {
-                    document.getElementById('onlineUsers').textContent = data.online_users;
-                    document.getElementById('processingFiles').textContent = data.processing_files;
-                })
-                .catch(error => console.error('Ошибка загрузки статистики:', error));
-        }
-
-        updateStats();
-        setInterval(updateStats, 5000);
-
-        function showLoading(text) {
-            const overlay = document.getElementById('loadingOverlay');
-            const loadingText = overlay.querySelector('.loading-text');
-            loadingText.textContent = text;
-            overlay.classList.add('show');
-        }
-
-        document.getElementById('uploadForm').addEventListener('submit', function(e) {
-            const submitBtn = document.getElementById('uploadSubmit');
-            submitBtn.disabled = true;
-            showLoading('Обработка документа...');
-        });
-
-        document.getElementById('chatForm').addEventListener('submit', function(e) {
-            const submitBtn = document.getElementById('chatSubmit');
-            submitBtn.disabled = true;
-            showLoading('Получение ответа от ИИ...');
-        });
-    </script>
+    <script src="{{ static_url('js/index.js') }}"></script>
 </body>
 </html>
 """
@@ -302,97 +159,7 @@ HISTORY_TEMPLATE = """
 <head>
     <meta charset="UTF-8">
     <title>История файлов</title>
-    <style>
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-            padding: 20px;
-        }
-        .container {
-            max-width: 1100px;
-            margin: 0 auto;
-            background: rgba(255, 255, 255, 0.98);
-            padding: 40px;
-            border-radius: 20px;
-            box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
-        }
-        h2 {
-            color: #5b21b6;
-            font-size: 32px;
-            margin-bottom: 25px;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            background-clip: text;
-        }
-        table {
-            width: 100%;
-            border-collapse: collapse;
-            margin-top: 25px;
-            background: white;
-            border-radius: 10px;
-            overflow: hidden;
-            box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
-        }
-        th, td {
-            padding: 15px;
-            text-align: left;
-        }
-        th {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            font-weight: 600;
-        }
-        tr {
-            border-bottom: 1px solid #e0d4f7;
-            transition: all 0.2s ease;
-        }
-        tr:hover {
-            background: linear-gradient(135deg, #faf5ff 0%, #f5f3ff 100%);
-        }
-        td a {
-            color: #7c3aed;
-            text-decoration: none;
-            font-weight: 600;
-            transition: all 0.2s ease;
-        }
-        td a:hover {
-            color: #5b21b6;
-        }
-        .btn {
-            display: inline-block;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            padding: 12px 25px;
-            border-radius: 10px;
-            text-decoration: none;
-            margin-bottom: 25px;
-            font-weight: 600;
-            transition: all 0.3s ease;
-            box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-        }
-        .btn:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6);
-        }
-        .empty-state {
-            text-align: center;
-            padding: 60px 40px;
-            background: linear-gradient(135deg, #f5f7fa 0%, #f3e7ff 100%);
-            border-radius: 15px;
-            color: #5b21b6;
-            margin-top: 20px;
-        }
-        .empty-state p:first-child {
-            font-size: 48px;
-            margin-bottom: 15px;
-        }
-        .empty-state p:last-child {
-            font-size: 18px;
-            color: #7c3aed;
-        }
-    </style>
+    <link rel="stylesheet" href="{{ static_url('css/history.css') }}">
 </head>
 <body>
     <div class="container">
@@ -434,156 +201,7 @@ FILE_DETAIL_TEMPLATE = """
     <meta charset="UTF-8">
     <title>{{ file.filename }}</title>
     <script src="https://cdn.jsdelivr.net/npm/marked/marked.min.js"></script>
-    <style>
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-            padding: 20px;
-        }
-        .container {
-            max-width: 1100px;
-            margin: 0 auto;
-            background: rgba(255, 255, 255, 0.98);
-            padding: 40px;
-            border-radius: 20px;
-            box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
-        }
-        h2 {
-            color: #5b21b6;
-            font-size: 32px;
-            margin-bottom: 25px;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            background-clip: text;
-        }
-        .transaction {
-            background: white;
-            border-left: 5px solid #7c3aed;
-            padding: 20px;
-            margin: 15px 0;
-            border-radius: 15px;
-            box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
-            transition: all 0.2s ease;
-        }
-        .transaction:hover {
-            box-shadow: 0 4px 12px rgba(0, 0, 0, 0.15);
-        }
-        .transaction.anomaly {
-            border-left: 5px solid #ff9800;
-            background: linear-gradient(135deg, #fff8e1 0%, #ffe0b2 10%, white 50%);
-        }
-        .transaction h3 {
-            margin-top: 0;
-            color: #5b21b6;
-            font-size: 20px;
-        }
-        .transaction.anomaly h3 {
-            color: #ff9800;
-        }
-        .anomaly-badge {
-            background: linear-gradient(135deg, #ff9800 0%, #f57c00 100%);
-            color: white;
-            padding: 5px 12px;
-            border-radius: 8px;
-            font-size: 12px;
-            margin-left: 10px;
-            box-shadow: 0 2px 4px rgba(255, 152, 0, 0.3);
-        }
-        .anomaly-reasons {
-            background: #fff3e0;
-            border-left: 4px solid #ff9800;
-            padding: 15px;
-            margin: 15px 0;
-            border-radius: 10px;
-        }
-        .anomaly-reasons ul {
-            margin: 5px 0;
-            padding-left: 20px;
-        }
-        .data-row {
-            display: flex;
-            padding: 12px 0;
-            border-bottom: 1px solid #e0d4f7;
-        }
-        .data-row:last-child {
-            border-bottom: none;
-        }
-        .data-label {
-            font-weight: 600;
-            min-width: 220px;
-            color: #5b21b6;
-        }
-        .data-value {
-            color: #333;
-            flex: 1;
-        }
-        .btn {
-            display: inline-block;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            padding: 12px 25px;
-            border-radius: 10px;
-            text-decoration: none;
-            margin-bottom: 25px;
-            margin-right: 10px;
-            font-weight: 600;
-            transition: all 0.3s ease;
-            box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-        }
-        .btn:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6);
-        }
-        .meta-info {
-            background: linear-gradient(135deg, #f0fdf4 0%, #f3e7ff 100%);
-            padding: 20px;
-            border-radius: 15px;
-            margin-bottom: 25px;
-            border: 2px solid rgba(124, 58, 237, 0.2);
-        }
-        .qa-section {
-            background: linear-gradient(135deg, #e0f2fe 0%, #f3e7ff 100%);
-            padding: 20px;
-            border-radius: 15px;
-            margin-bottom: 25px;
-            border-left: 5px solid #7c3aed;
-            box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
-        }
-        .qa-section h3 {
-            margin-top: 0;
-            color: #5b21b6;
-        }
-        .qa-section p {
-            margin: 12px 0;
-            line-height: 1.6;
-        }
-        h3 {
-            color: #5b21b6;
-            margin-top: 30px;
-            margin-bottom: 15px;
-            font-size: 24px;
-        }
-        #ai-answer {
-            line-height: 1.8;
-            color: #333;
-        }
-        #ai-answer code {
-            background: #f3e7ff;
-            padding: 2px 6px;
-            border-radius: 4px;
-            color: #7c3aed;
-            font-family: 'Courier New', monospace;
-        }
-        #ai-answer pre {
-            background: #1f2937;
-            color: #a78bfa;
-            padding: 15px;
-            border-radius: 10px;
-            overflow-x: auto;
-        }
-    </style>
+    <link rel="stylesheet" href="{{ static_url('css/file_detail.css') }}">
 </head>
 <body>
     <div class="container">
@@ -600,11 +218,10 @@ FILE_DETAIL_TEMPLATE = """
                 <div class="data-label">Всего транзакций:</div>
                 <div class="data-value">{{ file.transactions|length }}</div>
             </div>
-            {% set anomaly_count = file.transactions|selectattr('is_anomaly', 'equalto', 1)|list|length %}
-            {% if anomaly_count > 0 %}
+            {% if file.anomaly_counts.total > 0 %}
             <div class="data-row">
                 <div class="data-label">Обнаружено аномалий:</div>
-                <div class="data-value" style="color: #ff9800; font-weight: bold;">⚠️ {{ anomaly_count }}</div>
+                <div class="data-value" style="color: #ff9800; font-weight: bold;">⚠️ {{ file.anomaly_counts.total }}</div>
             </div>
             {% endif %}
         </div>
@@ -632,11 +249,11 @@ FILE_DETAIL_TEMPLATE = """
                 {% endif %}
             </h3>
             
-            {% if transaction.is_anomaly == 1 and transaction.anomaly_reasons %}
+            {% if transaction.is_anomaly == 1 and transaction.anomaly_mask %}
             <div class="anomaly-reasons">
                 <b>Обнаруженные проблемы:</b>
                 <ul style="margin: 5px 0; padding-left: 20px;">
-                {% for reason in transaction.anomaly_reasons %}
+                {% for reason in transaction.anomaly_mask|anomaly_labels %}
                     <li>{{ reason }}</li>
                 {% endfor %}
                 </ul>
@@ -681,116 +298,7 @@ RESULT_TEMPLATE = """
     <meta charset="UTF-8">
     <title>Результат обработки</title>
     <script src="https://cdn.jsdelivr.net/npm/marked/marked.min.js"></script>
-    <style>
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-            padding: 20px;
-        }
-        .container {
-            max-width: 1000px;
-            margin: 0 auto;
-            background: rgba(255, 255, 255, 0.98);
-            padding: 40px;
-            border-radius: 20px;
-            box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
-        }
-        h2 {
-            color: #5b21b6;
-            font-size: 32px;
-            margin-bottom: 25px;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            background-clip: text;
-        }
-        .result {
-            background: linear-gradient(135deg, #f0fdf4 0%, #f3e7ff 100%);
-            padding: 20px;
-            border-radius: 15px;
-            margin-top: 20px;
-            border: 2px solid rgba(124, 58, 237, 0.2);
-        }
-        .error {
-            background: linear-gradient(135deg, #fee2e2 0%, #fce7f3 100%);
-            color: #991b1b;
-            padding: 20px;
-            border-radius: 15px;
-            margin-top: 20px;
-            border: 2px solid rgba(220, 38, 38, 0.3);
-        }
-        .transaction {
-            background: white;
-            border-left: 5px solid #7c3aed;
-            padding: 20px;
-            margin: 15px 0;
-            border-radius: 10px;
-            box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
-        }
-        .transaction h3 {
-            margin-top: 0;
-            color: #5b21b6;
-        }
-        .data-item {
-            margin: 10px 0;
-            padding: 12px;
-            background: linear-gradient(135deg, #faf5ff 0%, #f5f3ff 100%);
-            border-left: 3px solid #a78bfa;
-            border-radius: 5px;
-        }
-        pre {
-            background: #1f2937;
-            color: #a78bfa;
-            padding: 15px;
-            border-radius: 10px;
-            overflow-x: auto;
-            white-space: pre-wrap;
-        }
-        a {
-            display: inline-block;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            padding: 12px 25px;
-            border-radius: 10px;
-            text-decoration: none;
-            font-weight: 600;
-            margin-top: 20px;
-            margin-right: 10px;
-            transition: all 0.3s ease;
-            box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-        }
-        a:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6);
-        }
-        #ai-response {
-            line-height: 1.8;
-        }
-        #ai-response h1, #ai-response h2, #ai-response h3 {
-            color: #5b21b6;
-            margin-top: 20px;
-            margin-bottom: 10px;
-        }
-        #ai-response code {
-            background: #f3e7ff;
-            padding: 2px 6px;
-            border-radius: 4px;
-            color: #7c3aed;
-            font-family: 'Courier New', monospace;
-        }
-        #ai-response pre {
-            background: #1f2937;
-            color: #a78bfa;
-            padding: 15px;
-            border-radius: 10px;
-            overflow-x: auto;
-        }
-        #ai-response ul, #ai-response ol {
-            margin-left: 20px;
-            line-height: 1.8;
-        }
-    </style>
+    <link rel="stylesheet" href="{{ static_url('css/result.css') }}">
 </head>
 <body>
     <div class="container">
@@ -805,110 +313,442 @@ RESULT_TEMPLATE = """
 </html>
 """
 
+TRACES_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>Трейсы</title>
+    <link rel="stylesheet" href="{{ static_url('css/traces.css') }}">
+</head>
+<body>
+    <div class="container">
+        <h2>{{ title }}</h2>
+        {% for trace_id, rows in traces %}
+        <div class="trace">
+            <div class="trace-meta">
+                trace <a href="/admin/traces/{{ trace_id }}">{{ trace_id }}</a>,
+                спанов: {{ rows|length }}{% if rows %}, pid {{ rows[0].pid }}{% endif %}
+            </div>
+            <table class="waterfall">
+                {% for row in rows %}
+                <tr>
+                    <td class="span-name" style="padding-left: {{ 6 + row.depth * 16 }}px;">{{ row.name }}</td>
+                    <td class="span-duration">{{ '%.1f'|format(row.duration_ms) }} мс</td>
+                    <td class="span-timeline">
+                        <div class="span-bar{% if row.attributes.error %} error{% endif %}"
+                             style="left: {{ row.offset }}%; width: {{ row.width }}%;"></div>
+                        {% if row.attributes %}
+                        <div class="span-attributes">
+                            {% for key, value in row.attributes.items() %}{{ key }}={{ value }}{% if not loop.last %}, {% endif %}{% endfor %}
+                            · {{ row.thread }}
+                        </div>
+                        {% endif %}
+                    </td>
+                </tr>
+                {% endfor %}
+            </table>
+        </div>
+        {% else %}
+        <p>Трейсов не найдено. Трассируется доля запросов TRACE_SAMPLE_RATE и запросы администратора с заголовком X-Trace: 1.</p>
+        {% endfor %}
+        <a href='/'>← На главную</a>
+        <a href='/history'>📋 История</a>
+    </div>
+</body>
+</html>
+"""
+
+# Шаблоны компилируются один раз при первом использовании и кэшируются Jinja
+app.jinja_loader = DictLoader({
+    'index.html': HTML_TEMPLATE,
+    'history.html': HISTORY_TEMPLATE,
+    'file_detail.html': FILE_DETAIL_TEMPLATE,
+    'result.html': RESULT_TEMPLATE,
+    'traces.html': TRACES_TEMPLATE,
+})
+app.jinja_env.auto_reload = False
+
+STATIC_FINGERPRINTS = build_static_fingerprints(app.static_folder)
+
+@app.template_filter('anomaly_labels')
+def anomaly_labels_filter(mask):
+    """Подписи причин аномалии по битовой маске"""
+    return mask_to_labels(mask)
+
+@app.template_global()
+def static_url(filename):
+    """URL статического файла с отпечатком содержимого для долгого кэширования"""
+    url = f"{app.static_url_path}/{filename}"
+    fingerprint = STATIC_FINGERPRINTS.get(filename)
+    return f"{url}?v={fingerprint}" if fingerprint else url
+
+@app.after_request
+def add_http_caching(response):
+    """ETag, gzip и заголовки кэширования для всех ответов"""
+    return apply_http_caching(request, response, app.static_url_path)
+
 @app.route("/api/stats")
 def get_stats():
     """API endpoint для получения статистики"""
-    return jsonify(stats_tracker.get_stats())
+    stats = dict(stats_tracker.get_stats())
+    stats['admission'] = upload_admission.get_stats()
+    stats['model_scheduler'] = model_scheduler.get_stats()
+    stats['conversations'] = conversation_memory.get_stats()
+    return jsonify(stats)
+
+@app.route("/api/stats/stream")
+def stats_stream():
+    """SSE-поток статистики: события только при изменениях, между ними heartbeat"""
+    session_id = session['session_id']
+    stream = stats_publisher.subscribe(lambda: stats_tracker.update_user_activity(session_id))
+    return Response(stream, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route("/api/cache/stats")
+def get_cache_stats():
+    """Метрики кэша ответов /chat"""
+    return jsonify(answer_cache.get_stats())
+
+@app.route("/admin/cache/purge", methods=["POST"])
+def purge_answer_cache():
+    """Очистка кэша ответов (только для администратора)"""
+    if not is_admin_request():
+        return jsonify({'error': 'forbidden'}), 403
+    removed = answer_cache.purge()
+    return jsonify({'purged': removed})
+
+@app.route("/admin/reprocess", methods=["POST"])
+def start_reprocess():
+    """Фоновая переобработка сохранённых ответов модели (file_id — повторяемый, dry_run=1)"""
+    if not is_admin_request():
+        return jsonify({'error': 'forbidden'}), 403
+    started = reprocess_job.start(
+        file_ids=request.args.getlist("file_id", type=int) or None,
+        dry_run=request.args.get("dry_run") == "1"
+    )
+    if not started:
+        return jsonify({'error': 'reprocessing already running', 'status': reprocess_job.get_status()}), 409
+    return jsonify(reprocess_job.get_status()), 202
+
+@app.route("/admin/reprocess")
+def reprocess_status():
+    """Состояние последней переобработки"""
+    if not is_admin_request():
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify(reprocess_job.get_status())
+
+@app.route("/api/usage")
+def api_usage():
+    """Сводка расхода модели (group_by=day|file_type|operation|tenant|model, days, tenant)"""
+    if not is_admin_request():
+        return jsonify({'error': 'forbidden'}), 403
+    group_by = request.args.get("group_by", "day")
+    if group_by not in ROLLUP_GROUPS:
+        return jsonify({'error': 'unsupported group_by', 'allowed': list(ROLLUP_GROUPS)}), 400
+    days = max(1, request.args.get("days", 30, type=int))
+    tenant = request.args.get("tenant")
+    items = usage_tracker.get_rollup(group_by, days=days, tenant=tenant)
+    return jsonify({'group_by': group_by, 'days': days, 'items': items})
+
+@app.route("/api/usage/top")
+def api_usage_top():
+    """Самые дорогие или медленные вызовы модели (order_by=cost|latency)"""
+    if not is_admin_request():
+        return jsonify({'error': 'forbidden'}), 403
+    items = usage_tracker.get_top_calls(
+        limit=parse_limit_param("limit", 20),
+        days=max(1, request.args.get("days", 30, type=int)),
+        order_by=request.args.get("order_by", "cost")
+    )
+    return jsonify({'items': items})
+
+@app.route("/admin/traces/file/<int:file_id>")
+def file_traces(file_id):
+    """Трейсы обработки файла в виде диаграммы (?format=json — спаны в JSON)"""
+    if not is_admin_request():
+        return jsonify({'error': 'forbidden'}), 403
+    traces = find_traces(file_id)
+    if request.args.get('format') == 'json':
+        return jsonify({'file_id': file_id, 'traces': [{'trace_id': trace_id, 'spans': spans} for trace_id, spans in traces]})
+    return render_template('traces.html', title=f"Трейсы файла #{file_id}",
+                           traces=[(trace_id, waterfall_rows(spans)) for trace_id, spans in traces])
+
+@app.route("/admin/traces/<trace_id>")
+def trace_detail(trace_id):
+    """Один трейс по идентификатору"""
+    if not is_admin_request():
+        return jsonify({'error': 'forbidden'}), 403
+    spans = load_trace(trace_id)
+    if request.args.get('format') == 'json':
+        return jsonify({'trace_id': trace_id, 'spans': spans})
+    traces = [(trace_id, waterfall_rows(spans))] if spans else []
+    return render_template('traces.html', title=f"Трейс {trace_id}", traces=traces)
+
+@app.errorhandler(413)
+def request_too_large(e):
+    content = f"<p>Файл превышает допустимый размер {MAX_UPLOAD_BYTES // (1024 * 1024)} МБ</p>"
+    return render_template('result.html', title="Ошибка", content=content, result_class="error"), 413
+
+API_MAX_PAGE_SIZE = 500
+
+def parse_fields_param(allowed):
+    """Разбор параметра fields=a,b,c. Возвращает список столбцов или None при неизвестном поле"""
+    raw = request.args.get("fields", "")
+    if not raw:
+        return list(allowed)
+    fields = [f.strip() for f in raw.split(",") if f.strip()]
+    if any(f not in allowed for f in fields):
+        return None
+    return fields
+
+def parse_limit_param(name, default):
+    return max(1, min(request.args.get(name, default, type=int), API_MAX_PAGE_SIZE))
+
+def transaction_filters_from_args():
+    return {
+        'date_from': request.args.get("date_from"),
+        'date_to': request.args.get("date_to"),
+        'anomalies_only': request.args.get("anomalies_only") == "1",
+        'counterparty_id': request.args.get("counterparty_id", type=int),
+        'anomaly_code': request.args.get("anomaly_code") or None,
+    }
+
+def unknown_anomaly_code(filters):
+    """Ответ 400, если в фильтрах неизвестный код причины аномалии"""
+    if filters['anomaly_code'] and filters['anomaly_code'] not in ANOMALY_CODES:
+        return jsonify({'error': 'unknown anomaly_code', 'allowed': list(ANOMALY_CODES)}), 400
+    return None
+
+def decode_anomaly_column(chunks, columns):
+    """Заменяет маску в столбце anomaly_reasons подписями причин при выгрузке"""
+    index = columns.index('anomaly_reasons')
+    for rows in chunks:
+        decoded = []
+        for row in rows:
+            row = list(row)
+            row[index] = "; ".join(mask_to_labels(row[index]))
+            decoded.append(row)
+        yield decoded
+
+@app.route("/api/files")
+def api_files():
+    """Список файлов с постраничной навигацией (page, per_page)"""
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = parse_limit_param("per_page", 50)
+    files, total = get_files_page(limit=per_page, offset=(page - 1) * per_page)
+    return jsonify({'items': files, 'page': page, 'per_page': per_page, 'total': total})
+
+@app.route("/api/files/<int:file_id>")
+def api_file(file_id):
+    """Метаданные одного файла"""
+    file_data = get_file(file_id)
+    if not file_data:
+        return jsonify({'error': 'not found'}), 404
+    return jsonify(file_data)
+
+@app.route("/api/anomalies/summary")
+def api_anomalies_summary():
+    """Число аномалий по причинам (file_id, date_from, date_to, counterparty_id)"""
+    filters = transaction_filters_from_args()
+    filters.pop('anomaly_code')
+    counts = get_anomaly_counts(file_id=request.args.get("file_id", type=int), **filters)
+    return jsonify({
+        'total': counts['total'],
+        'by_reason': [
+            {'code': code, 'label': label, 'count': counts[code]}
+            for code, (_, label) in ANOMALY_CODES.items()
+        ],
+    })
+
+@app.route("/api/counterparties")
+def api_counterparties():
+    """Справочник контрагентов с постраничной навигацией и поиском по ИНН или названию (q)"""
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = parse_limit_param("per_page", 50)
+    items, total = get_counterparties_page(
+        limit=per_page, offset=(page - 1) * per_page, query=request.args.get("q", "").strip() or None
+    )
+    return jsonify({'items': items, 'page': page, 'per_page': per_page, 'total': total})
+
+@app.route("/api/transactions")
+@app.route("/api/files/<int:file_id>/transactions")
+def api_transactions(file_id=None):
+    """Транзакции с keyset-пагинацией (after_id, limit) и выбором полей (fields)"""
+    columns = parse_fields_param(TRANSACTION_COLUMNS)
+    if columns is None:
+        return jsonify({'error': 'unknown field', 'allowed': TRANSACTION_COLUMNS}), 400
+    # id нужен для курсора следующей страницы
+    query_columns = columns if 'id' in columns else ['id'] + columns
+    limit = parse_limit_param("limit", 100)
+    filters = transaction_filters_from_args()
+    error = unknown_anomaly_code(filters)
+    if error:
+        return error
+    items = get_transactions_page(
+        query_columns, after_id=request.args.get("after_id", 0, type=int), limit=limit,
+        file_id=file_id, **filters
+    )
+    next_after_id = items[-1]['id'] if len(items) == limit else None
+    for item in items:
+        if 'anomaly_reasons' in item:
+            item['anomaly_reasons'] = mask_to_labels(item['anomaly_reasons'])
+        if 'id' not in columns:
+            del item['id']
+    return jsonify({'items': items, 'next_after_id': next_after_id})
+
+@app.route("/api/export/transactions.<fmt>")
+def export_transactions(fmt):
+    """Выгрузка транзакций за период (date_from, date_to): CSV потоком, XLSX и Parquet — собранным файлом"""
+    if fmt not in EXPORTERS:
+        return jsonify({'error': 'unsupported format', 'allowed': list(EXPORTERS)}), 400
+    columns = parse_fields_param(TRANSACTION_COLUMNS)
+    if columns is None:
+        return jsonify({'error': 'unknown field', 'allowed': TRANSACTION_COLUMNS}), 400
+    file_id = request.args.get("file_id", type=int)
+    filters = transaction_filters_from_args()
+    error = unknown_anomaly_code(filters)
+    if error:
+        return error
+    chunks = iter_transactions(columns, file_id=file_id, **filters)
+    if 'anomaly_reasons' in columns:
+        chunks = decode_anomaly_column(chunks, columns)
+    try:
+        body = EXPORTERS[fmt](chunks, columns)
+    except ExportUnavailableError as e:
+        chunks.close()
+        return jsonify({'error': str(e)}), 501
+    return Response(
+        body,
+        mimetype=EXPORT_MIMETYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename=transactions.{fmt}'}
+    )
 
 @app.route("/")
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    return render_template('index.html')
 
 @app.route("/history")
 def history():
     files = get_all_files()
-    return render_template_string(HISTORY_TEMPLATE, files=files)
+    return render_template('history.html', files=files)
 
 @app.route("/file/<int:file_id>")
 def file_detail(file_id):
     file_data = get_file_with_transactions(file_id)
     if not file_data:
         content = "<p>Файл не найден</p>"
-        return render_template_string(RESULT_TEMPLATE, title="Ошибка", content=content, result_class="error")
-    return render_template_string(FILE_DETAIL_TEMPLATE, file=file_data)
+        return render_template('result.html', title="Ошибка", content=content, result_class="error")
+    return render_template('file_detail.html', file=file_data)
 
 @app.route("/chat", methods=["POST"])
 def chat():
     user_input = request.form.get("message", "")
     try:
-        response = model.generate_content(f"Ты опытный бухгалтер. Ответь на запрос: {user_input}")
-        escaped_text = json.dumps(response.text)
+        session_id = session['session_id']
+        with span("retrieval"):
+            prompt, context = build_chat_prompt(user_input, conversation_memory.history(session_id))
+        answer = answer_cache.get(user_input, context)
+        if answer is None:
+            response = generate_content(prompt, usage={"operation": "chat"})
+            answer = response.text
+            answer_cache.set(user_input, answer, context)
+        else:
+            stats_tracker.increment('chat_cache_hits')
+        conversation_memory.append(session_id, user_input, answer)
+        stats_tracker.increment('chat_answered')
+        escaped_text = json.dumps(answer)
         content = f"<div id='ai-response'></div><script>const aiText = {escaped_text}; document.getElementById('ai-response').innerHTML = marked.parse(aiText);</script>"
-        return render_template_string(RESULT_TEMPLATE, title="💬 Ответ ИИ-бухгалтера", content=content, result_class="result")
+        return render_template('result.html', title="💬 Ответ ИИ-бухгалтера", content=content, result_class="result")
+    except ModelUnavailableError as e:
+        content = f"<p>{str(e)}</p>"
+        return render_template('result.html', title="Ошибка", content=content, result_class="error"), 503
     except Exception as e:
         content = f"<p>Ошибка при обработке запроса: {str(e)}</p>"
-        return render_template_string(RESULT_TEMPLATE, title="Ошибка", content=content, result_class="error")
+        return render_template('result.html', title="Ошибка", content=content, result_class="error")
+
+def admission_rejected_response(error, html=False):
+    """Немедленный отказ перегруженному серверу: 429 или 503 с Retry-After"""
+    headers = {'Retry-After': str(error.retry_after)}
+    if html:
+        content = f"<p>{error.reason}. Повторите через {error.retry_after} с.</p>"
+        return render_template('result.html', title="Сервер занят", content=content, result_class="error"), error.status, headers
+    return jsonify(error.as_dict()), error.status, headers
 
 @app.route("/upload", methods=["POST"])
 def upload():
+    # Допуск до чтения тела запроса: отказ не тратит ни памяти, ни диска
+    try:
+        with span("admission"):
+            admission = upload_admission.acquire(session['session_id'])
+    except AdmissionRejected as e:
+        return admission_rejected_response(e, html=True)
+    with admission:
+        return process_upload()
+
+def process_upload():
     if 'file' not in request.files:
         content = "<p>Файл не выбран</p>"
-        return render_template_string(RESULT_TEMPLATE, title="Ошибка", content=content, result_class="error")
+        return render_template('result.html', title="Ошибка", content=content, result_class="error")
     
     file = request.files['file']
     if file.filename == '':
         content = "<p>Файл не выбран</p>"
-        return render_template_string(RESULT_TEMPLATE, title="Ошибка", content=content, result_class="error")
+        return render_template('result.html', title="Ошибка", content=content, result_class="error")
     
     try:
         safe_filename = secure_filename(file.filename)
         if not safe_filename:
             content = "<p>Недопустимое имя файла</p>"
-            return render_template_string(RESULT_TEMPLATE, title="Ошибка", content=content, result_class="error")
+            return render_template('result.html', title="Ошибка", content=content, result_class="error")
         
-        stats_tracker.start_processing(safe_filename)
+        job_id = stats_tracker.start_processing(safe_filename)
+        stats_tracker.increment('uploads_received')
         
-        file_path = Path(UPLOAD_DIR) / safe_filename
-        file.save(str(file_path))
+        with span("file.save") as save_span:
+            stored = save_upload_stream(file.stream, UPLOAD_DIR, safe_filename, MAX_UPLOAD_BYTES)
+            save_span.set(bytes=stored.size)
+        file_path = stored.path
+        # Наблюдатель за папкой не должен повторно обработать этот файл
+        record_ingestion(stored.sha256, file_path, 'web')
+        payload = DocumentPayload(file_path)
         
         user_question = request.form.get("question", "").strip()
         ai_answer = None
         
         if user_question:
             try:
-                with open(file_path, "rb") as f:
-                    file_data = f.read()
-                file_base64 = base64.b64encode(file_data).decode("utf-8")
-                
-                file_ext = Path(safe_filename).suffix.lower()
-                if file_ext == ".pdf":
-                    mime_type = "application/pdf"
-                elif file_ext in ['.jpg', '.jpeg']:
-                    mime_type = "image/jpeg"
-                elif file_ext == '.png':
-                    mime_type = "image/png"
-                else:
-                    mime_type = "application/pdf"
-                
-                response = model.generate_content([
-                    {"mime_type": mime_type, "data": file_base64},
-                    {"text": f"Ответь на вопрос по этому документу: {user_question}"}
-                ])
+                with span("question"):
+                    response = generate_content([
+                        payload.as_part(),
+                        {"text": document_question_prompt(user_question)}
+                    ], usage=payload.usage_info("document_question"))
                 ai_answer = response.text
+                stats_tracker.increment('questions_answered')
             except Exception as e:
                 ai_answer = f"Ошибка при обработке вопроса: {str(e)}"
         
-        transactions = extract_invoice_data(file_path)
-        
-        if not isinstance(transactions, list):
-            transactions = [transactions]
+        # Одинаковые документы, загруженные одновременно, извлекаются один раз;
+        # у ожидающих чужое извлечение спан single_flight без дочернего extraction
+        with span("single_flight"):
+            transactions = extraction_flight.do(
+                f"extract:{stored.sha256}",
+                lambda: extract_invoice_data(file_path, payload)
+            )
         
-        successful_transactions = []
-        for transaction in transactions:
-            if isinstance(transaction, dict) and "error" not in transaction:
-                transaction["Счет"] = classify_transaction(transaction.get("Назначение платежа", ""))
-                successful_transactions.append(transaction)
+        stats_tracker.increment('documents_rejected' if is_rejected(transactions) else 'extractions_done')
         
-        if successful_transactions:
-            successful_transactions = detect_anomalies_in_transactions(successful_transactions)
-        
-        all_transactions_with_anomalies = []
-        for transaction in transactions:
-            if isinstance(transaction, dict) and "error" not in transaction:
-                all_transactions_with_anomalies.append(transaction)
+        raw_extraction = compress_extraction(transactions)
+        transactions, successful_transactions = enrich_transactions(transactions)
         
         file_ext = Path(safe_filename).suffix.lower()
-        file_id = save_file_and_transactions(safe_filename, file_ext, all_transactions_with_anomalies, user_question, ai_answer)
+        file_id = save_file_and_transactions(
+            file_path.name, file_ext, successful_transactions, user_question, ai_answer,
+            content_hash=stored.sha256, raw_extraction=raw_extraction
+        )
+        stats_tracker.increment('transactions_saved', len(successful_transactions))
         
         html_content = f"<h3>✅ Документ успешно обработан!</h3>"
         html_content += f"<p><b>Найдено транзакций:</b> {len(transactions)}</p>"
@@ -950,7 +790,7 @@ def upload():
                     html_content += f"<h3>Транзакция №{i}</h3>"
                 
                 for key, value in transaction.items():
-                    if key not in ['is_anomaly', 'anomaly_reasons']:
+                    if key not in ['is_anomaly', 'anomaly_mask', 'anomaly_reasons']:
                         html_content += f"<div class='data-item'><b>{key}:</b> {value if value else 'Не указано'}</div>"
                 html_content += "</div>"
         
@@ -958,16 +798,111 @@ def upload():
             html_content += f"<p style='margin-top: 20px;'>✅ {len(successful_transactions)} транзакци(й/я) сохранено в <a href='/history'>историю</a></p>"
             html_content += f"<p><a href='/file/{file_id}'>Просмотреть детали →</a></p>"
         
-        stats_tracker.finish_processing(safe_filename)
-        return render_template_string(RESULT_TEMPLATE, title="📄 Результат обработки документа", content=html_content, result_class="result")
+        stats_tracker.finish_processing(job_id)
+        return render_template('result.html', title="📄 Результат обработки документа", content=html_content, result_class="result")
+    
+    except UploadTooLargeError as e:
+        if 'job_id' in locals():
+            stats_tracker.finish_processing(job_id)
+        content = f"<p>{str(e)}</p>"
+        return render_template('result.html', title="Ошибка", content=content, result_class="error"), 413
+    
+    except ModelUnavailableError as e:
+        if 'job_id' in locals():
+            stats_tracker.finish_processing(job_id)
+        content = f"<p>{str(e)}</p>"
+        return render_template('result.html', title="Ошибка", content=content, result_class="error"), 503
     
     except Exception as e:
-        if 'safe_filename' in locals():
-            stats_tracker.finish_processing(safe_filename)
+        if 'job_id' in locals():
+            stats_tracker.finish_processing(job_id)
         content = f"<p>Ошибка при обработке файла: {str(e)}</p>"
         import traceback
         content += f"<pre>{traceback.format_exc()}</pre>"
-        return render_template_string(RESULT_TEMPLATE, title="Ошибка", content=content, result_class="error")
+        return render_template('result.html', title="Ошибка", content=content, result_class="error")
+
+def ndjson_line(payload):
+    return json.dumps(payload, ensure_ascii=False, default=str) + "\n"
+
+@app.route("/api/upload/stream", methods=["POST"])
+def upload_stream():
+    """Загрузка документа с потоковой выдачей транзакций (NDJSON).
+
+    Каждая транзакция отдаётся строкой {"type": "transaction", ...}, как только
+    модель её вернула; последняя строка {"type": "done", ...} — после классификации,
+    поиска аномалий и сохранения. Если ответ модели оборвался, сохраняются
+    транзакции, полученные до обрыва.
+    """
+    try:
+        admission = upload_admission.acquire(session['session_id'])
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    # Генератор ответа выполняется после выхода из обработчика, трейс начинается в нём
+    forced = trace_forced()
+    session_id = session['session_id']
+    try:
+        file = request.files.get('file')
+        safe_filename = secure_filename(file.filename) if file else ''
+        if not safe_filename:
+            admission.release()
+            return jsonify({'error': 'file is required'}), 400
+        stored = save_upload_stream(file.stream, UPLOAD_DIR, safe_filename, MAX_UPLOAD_BYTES)
+        record_ingestion(stored.sha256, stored.path, 'web')
+    except UploadTooLargeError as e:
+        admission.release()
+        return jsonify({'error': str(e)}), 413
+    except Exception:
+        admission.release()
+        raise
+
+    def generate():
+        with start_trace("POST /api/upload/stream", force=forced, session=session_id[:8]):
+            yield from process_stream()
+
+    def process_stream():
+        job_id = stats_tracker.start_processing(safe_filename)
+        try:
+            stats_tracker.increment('uploads_received')
+            yield ndjson_line({'type': 'file', 'filename': stored.path.name, 'content_hash': stored.sha256})
+            transactions = []
+            # Тот же ключ, что и у /upload: одинаковые одновременные загрузки извлекаются один раз,
+            # ожидающие получают транзакции ведущего разом, когда он закончит
+            extraction = extraction_flight.stream(
+                f"extract:{stored.sha256}", lambda: iter_invoice_transactions(stored.path)
+            )
+            for transaction in extraction:
+                transactions.append(transaction)
+                if isinstance(transaction, dict) and "error" not in transaction:
+                    row = {**transaction, "Счет": classify_transaction(transaction.get("Назначение платежа", ""))}
+                    yield ndjson_line({'type': 'transaction', 'index': len(transactions), 'data': row})
+                else:
+                    yield ndjson_line({'type': 'error', 'data': transaction})
+            stats_tracker.increment('documents_rejected' if is_rejected(transactions) else 'extractions_done')
+
+            raw_extraction = compress_extraction(transactions)
+            transactions, successful_transactions = enrich_transactions(transactions)
+            file_id = save_file_and_transactions(
+                stored.path.name, stored.path.suffix.lower(), successful_transactions,
+                content_hash=stored.sha256, raw_extraction=raw_extraction
+            )
+            stats_tracker.increment('transactions_saved', len(successful_transactions))
+            yield ndjson_line({
+                'type': 'done',
+                'file_id': file_id,
+                'saved_transactions': len(successful_transactions),
+                'anomalies': sum(1 for t in successful_transactions if t.get('is_anomaly', False)),
+            })
+        except ModelUnavailableError as e:
+            yield ndjson_line({'type': 'error', 'status': 503, 'error': str(e)})
+        except Exception as e:
+            yield ndjson_line({'type': 'error', 'error': f"Ошибка при обработке файла: {str(e)}"})
+        finally:
+            stats_tracker.finish_processing(job_id)
+
+    response = Response(generate(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+    # Место освобождается, когда ответ дописан или клиент отключился
+    response.call_on_close(admission.release)
+    return response
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
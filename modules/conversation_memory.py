@@ -0,0 +1,303 @@
+"""
+История разговора в /chat по сессиям (session['session_id']):
+- Последние реплики хранятся целиком, пока укладываются в бюджет токенов
+- Вышедшие из окна реплики сжимаются в краткую сводку (вопрос и начало ответа)
+  без дополнительных вызовов модели; сводка тоже ограничена бюджетом
+- История удаляется, когда сессия уходит в offline, а число хранимых
+  сессий ограничено, поэтому память не растёт с числом пользователей
+
+При STATS_BACKEND=sqlite история хранится в общей базе статистики (STATS_DB):
+следующий вопрос может попасть на другой воркер gunicorn и увидит ту же историю,
+а offline определяется по общей таблице присутствия всех воркеров.
+Иначе история хранится в памяти процесса.
+"""
+import json
+import logging
+import re
+import sqlite3
+import time
+from threading import Lock
+from collections import OrderedDict, deque
+from config import (
+    CHAT_HISTORY_TOKENS, CHAT_HISTORY_SUMMARY_TOKENS, CHAT_HISTORY_MAX_SESSIONS, STATS_BACKEND, STATS_DB
+)
+from modules.chat_retrieval import estimate_tokens
+from modules.stats_tracker import stats_tracker
+
+logger = logging.getLogger(__name__)
+
+QUESTION_PREVIEW_CHARS = 150
+ANSWER_PREVIEW_CHARS = 200
+# Короче этого начало ответа в сводке — скорее заголовок, добавляем следующую фразу
+MIN_LEAD_CHARS = 60
+# Сколько токенов ответа сохраняется даже после очень длинного вопроса
+MIN_ANSWER_TOKENS = 100
+
+_MARKDOWN_RE = re.compile(r'[#*_`>|]+')
+_WHITESPACE_RE = re.compile(r'\s+')
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?])\s')
+
+def _clip(text, limit):
+    text = _WHITESPACE_RE.sub(' ', _MARKDOWN_RE.sub(' ', text or '')).strip()
+    return text if len(text) <= limit else text[:limit].rstrip() + "…"
+
+def _clip_to_tokens(text, tokens):
+    """Обрезать текст так, чтобы оценка токенов не превышала tokens"""
+    if estimate_tokens(text) <= tokens:
+        return text
+    encoded = text.encode('utf-8')[:max(0, tokens) * 4]
+    return encoded.decode('utf-8', errors='ignore').rstrip() + "…"
+
+def summarize_turn(question, answer):
+    """Сжатая реплика для сводки: вопрос и начало ответа (первые фразы, но не заголовок)"""
+    lead = ""
+    for sentence in _SENTENCE_END_RE.split(_clip(answer, ANSWER_PREVIEW_CHARS * 4)):
+        lead = f"{lead} {sentence}".strip()
+        if len(lead) >= MIN_LEAD_CHARS:
+            break
+    return f"- {_clip(question, QUESTION_PREVIEW_CHARS)} → {_clip(lead, ANSWER_PREVIEW_CHARS)}"
+
+def format_turn(question, answer):
+    return f"Пользователь: {question}\nБухгалтер: {answer}"
+
+class Conversation:
+    """История одной сессии: сводка старых реплик и окно последних"""
+    def __init__(self, summary=(), turns=()):
+        self.summary = deque(summary)
+        self.summary_tokens = sum(estimate_tokens(line) for line in self.summary)
+        # (вопрос, ответ, токены)
+        self.turns = deque(tuple(turn) for turn in turns)
+        self.turn_tokens = sum(tokens for _, _, tokens in self.turns)
+
+    def tokens(self):
+        return self.summary_tokens + self.turn_tokens
+
+    def as_text(self):
+        parts = []
+        if self.summary:
+            parts.append("Ранее в разговоре (кратко):\n" + "\n".join(self.summary))
+        if self.turns:
+            parts.append("\n\n".join(format_turn(question, answer) for question, answer, _ in self.turns))
+        return "\n\n".join(parts)
+
+    def to_json(self):
+        return json.dumps({'summary': list(self.summary), 'turns': list(self.turns)}, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        return cls(data['summary'], data['turns'])
+
+class SharedConversationStore:
+    """История всех воркеров в SQLite: одна строка JSON на сессию"""
+    def __init__(self, db_path, max_sessions=5000, user_timeout=60, cleanup_interval=30):
+        self.db_path = db_path
+        self.max_sessions = max_sessions
+        self.user_timeout = user_timeout
+        self.cleanup_interval = cleanup_interval
+        self.last_cleanup = 0.0
+        self._init_tables()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+
+    def _init_tables(self):
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                session_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations (updated_at)')
+        conn.close()
+
+    def _load_live(self, conn, session_id):
+        """История сессии, если после последней реплики сессия не уходила в offline.
+
+        Строка присутствия удаляется, когда сессия ушла в offline, и создаётся заново
+        с новым since, когда пользователь вернулся: тогда история старше since уже истекла,
+        даже если _cleanup её ещё не удалил.
+        """
+        row = conn.execute(
+            'SELECT c.data FROM conversations c JOIN presence p ON p.session_id = c.session_id '
+            'WHERE c.session_id = ? AND COALESCE(p.since, 0) <= c.updated_at',
+            (session_id,)
+        ).fetchone()
+        return Conversation.from_json(row[0]) if row else None
+
+    def load(self, session_id):
+        conn = self._connect()
+        try:
+            return self._load_live(conn, session_id)
+        finally:
+            conn.close()
+
+    def update(self, session_id, change):
+        """change(conversation) под блокировкой записи: одновременные ответы из разных воркеров не теряются.
+        Возвращает число удалённых при очистке сессий"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conversation = self._load_live(conn, session_id) or Conversation()
+            change(conversation)
+            conn.execute(
+                'INSERT INTO conversations (session_id, data, tokens, updated_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(session_id) DO UPDATE SET data = excluded.data, tokens = excluded.tokens, '
+                'updated_at = excluded.updated_at',
+                (session_id, conversation.to_json(), conversation.tokens(), now)
+            )
+            expired = self._cleanup(conn, now) if now - self.last_cleanup > self.cleanup_interval else 0
+            conn.execute('COMMIT')
+            return expired
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _cleanup(self, conn, now):
+        """Удалить историю сессий, ушедших в offline на всех воркерах, и самые старые сверх max_sessions"""
+        self.last_cleanup = now
+        # Таблица presence — общее присутствие из SharedStatsStore в той же базе
+        expired = conn.execute(
+            'DELETE FROM conversations WHERE updated_at < ? AND session_id NOT IN '
+            '(SELECT session_id FROM presence WHERE last_seen >= ?)',
+            (now - self.user_timeout, now - self.user_timeout)
+        ).rowcount
+        expired += conn.execute(
+            'DELETE FROM conversations WHERE session_id IN '
+            '(SELECT session_id FROM conversations ORDER BY updated_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_sessions,)
+        ).rowcount
+        return expired
+
+    def forget(self, session_id):
+        conn = self._connect()
+        try:
+            return conn.execute('DELETE FROM conversations WHERE session_id = ?', (session_id,)).rowcount
+        finally:
+            conn.close()
+
+    def totals(self):
+        """(число сессий, сумма токенов)"""
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM conversations').fetchone()
+        finally:
+            conn.close()
+
+class ConversationMemory:
+    def __init__(self, token_budget=1200, summary_tokens=300, max_sessions=5000, store=None):
+        self.lock = Lock()
+        # session ID -> Conversation, от давно не писавших к недавним (без общего хранилища)
+        self.sessions = OrderedDict()
+        self.token_budget = token_budget
+        self.summary_budget = summary_tokens
+        self.max_sessions = max_sessions
+        # Общее для воркеров хранилище (None — история только этого процесса)
+        self.store = store
+        self.summarized_turns = 0
+        self.expired_sessions = 0
+
+    def history(self, session_id):
+        """Текст истории для промпта или пустая строка"""
+        if not session_id:
+            return ""
+        if self.store is not None:
+            try:
+                conversation = self.store.load(session_id)
+            except sqlite3.Error:
+                logger.warning("Не удалось прочитать историю разговора", exc_info=True)
+                return ""
+            return conversation.as_text() if conversation else ""
+        with self.lock:
+            conversation = self.sessions.get(session_id)
+            return conversation.as_text() if conversation else ""
+
+    def _add_turn(self, conversation, question, answer, tokens):
+        """Добавить реплику и сдвинуть окно, если история вышла за бюджет токенов"""
+        conversation.turns.append((question, answer, tokens))
+        conversation.turn_tokens += tokens
+        summarized = 0
+        while conversation.turn_tokens > self.token_budget and len(conversation.turns) > 1:
+            old_question, old_answer, old_tokens = conversation.turns.popleft()
+            conversation.turn_tokens -= old_tokens
+            line = summarize_turn(old_question, old_answer)
+            conversation.summary.append(line)
+            conversation.summary_tokens += estimate_tokens(line)
+            summarized += 1
+        while conversation.summary_tokens > self.summary_budget and conversation.summary:
+            conversation.summary_tokens -= estimate_tokens(conversation.summary.popleft())
+        return summarized
+
+    def append(self, session_id, question, answer):
+        """Добавить реплику в историю сессии"""
+        if not session_id:
+            return
+        # Одна реплика не может занять больше бюджета окна, но длинный вопрос не обнуляет ответ
+        answer_budget = max(MIN_ANSWER_TOKENS, self.token_budget - estimate_tokens(question))
+        answer = _clip_to_tokens(answer, answer_budget)
+        tokens = estimate_tokens(format_turn(question, answer))
+        if self.store is not None:
+            summarized = []
+            try:
+                expired = self.store.update(
+                    session_id, lambda conversation: summarized.append(self._add_turn(conversation, question, answer, tokens))
+                )
+            except sqlite3.Error:
+                logger.warning("Не удалось сохранить историю разговора", exc_info=True)
+                return
+            with self.lock:
+                self.summarized_turns += sum(summarized)
+                self.expired_sessions += expired
+            return
+        with self.lock:
+            conversation = self.sessions.get(session_id)
+            if conversation is None:
+                conversation = self.sessions[session_id] = Conversation()
+            self.sessions.move_to_end(session_id)
+            self.summarized_turns += self._add_turn(conversation, question, answer, tokens)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def forget(self, session_id):
+        """Удалить историю сессии (сессия ушла в offline в этом процессе)"""
+        if self.store is not None:
+            # Сессия может быть активна на другом воркере: общую историю чистит _cleanup по присутствию
+            return
+        with self.lock:
+            if self.sessions.pop(session_id, None) is not None:
+                self.expired_sessions += 1
+
+    def get_stats(self):
+        if self.store is not None:
+            try:
+                sessions, tokens = self.store.totals()
+            except sqlite3.Error:
+                sessions, tokens = None, None
+        else:
+            with self.lock:
+                sessions = len(self.sessions)
+                tokens = sum(conversation.tokens() for conversation in self.sessions.values())
+        return {
+            'sessions': sessions,
+            'tokens': tokens,
+            'summarized_turns': self.summarized_turns,
+            'expired_sessions': self.expired_sessions,
+        }
+
+def create_conversation_memory(backend=STATS_BACKEND, db_path=STATS_DB):
+    """История в общей SQLite-базе статистики или только в памяти процесса"""
+    store = None
+    if backend == "sqlite":
+        store = SharedConversationStore(db_path, CHAT_HISTORY_MAX_SESSIONS, stats_tracker.user_timeout)
+    return ConversationMemory(CHAT_HISTORY_TOKENS, CHAT_HISTORY_SUMMARY_TOKENS, CHAT_HISTORY_MAX_SESSIONS, store)
+
+# Глобальная история разговоров; очищается вместе с неактивными сессиями
+conversation_memory = create_conversation_memory()
+stats_tracker.add_expiry_listener(conversation_memory.forget)
@@ -0,0 +1,137 @@
+"""
+Справочник контрагентов:
+- ИНН нормализуется и проверяется по контрольным цифрам
+- Контрагент с корректным ИНН ключуется по ИНН, без него — по нормализованному названию
+- Варианты написания названия («ООО Ромашка», «Ромашка ООО») хранятся как псевдонимы
+- Кэш псевдонимов в памяти: при вставке транзакций повторные контрагенты не требуют запросов
+"""
+import re
+from threading import Lock
+
+INN_10_WEIGHTS = [2, 4, 10, 3, 5, 9, 4, 6, 8]
+INN_12_WEIGHTS_11 = [7, 2, 4, 10, 3, 5, 9, 4, 6, 8]
+INN_12_WEIGHTS_12 = [3, 7, 2, 4, 10, 3, 5, 9, 4, 6, 8]
+
+# Организационно-правовые формы, которые модель пишет в разных местах названия
+LEGAL_FORMS_RE = re.compile(
+    r'\b(ооо|оао|зао|пао|ао|ип|нко|ано|муп|гуп|фгуп|'
+    r'общество с ограниченной ответственностью|'
+    r'(?:публичное |закрытое |открытое )?акционерное общество|'
+    r'индивидуальный предприниматель)\b'
+)
+_NAME_NOISE_RE = re.compile(r'[«»"\'“”„.,()]+')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_inn(value):
+    """Только цифры ИНН или пустая строка"""
+    if not value:
+        return ""
+    return re.sub(r'\D', '', str(value))
+
+def _checksum(digits, weights):
+    return sum(int(d) * w for d, w in zip(digits, weights)) % 11 % 10
+
+def is_valid_inn(inn):
+    """Проверка контрольных цифр ИНН юрлица (10 цифр) или физлица/ИП (12 цифр)"""
+    if not inn or not inn.isdigit():
+        return False
+    if len(inn) == 10:
+        return _checksum(inn, INN_10_WEIGHTS) == int(inn[9])
+    if len(inn) == 12:
+        return (_checksum(inn, INN_12_WEIGHTS_11) == int(inn[10])
+                and _checksum(inn, INN_12_WEIGHTS_12) == int(inn[11]))
+    return False
+
+def normalize_counterparty_name(name):
+    """Канонический вид названия для сравнения: без ОПФ, кавычек, регистра и лишних пробелов"""
+    if not name:
+        return ""
+    text = str(name).casefold().replace('ё', 'е')
+    text = _NAME_NOISE_RE.sub(' ', text)
+    text = LEGAL_FORMS_RE.sub(' ', text)
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+class CounterpartyResolver:
+    """Сопоставляет (ИНН, название) транзакции с id контрагента, создавая его при необходимости.
+
+    Работает на курсоре вызывающего, чтобы контрагенты создавались в той же
+    транзакции БД, что и ссылающиеся на них строки.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        # (корректный ИНН или None, нормализованное название) -> id контрагента
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, cursor, inn, name):
+        inn = normalize_inn(inn)
+        if not is_valid_inn(inn):
+            inn = None
+        alias = normalize_counterparty_name(name)
+        if inn is None and not alias:
+            return None
+        key = (inn, alias)
+        with self.lock:
+            counterparty_id = self.cache.get(key)
+            if counterparty_id is not None:
+                self.hits += 1
+                return counterparty_id
+            self.misses += 1
+        counterparty_id = self._resolve_in_db(cursor, inn, alias, name)
+        with self.lock:
+            self.cache[key] = counterparty_id
+        return counterparty_id
+
+    def _resolve_in_db(self, cursor, inn, alias, name):
+        counterparty_id = None
+        if inn:
+            row = cursor.execute('SELECT id FROM counterparties WHERE inn = ?', (inn,)).fetchone()
+            if row:
+                counterparty_id = row[0]
+            elif alias:
+                # Контрагент, ранее известный только по названию, получает ИНН
+                row = cursor.execute('''
+                    SELECT c.id FROM counterparty_aliases a
+                    JOIN counterparties c ON c.id = a.counterparty_id
+                    WHERE a.alias = ? AND c.inn IS NULL
+                ''', (alias,)).fetchone()
+                if row:
+                    counterparty_id = row[0]
+                    cursor.execute('UPDATE counterparties SET inn = ? WHERE id = ?', (inn, counterparty_id))
+            if counterparty_id is None:
+                # OR IGNORE + повторный SELECT: другой воркер мог создать контрагента одновременно
+                cursor.execute('INSERT OR IGNORE INTO counterparties (inn, name) VALUES (?, ?)', (inn, name or alias))
+                counterparty_id = cursor.execute('SELECT id FROM counterparties WHERE inn = ?', (inn,)).fetchone()[0]
+        else:
+            row = cursor.execute('SELECT counterparty_id FROM counterparty_aliases WHERE alias = ?', (alias,)).fetchone()
+            if row:
+                counterparty_id = row[0]
+            else:
+                cursor.execute('INSERT INTO counterparties (inn, name) VALUES (NULL, ?)', (name or alias,))
+                counterparty_id = cursor.lastrowid
+                cursor.execute(
+                    'INSERT OR IGNORE INTO counterparty_aliases (alias, counterparty_id) VALUES (?, ?)',
+                    (alias, counterparty_id)
+                )
+                owner = cursor.execute(
+                    'SELECT counterparty_id FROM counterparty_aliases WHERE alias = ?', (alias,)
+                ).fetchone()[0]
+                if owner != counterparty_id:
+                    # Псевдоним успел занять другой воркер — используем его контрагента
+                    cursor.execute('DELETE FROM counterparties WHERE id = ?', (counterparty_id,))
+                    counterparty_id = owner
+        if alias:
+            cursor.execute(
+                'INSERT OR IGNORE INTO counterparty_aliases (alias, counterparty_id) VALUES (?, ?)',
+                (alias, counterparty_id)
+            )
+        return counterparty_id
+
+    def clear(self):
+        """Сброс кэша (после отката транзакции БД в нём могли остаться несохранённые id)"""
+        with self.lock:
+            self.cache.clear()
+
+# Глобальный резолвер контрагентов
+counterparty_resolver = CounterpartyResolver()
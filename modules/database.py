@@ -2,7 +2,14 @@ import sqlite3
 from datetime import datetime
 from pathlib import Path
 import json
+import logging
+import zlib
 from config import DB_PATH
+from modules.counterparties import counterparty_resolver, is_valid_inn, normalize_inn
+from modules.anomaly_codes import ANOMALY_CODES, anomaly_bit, labels_to_mask
+from modules.tracing import span, set_trace_attribute
+
+logger = logging.getLogger(__name__)
 
 def init_database():
     """Инициализация базы данных и создание таблиц."""
@@ -17,7 +24,8 @@ def init_database():
             file_type TEXT,
             status TEXT DEFAULT 'success',
             user_question TEXT,
-            ai_answer TEXT
+            ai_answer TEXT,
+            content_hash TEXT
         )
     ''')
     
@@ -48,6 +56,13 @@ def init_database():
     except sqlite3.OperationalError:
         pass
     
+    try:
+        cursor.execute('ALTER TABLE uploaded_files ADD COLUMN content_hash TEXT')
+    except sqlite3.OperationalError:
+        pass
+    
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_uploaded_files_content_hash ON uploaded_files (content_hash)')
+    
     try:
         cursor.execute('ALTER TABLE transactions ADD COLUMN is_anomaly INTEGER DEFAULT 0')
     except sqlite3.OperationalError:
@@ -58,47 +73,243 @@ def init_database():
     except sqlite3.OperationalError:
         pass
     
+    try:
+        cursor.execute('ALTER TABLE transactions ADD COLUMN anomaly_mask INTEGER DEFAULT 0')
+    except sqlite3.OperationalError:
+        pass
+    
+    migrate_anomaly_masks(cursor)
+    # Частичный индекс: аномалий мало, и фильтры по битам маски проходят только по ним
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_anomaly_mask ON transactions (anomaly_mask) WHERE anomaly_mask != 0')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ingestion_log (
+            content_hash TEXT PRIMARY KEY,
+            path TEXT,
+            status TEXT,
+            error TEXT,
+            file_id INTEGER,
+            processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS counterparties (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            inn TEXT UNIQUE,
+            name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS counterparty_aliases (
+            alias TEXT PRIMARY KEY,
+            counterparty_id INTEGER NOT NULL,
+            FOREIGN KEY (counterparty_id) REFERENCES counterparties (id)
+        )
+    ''')
+    
+    try:
+        cursor.execute('ALTER TABLE transactions ADD COLUMN counterparty_id INTEGER REFERENCES counterparties (id)')
+    except sqlite3.OperationalError:
+        pass
+    
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_counterparty_id ON transactions (counterparty_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_counterparty_aliases_counterparty_id ON counterparty_aliases (counterparty_id)')
+    
+    migrate_counterparties(cursor)
+    
+    # Исходный ответ модели по файлу (JSON, сжатый zlib) — для переобработки без повторного извлечения
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS raw_extractions (
+            file_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            raw_size INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            reprocessed_at TIMESTAMP,
+            FOREIGN KEY (file_id) REFERENCES uploaded_files (id)
+        )
+    ''')
+    
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_file_id ON transactions (file_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_created_at ON transactions (created_at)')
+    
+    init_fulltext_index(cursor)
+    
     conn.commit()
     conn.close()
 
-def save_file_and_transactions(filename, file_type, transactions_data, user_question=None, ai_answer=None):
-    """Сохраняет файл и все его транзакции в базу данных."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+# Текстовые столбцы транзакций в полнотекстовом индексе
+FULLTEXT_COLUMNS = ('counterparty', 'purpose', 'inn', 'account')
+
+# Доступен ли полнотекстовый индекс (SQLite без FTS5 — поиск только по отборам)
+FULLTEXT_AVAILABLE = False
+
+def init_fulltext_index(cursor):
+    """Полнотекстовый индекс FTS5 по транзакциям для поиска к вопросам чата (ранжирование BM25).
     
-    cursor.execute(
-        'INSERT INTO uploaded_files (filename, file_type, user_question, ai_answer) VALUES (?, ?, ?, ?)',
-        (filename, file_type, user_question, ai_answer)
+    Индекс внешнего содержимого: тексты хранятся только в transactions,
+    а триггеры поддерживают индекс при вставке, изменении и удалении строк.
+    """
+    global FULLTEXT_AVAILABLE
+    columns = ", ".join(FULLTEXT_COLUMNS)
+    old_values = ", ".join(f"old.{column}" for column in FULLTEXT_COLUMNS)
+    new_values = ", ".join(f"new.{column}" for column in FULLTEXT_COLUMNS)
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transactions_fts'"
+    ).fetchone()
+    try:
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+                {columns}, content='transactions', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        logger.warning("Полнотекстовый поиск недоступен: %s", e)
+        return
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_insert AFTER INSERT ON transactions BEGIN
+            INSERT INTO transactions_fts (rowid, {columns}) VALUES (new.id, {new_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_delete AFTER DELETE ON transactions BEGIN
+            INSERT INTO transactions_fts (transactions_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_update AFTER UPDATE OF {columns} ON transactions BEGIN
+            INSERT INTO transactions_fts (transactions_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO transactions_fts (rowid, {columns}) VALUES (new.id, {new_values});
+        END
+    ''')
+    if not exists:
+        # Индекс создан к уже заполненной таблице — строим его по существующим строкам
+        cursor.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('rebuild')")
+    FULLTEXT_AVAILABLE = True
+
+def migrate_anomaly_masks(cursor):
+    """Переносит причины аномалий из JSON-текста anomaly_reasons в битовую маску anomaly_mask.
+    
+    После переноса текст очищается, так что повторный запуск ничего не делает.
+    """
+    rows = cursor.execute('SELECT id, anomaly_reasons FROM transactions WHERE anomaly_reasons IS NOT NULL').fetchall()
+    updates = []
+    for row_id, value in rows:
+        try:
+            labels = json.loads(value) if value else []
+        except (json.JSONDecodeError, TypeError):
+            labels = []
+        updates.append((labels_to_mask(labels), row_id))
+    cursor.executemany('UPDATE transactions SET anomaly_mask = ?, anomaly_reasons = NULL WHERE id = ?', updates)
+
+def migrate_counterparties(cursor):
+    """Привязывает к справочнику контрагентов транзакции, у которых ещё нет counterparty_id.
+    
+    Пары с корректным ИНН обрабатываются первыми, чтобы варианты названий
+    стали псевдонимами контрагента с ИНН, а не отдельными записями.
+    """
+    pairs = cursor.execute(
+        'SELECT DISTINCT inn, counterparty FROM transactions WHERE counterparty_id IS NULL'
+    ).fetchall()
+    if not pairs:
+        return
+    pairs.sort(key=lambda pair: not is_valid_inn(normalize_inn(pair[0])))
+    resolved = {(inn, name): counterparty_resolver.resolve(cursor, inn, name) for inn, name in pairs}
+    
+    rows = cursor.execute('SELECT id, inn, counterparty FROM transactions WHERE counterparty_id IS NULL').fetchall()
+    cursor.executemany(
+        'UPDATE transactions SET counterparty_id = ? WHERE id = ?',
+        [(resolved[(inn, name)], row_id) for row_id, inn, name in rows if resolved.get((inn, name)) is not None]
     )
-    file_id = cursor.lastrowid
+
+# Поля извлечённой транзакции -> столбцы таблицы transactions
+TRANSACTION_FIELD_COLUMNS = {
+    "ИНН поставщика": 'inn',
+    "Название контрагента": 'counterparty',
+    "Сумма": 'amount',
+    "Дата": 'date',
+    "Назначение платежа": 'purpose',
+    "Счет": 'account',
+}
+
+INSERT_TRANSACTION_SQL = '''
+    INSERT INTO transactions 
+    (file_id, inn, counterparty, amount, date, purpose, account, is_anomaly, anomaly_mask, counterparty_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def compress_extraction(transactions):
+    """Сжимает ответ модели (список транзакций и ошибок) для хранения в raw_extractions.
     
-    if isinstance(transactions_data, dict):
-        transactions_data = [transactions_data]
+    Вызывается до классификации: она дописывает поля в те же словари.
+    """
+    raw = json.dumps(transactions, ensure_ascii=False).encode('utf-8')
+    return zlib.compress(raw, 6), len(raw)
+
+def decompress_extraction(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+def _transaction_values(cursor, transaction):
+    """Значения столбцов транзакции после классификации, от inn до counterparty_id"""
+    is_anomaly = 1 if transaction.get("is_anomaly", False) else 0
+    anomaly_mask = transaction.get("anomaly_mask")
+    if anomaly_mask is None:
+        anomaly_mask = labels_to_mask(transaction.get("anomaly_reasons"))
+    counterparty_id = counterparty_resolver.resolve(
+        cursor, transaction.get("ИНН поставщика"), transaction.get("Название контрагента")
+    )
+    return tuple(transaction.get(field) for field in TRANSACTION_FIELD_COLUMNS) + (
+        is_anomaly, anomaly_mask, counterparty_id
+    )
+
+def save_file_and_transactions(filename, file_type, transactions_data, user_question=None, ai_answer=None, content_hash=None,
+                               raw_extraction=None):
+    """Сохраняет файл и все его транзакции в базу данных.
     
-    for transaction in transactions_data:
-        if isinstance(transaction, dict) and "error" not in transaction:
-            is_anomaly = 1 if transaction.get("is_anomaly", False) else 0
-            anomaly_reasons = json.dumps(transaction.get("anomaly_reasons", []), ensure_ascii=False)
-            
-            cursor.execute('''
-                INSERT INTO transactions 
-                (file_id, inn, counterparty, amount, date, purpose, account, is_anomaly, anomaly_reasons)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                file_id,
-                transaction.get("ИНН поставщика"),
-                transaction.get("Название контрагента"),
-                transaction.get("Сумма"),
-                transaction.get("Дата"),
-                transaction.get("Назначение платежа"),
-                transaction.get("Счет"),
-                is_anomaly,
-                anomaly_reasons
-            ))
+    raw_extraction — результат compress_extraction для исходного ответа модели.
+    """
+    write_span = span("db.write")
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
     
-    conn.commit()
-    conn.close()
+    try:
+        cursor.execute(
+            'INSERT INTO uploaded_files (filename, file_type, user_question, ai_answer, content_hash) VALUES (?, ?, ?, ?, ?)',
+            (filename, file_type, user_question, ai_answer, content_hash)
+        )
+        file_id = cursor.lastrowid
+        write_span.set(file_id=file_id)
+        
+        if isinstance(transactions_data, dict):
+            transactions_data = [transactions_data]
+        
+        for transaction in transactions_data:
+            if isinstance(transaction, dict) and "error" not in transaction:
+                cursor.execute(INSERT_TRANSACTION_SQL, (file_id,) + _transaction_values(cursor, transaction))
+        
+        if raw_extraction is not None:
+            data, raw_size = raw_extraction
+            cursor.execute(
+                'INSERT INTO raw_extractions (file_id, data, raw_size) VALUES (?, ?, ?)',
+                (file_id, data, raw_size)
+            )
+        
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        # Кэш мог запомнить контрагентов, созданных в откатанной транзакции
+        counterparty_resolver.clear()
+        write_span.set(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        conn.close()
+        write_span.end()
     
+    # По file_id трейс находится на странице /admin/traces/file/<file_id>
+    set_trace_attribute(file_id=file_id)
     return file_id
 
 def get_all_files():
@@ -158,22 +369,452 @@ def get_file_with_transactions(file_id):
         ORDER BY id
     ''', (file_id,))
     
-    transactions = []
-    for row in cursor.fetchall():
-        t = dict(row)
-        if t.get('anomaly_reasons'):
-            try:
-                t['anomaly_reasons'] = json.loads(t['anomaly_reasons'])
-            except (json.JSONDecodeError, TypeError):
-                t['anomaly_reasons'] = []
-        else:
-            t['anomaly_reasons'] = []
-        transactions.append(t)
-    
+    transactions = [dict(row) for row in cursor.fetchall()]
     conn.close()
     
     file_dict['transactions'] = transactions
+    file_dict['anomaly_counts'] = get_anomaly_counts(file_id=file_id)
     
     return file_dict
 
+def get_processed_content_hashes():
+    """Получает хэши содержимого всех уже сохранённых файлов."""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT DISTINCT content_hash FROM uploaded_files WHERE content_hash IS NOT NULL')
+    hashes = {row[0] for row in cursor.fetchall()}
+    conn.close()
+
+    return hashes
+
+def record_ingestion(content_hash, path, status, error=None, file_id=None):
+    """Отмечает файл в журнале приёма: status — web, done, failed или rejected."""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        'INSERT OR REPLACE INTO ingestion_log (content_hash, path, status, error, file_id) VALUES (?, ?, ?, ?, ?)',
+        (content_hash, str(path), status, error, file_id)
+    )
+    conn.commit()
+    conn.close()
+
+def get_ingested_hashes(exclude_failed=False):
+    """Получает хэши файлов из журнала приёма (веб-загрузки и наблюдатель за папкой)."""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    if exclude_failed:
+        cursor.execute("SELECT content_hash FROM ingestion_log WHERE status != 'failed'")
+    else:
+        cursor.execute('SELECT content_hash FROM ingestion_log')
+    hashes = {row[0] for row in cursor.fetchall()}
+    conn.close()
+
+    return hashes
+
+def is_content_ingested(content_hash, exclude_failed=False):
+    """Проверяет, принимался ли уже файл с таким содержимым."""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT 1 FROM uploaded_files WHERE content_hash = ? LIMIT 1', (content_hash,))
+    found = cursor.fetchone() is not None
+    if not found:
+        cursor.execute(
+            "SELECT 1 FROM ingestion_log WHERE content_hash = ?" + (" AND status != 'failed'" if exclude_failed else ''),
+            (content_hash,)
+        )
+        found = cursor.fetchone() is not None
+    conn.close()
+
+    return found
+
+def iter_stored_extractions(batch_size=200, file_ids=None):
+    """Генератор пачек [(file_id, ответ модели, источник), ...] для переобработки.
+    
+    Источник 'raw' — сохранённый ответ модели. У файлов, загруженных до появления
+    raw_extractions, ответ восстанавливается из полей их транзакций (источник 'rows').
+    """
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cursor = conn.cursor()
+        where, params = '', []
+        if file_ids:
+            where = f"AND f.id IN ({', '.join('?' * len(file_ids))})"
+            params = list(file_ids)
+        after_id = 0
+        while True:
+            rows = cursor.execute(f'''
+                SELECT f.id, r.data FROM uploaded_files f
+                LEFT JOIN raw_extractions r ON r.file_id = f.id
+                WHERE f.id > ? {where}
+                ORDER BY f.id
+                LIMIT ?
+            ''', [after_id] + params + [batch_size]).fetchall()
+            if not rows:
+                break
+            after_id = rows[-1][0]
+            
+            legacy_ids = [file_id for file_id, data in rows if data is None]
+            legacy = {}
+            if legacy_ids:
+                columns = [column for column in TRANSACTION_FIELD_COLUMNS.values() if column != 'account']
+                cursor.execute(
+                    f"SELECT file_id, {', '.join(columns)} FROM transactions "
+                    f"WHERE file_id IN ({', '.join('?' * len(legacy_ids))}) ORDER BY id",
+                    legacy_ids
+                )
+                for file_id, *values in cursor.fetchall():
+                    legacy.setdefault(file_id, []).append(dict(zip(TRANSACTION_FIELD_COLUMNS, values)))
+            
+            batch = []
+            for file_id, data in rows:
+                if data is not None:
+                    batch.append((file_id, decompress_extraction(data), 'raw'))
+                elif file_id in legacy:
+                    batch.append((file_id, legacy[file_id], 'rows'))
+            if batch:
+                yield batch
+    finally:
+        conn.close()
+
+def replace_file_transactions(results, dry_run=False):
+    """Записывает результат переобработки пачки файлов одной транзакцией БД.
+    
+    results — список (file_id, успешные транзакции после классификации). Строки
+    обновляются на месте по порядку, чтобы id транзакций не менялись; если число
+    транзакций изменилось, строки файла пересоздаются.
+    
+    Returns:
+        Число транзакций, у которых изменились счёт, аномалии или контрагент
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    changed = 0
+    
+    try:
+        for file_id, transactions in results:
+            old_rows = cursor.execute(
+                'SELECT id, account, is_anomaly, anomaly_mask, counterparty_id FROM transactions WHERE file_id = ? ORDER BY id',
+                (file_id,)
+            ).fetchall()
+            new_values = [_transaction_values(cursor, transaction) for transaction in transactions]
+            if len(old_rows) == len(new_values):
+                updates = []
+                for (row_id, *old_derived), values in zip(old_rows, new_values):
+                    if tuple(old_derived) != values[5:]:
+                        changed += 1
+                    updates.append(values + (row_id,))
+                cursor.executemany('''
+                    UPDATE transactions SET inn = ?, counterparty = ?, amount = ?, date = ?, purpose = ?, account = ?,
+                    is_anomaly = ?, anomaly_mask = ?, counterparty_id = ?
+                    WHERE id = ?
+                ''', updates)
+            else:
+                changed += len(new_values)
+                cursor.execute('DELETE FROM transactions WHERE file_id = ?', (file_id,))
+                cursor.executemany(INSERT_TRANSACTION_SQL, [(file_id,) + values for values in new_values])
+            cursor.execute('UPDATE raw_extractions SET reprocessed_at = CURRENT_TIMESTAMP WHERE file_id = ?', (file_id,))
+        
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        counterparty_resolver.clear()
+        raise
+    finally:
+        conn.close()
+    
+    if dry_run:
+        # Контрагенты, созданные в откатанной транзакции, не должны остаться в кэше
+        counterparty_resolver.clear()
+    return changed
+
+# Столбцы транзакций, доступные через API и выгрузки
+TRANSACTION_COLUMNS = [
+    'id', 'file_id', 'inn', 'counterparty', 'counterparty_id', 'amount', 'date', 'purpose',
+    'account', 'is_anomaly', 'anomaly_mask', 'anomaly_reasons', 'created_at'
+]
+
+# Вычисляемые столбцы: anomaly_reasons выбирается как маска и превращается в подписи при выдаче
+COLUMN_EXPRESSIONS = {
+    'anomaly_reasons': 'anomaly_mask AS anomaly_reasons',
+}
+
+def _select_list(columns):
+    return ", ".join(COLUMN_EXPRESSIONS.get(column, column) for column in columns)
+
+def _transaction_filters(file_id=None, date_from=None, date_to=None, anomalies_only=False, counterparty_id=None,
+                         anomaly_code=None):
+    """Собирает WHERE-условие выборки транзакций. Даты — по времени загрузки (created_at)."""
+    conditions = []
+    params = []
+    if file_id is not None:
+        conditions.append('file_id = ?')
+        params.append(file_id)
+    if counterparty_id is not None:
+        conditions.append('counterparty_id = ?')
+        params.append(counterparty_id)
+    if date_from:
+        conditions.append('created_at >= ?')
+        params.append(date_from)
+    if date_to:
+        # Дата без времени включает весь день
+        conditions.append('created_at < ?' if len(date_to) > 10 else "created_at < date(?, '+1 day')")
+        params.append(date_to)
+    if anomalies_only:
+        conditions.append('is_anomaly = 1')
+    if anomaly_code:
+        # anomaly_mask != 0 позволяет использовать частичный индекс idx_transactions_anomaly_mask
+        conditions.append('anomaly_mask != 0 AND (anomaly_mask & ?) != 0')
+        params.append(anomaly_bit(anomaly_code))
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    return where, params
+
+def get_anomaly_counts(**filters):
+    """Число транзакций по каждой причине аномалии, посчитанное в SQL по битам маски."""
+    where, params = _transaction_filters(**filters)
+    where = (where + ' AND anomaly_mask != 0') if where else 'WHERE anomaly_mask != 0'
+    sums = ", ".join(
+        f"COALESCE(SUM((anomaly_mask & {bit}) != 0), 0)" for bit, _ in ANOMALY_CODES.values()
+    )
+
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    row = cursor.execute(f'SELECT COUNT(*), {sums} FROM transactions {where}', params).fetchone()
+    conn.close()
+
+    counts = {'total': row[0]}
+    counts.update(zip(ANOMALY_CODES, row[1:]))
+    return counts
+
+def get_files_page(limit=50, offset=0):
+    """Получает страницу списка файлов и общее количество файлов."""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+
+    total = cursor.execute('SELECT COUNT(*) FROM uploaded_files').fetchone()[0]
+    cursor.execute('''
+        SELECT f.*, (SELECT COUNT(*) FROM transactions t WHERE t.file_id = f.id) as transaction_count
+        FROM uploaded_files f
+        ORDER BY f.upload_date DESC, f.id DESC
+        LIMIT ? OFFSET ?
+    ''', (limit, offset))
+
+    files = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+
+    return files, total
+
+def get_file(file_id):
+    """Получает метаданные одного файла без транзакций."""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT f.*, (SELECT COUNT(*) FROM transactions t WHERE t.file_id = f.id) as transaction_count
+        FROM uploaded_files f
+        WHERE f.id = ?
+    ''', (file_id,))
+    row = cursor.fetchone()
+    conn.close()
+
+    return dict(row) if row else None
+
+def get_counterparties_page(limit=50, offset=0, query=None):
+    """Страница справочника контрагентов с числом транзакций и вариантами названий."""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+
+    where, params = '', []
+    if query:
+        where = 'WHERE c.inn LIKE ? OR c.id IN (SELECT counterparty_id FROM counterparty_aliases WHERE alias LIKE ?)'
+        params = [f'{query}%', f'%{query.casefold()}%']
+    total = cursor.execute(f'SELECT COUNT(*) FROM counterparties c {where}', params).fetchone()[0]
+    cursor.execute(f'''
+        SELECT c.*,
+               (SELECT COUNT(*) FROM transactions t WHERE t.counterparty_id = c.id) as transaction_count,
+               (SELECT GROUP_CONCAT(DISTINCT t.counterparty) FROM transactions t WHERE t.counterparty_id = c.id) as name_variants
+        FROM counterparties c
+        {where}
+        ORDER BY transaction_count DESC, c.id
+        LIMIT ? OFFSET ?
+    ''', params + [limit, offset])
+
+    counterparties = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+
+    return counterparties, total
+
+def get_transactions_page(columns, after_id=0, limit=100, **filters):
+    """Получает страницу транзакций после after_id (keyset-пагинация по id)."""
+    where, params = _transaction_filters(**filters)
+    where = (where + ' AND id > ?') if where else 'WHERE id > ?'
+
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+
+    cursor.execute(
+        f'SELECT {_select_list(columns)} FROM transactions {where} ORDER BY id LIMIT ?',
+        params + [after_id, limit]
+    )
+
+    transactions = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+
+    return transactions
+
+def iter_transactions(columns, chunk_size=1000, **filters):
+    """Генератор транзакций частями по chunk_size строк с серверного курсора.
+
+    Строки не накапливаются в памяти, поэтому выгрузка любого объёма
+    занимает постоянную память.
+    """
+    where, params = _transaction_filters(**filters)
+
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {_select_list(columns)} FROM transactions {where} ORDER BY id', params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+# Дата операции (ДД.ММ.ГГГГ) в виде ГГГГ-ММ-ДД для сравнения; даты в другом формате дают NULL
+OPERATION_DATE_SQL = (
+    "CASE WHEN t.date GLOB '[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]' "
+    "THEN substr(t.date, 7, 4) || '-' || substr(t.date, 4, 2) || '-' || substr(t.date, 1, 2) END"
+)
+# Сумма операции числом: без пробелов-разделителей разрядов, с точкой вместо запятой
+AMOUNT_SQL = "CAST(REPLACE(REPLACE(REPLACE(t.amount, ' ', ''), char(160), ''), ',', '.') AS REAL)"
+
+def _search_filters(match=None, counterparty_ids=None, inn=None, operation_from=None, operation_to=None,
+                    operation_month=None):
+    """WHERE-условие поиска транзакций для чата. Период — по дате операции, а не загрузки.
+    
+    match — запрос FTS5; без полнотекстового индекса игнорируется.
+    """
+    conditions = []
+    params = []
+    if match and FULLTEXT_AVAILABLE:
+        conditions.append('t.id IN (SELECT rowid FROM transactions_fts WHERE transactions_fts MATCH ?)')
+        params.append(match)
+    if counterparty_ids:
+        conditions.append(f"t.counterparty_id IN ({', '.join('?' * len(counterparty_ids))})")
+        params.extend(counterparty_ids)
+    if inn:
+        conditions.append('t.inn = ?')
+        params.append(inn)
+    if operation_from:
+        conditions.append(f'{OPERATION_DATE_SQL} >= ?')
+        params.append(operation_from)
+    if operation_to:
+        conditions.append(f'{OPERATION_DATE_SQL} <= ?')
+        params.append(operation_to)
+    if operation_month:
+        conditions.append("t.date GLOB '[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]' AND substr(t.date, 4, 2) = ?")
+        params.append(f'{operation_month:02d}')
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    return where, params
+
+def find_counterparty_aliases(stems, limit=200):
+    """Псевдонимы контрагентов, содержащие любую из основ слов: [(псевдоним, id, название)]"""
+    if not stems:
+        return []
+    conditions = ' OR '.join('a.alias LIKE ?' for _ in stems)
+    conn = sqlite3.connect(DB_PATH)
+    rows = conn.execute(f'''
+        SELECT a.alias, c.id, c.name FROM counterparty_aliases a
+        JOIN counterparties c ON c.id = a.counterparty_id
+        WHERE {conditions}
+        LIMIT ?
+    ''', [f'%{stem}%' for stem in stems] + [limit]).fetchall()
+    conn.close()
+    return rows
+
+def count_fulltext_matches(queries):
+    """Число транзакций под каждый запрос FTS5 и общее число транзакций: ({запрос: число}, всего)"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    total = cursor.execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+    counts = {}
+    if FULLTEXT_AVAILABLE:
+        for query in queries:
+            counts[query] = cursor.execute(
+                'SELECT COUNT(*) FROM transactions_fts WHERE transactions_fts MATCH ?', (query,)
+            ).fetchone()[0]
+    conn.close()
+    return counts, total
+
+def get_transaction_aggregates(top_counterparties=5, **filters):
+    """Итоги по отобранным транзакциям, посчитанные в SQL: число, сумма, период и крупнейшие контрагенты."""
+    where, params = _search_filters(**filters)
+
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    count, total, anomalies, first_date, last_date = cursor.execute(f'''
+        SELECT COUNT(*), COALESCE(SUM({AMOUNT_SQL}), 0), COALESCE(SUM(t.is_anomaly), 0),
+               MIN({OPERATION_DATE_SQL}), MAX({OPERATION_DATE_SQL})
+        FROM transactions t {where}
+    ''', params).fetchone()
+    by_counterparty = cursor.execute(f'''
+        SELECT COALESCE(c.name, MAX(t.counterparty)), COUNT(*), SUM({AMOUNT_SQL}) AS total
+        FROM transactions t LEFT JOIN counterparties c ON c.id = t.counterparty_id
+        {where}
+        GROUP BY COALESCE(t.counterparty_id, t.counterparty)
+        ORDER BY total DESC
+        LIMIT ?
+    ''', params + [top_counterparties]).fetchall() if count else []
+    conn.close()
+
+    return {
+        'count': count,
+        'total': total,
+        'anomalies': anomalies,
+        'first_date': first_date,
+        'last_date': last_date,
+        'by_counterparty': [
+            {'name': name, 'count': rows, 'total': amount or 0.0} for name, rows, amount in by_counterparty
+        ],
+    }
+
+def search_transactions(limit=20, match=None, **filters):
+    """Наиболее подходящие транзакции: по рангу BM25 при текстовом запросе, иначе самые свежие операции."""
+    columns = 't.date, t.counterparty, t.inn, t.amount, t.purpose, t.account, t.is_anomaly'
+    where, params = _search_filters(**filters)
+    if match and FULLTEXT_AVAILABLE:
+        # Ранг берётся из индекса; отборы по контрагенту и периоду применяются к найденному
+        where = 'WHERE transactions_fts MATCH ?' + (' AND ' + where[len('WHERE '):] if where else '')
+        query = f'''
+            SELECT {columns} FROM transactions_fts JOIN transactions t ON t.id = transactions_fts.rowid
+            {where}
+            ORDER BY bm25(transactions_fts), t.id DESC
+            LIMIT ?
+        '''
+        params = [match] + params
+    else:
+        query = f'''
+            SELECT {columns} FROM transactions t {where}
+            ORDER BY {OPERATION_DATE_SQL} DESC, t.id DESC
+            LIMIT ?
+        '''
+
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    rows = [dict(row) for row in conn.execute(query, params + [limit]).fetchall()]
+    conn.close()
+    return rows
+
 init_database()
@@ -1,11 +1,23 @@
+import asyncio
 import base64
+import hashlib
 import json
+import logging
+import os
 import re
+import tempfile
 from pathlib import Path
-import google.generativeai as genai
-from config import GEMINI_API_KEY
+from threading import Lock
+from config import (
+    INLINE_PAYLOAD_MAX_BYTES, IMAGE_PREPROCESSING, PDF_RASTERIZE, TRIAGE_ENABLED, TRIAGE_REJECT_IRRELEVANT
+)
+from modules import image_preprocessing
+from modules.triage import triage_document, pdf_page_count
+from modules.json_stream import JsonArrayStreamParser
+from modules.model_client import stream_content, stream_content_async, upload_file
+from modules.tracing import span
 
-genai.configure(api_key=GEMINI_API_KEY)
+logger = logging.getLogger(__name__)
 
 def clean_json_response(text):
     """Очищает ответ от markdown форматирования и извлекает JSON."""
@@ -17,27 +29,138 @@ def clean_json_response(text):
     
     return text
 
-def extract_invoice_data(file_path):
-    """Извлекает реквизиты из PDF или изображения счёта через Gemini API.
-    Может извлекать как одну, так и несколько транзакций."""
-    file = Path(file_path)
-    
-    file_ext = file.suffix.lower() if file.suffix else ""
+def file_content_hash(file_path, chunk_size=1024 * 1024):
+    """SHA-256 содержимого файла, читаемого частями."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def guess_mime_type(file_path):
+    """Определяет MIME-тип документа по расширению."""
+    file_ext = Path(file_path).suffix.lower()
     
     if file_ext == ".pdf":
-        mime_type = "application/pdf"
+        return "application/pdf"
     elif file_ext in ['.jpg', '.jpeg']:
-        mime_type = "image/jpeg"
+        return "image/jpeg"
     elif file_ext == '.png':
-        mime_type = "image/png"
+        return "image/png"
     else:
-        mime_type = "application/pdf"
+        return "application/pdf"
 
-    with open(file, "rb") as f:
-        data = f.read()
-    base64_data = base64.b64encode(data).decode("utf-8")
+class DocumentPayload:
+    """Представление документа для модели, общее для всех вызовов по одному файлу.
+    
+    Изображения (и при PDF_RASTERIZE — страницы PDF) сначала уменьшаются
+    и пересжимаются. Небольшие результаты кодируются в base64 один раз,
+    крупные загружаются через File API, и дальше передаётся только ссылка на них.
+    """
+    def __init__(self, file_path, mime_type=None, preprocess=IMAGE_PREPROCESSING, rasterize_pdf=PDF_RASTERIZE):
+        self.path = Path(file_path)
+        self.mime_type = mime_type or guess_mime_type(file_path)
+        self.size = self.path.stat().st_size
+        self.preprocess = preprocess and image_preprocessing.is_available()
+        self.rasterize_pdf = rasterize_pdf
+        self.lock = Lock()
+        self.part = None
+        # Размер и тип того, что реально отправлено модели (после подготовки)
+        self.payload_bytes = None
+        self.payload_mime_type = None
+        self._page_count = None
+        self._triage = None
+    
+    @property
+    def page_count(self):
+        """Число страниц: для PDF — из сортировки или pypdfium2 (файл в память не читается),
+        изображение — одна страница. None, если посчитать нечем."""
+        if self._page_count is None:
+            if self.mime_type != "application/pdf":
+                self._page_count = 1
+            elif self._triage is not None and self._triage.get("pages"):
+                self._page_count = self._triage["pages"]
+            else:
+                self._page_count = pdf_page_count(self.path)
+        return self._page_count
+    
+    def triage(self):
+        """Результат локальной сортировки документа (modules.triage), считается один раз"""
+        if not TRIAGE_ENABLED:
+            return None
+        if self._triage is None:
+            with span("triage") as triage_span:
+                self._triage = triage_document(self.path)
+                triage_span.set(label=self._triage.get("label"), rows=self._triage.get("rows"))
+        return self._triage
+    
+    def usage_info(self, operation):
+        """Сведения о документе для учёта расхода модели"""
+        return {
+            "operation": operation,
+            "document": self.path.name,
+            "file_type": self.path.suffix.lower(),
+            "pages": self.page_count,
+            "document_bytes": self.size,
+        }
+    
+    def _needs_preparation(self):
+        if not self.preprocess:
+            return False
+        return self.mime_type.startswith("image/") or (self.rasterize_pdf and self.mime_type == "application/pdf")
+    
+    def _prepare(self, raw):
+        """Уменьшенное содержимое документа: (байты, MIME-тип). При ошибке — исходный файл"""
+        try:
+            if self.mime_type.startswith("image/"):
+                data, mime_type = image_preprocessing.preprocess_image(raw)
+                return data, mime_type or self.mime_type
+            data, _ = image_preprocessing.rasterize_pdf(raw)
+            return data, self.mime_type
+        except Exception:
+            logger.warning("Не удалось подготовить %s, отправляется исходный файл", self.path.name, exc_info=True)
+            return raw, self.mime_type
+    
+    def _upload_bytes(self, data, mime_type):
+        """Загрузка подготовленного содержимого через File API из временного файла"""
+        fd, tmp_path = tempfile.mkstemp(suffix=self.path.suffix)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            return upload_file(tmp_path, mime_type, usage=self.usage_info("file_upload"))
+        finally:
+            os.unlink(tmp_path)
+    
+    def as_part(self):
+        """Часть запроса generate_content с содержимым документа"""
+        with self.lock:
+            if self.part is None:
+                with span("payload.prepare", document_bytes=self.size) as prepare_span:
+                    self.part = self._build_part()
+                    prepare_span.set(payload_bytes=self.payload_bytes, inline=isinstance(self.part, dict))
+            return self.part
+    
+    def _build_part(self):
+        if self.size > INLINE_PAYLOAD_MAX_BYTES and not self._needs_preparation():
+            self.payload_bytes, self.payload_mime_type = self.size, self.mime_type
+            return upload_file(self.path, self.mime_type, usage=self.usage_info("file_upload"))
+        with open(self.path, "rb") as f:
+            raw = f.read()
+        data, mime_type = self._prepare(raw) if self._needs_preparation() else (raw, self.mime_type)
+        self.payload_bytes, self.payload_mime_type = len(data), mime_type
+        if len(data) <= INLINE_PAYLOAD_MAX_BYTES:
+            return {"mime_type": mime_type, "data": base64.b64encode(data).decode("utf-8")}
+        if data is raw:
+            return upload_file(self.path, mime_type, usage=self.usage_info("file_upload"))
+        return self._upload_bytes(data, mime_type)
+    
+    async def as_part_async(self):
+        """То же, что as_part, без блокировки цикла событий чтением файла или загрузкой"""
+        if self.part is not None:
+            return self.part
+        return await asyncio.to_thread(self.as_part)
 
-    prompt = """
+EXTRACTION_PROMPT = """
     Ты бухгалтерский ИИ. Проанализируй этот документ и найди ВСЕ транзакции/операции в нем.
     
     Верни JSON массив, где каждый элемент содержит данные одной транзакции:
@@ -65,14 +188,52 @@ def extract_invoice_data(file_path):
     ]
     """
 
-    model = genai.GenerativeModel("gemini-2.5-flash")
-    response = model.generate_content([
-        {"mime_type": mime_type, "data": base64_data},
-        {"text": prompt}
-    ])
+# Подсказки к запросу извлечения по метке сортировки документа
+EXTRACTION_HINTS = {
+    "invoice": "Это счёт, счёт-фактура или платёжное поручение: контрагент — поставщик (получатель платежа).",
+    "statement": "Это выписка или реестр операций: каждая операция — отдельная транзакция, не пропускай ни одной.",
+    "act": "Это акт выполненных работ или оказанных услуг: контрагент — исполнитель, сумма — итог по акту.",
+}
+
+def extraction_prompt(triage=None):
+    """Запрос извлечения с подсказкой по типу документа и ожидаемому числу транзакций"""
+    hint = EXTRACTION_HINTS.get(triage["label"]) if triage else None
+    if not hint:
+        return EXTRACTION_PROMPT
+    if triage.get("rows") and triage["rows"] > 1:
+        hint += f" Ожидается около {triage['rows']} транзакций."
+    return f"{EXTRACTION_PROMPT}\n    {hint}\n"
+
+def rejection_entry(triage):
+    """Запись об ошибке для документа, отклонённого сортировкой; None — документ нужно извлекать"""
+    if not TRIAGE_REJECT_IRRELEVANT or not triage or triage["label"] != "irrelevant":
+        return None
+    return {
+        "error": "Документ не похож на финансовый (счёт, выписку или акт) и не отправлялся на извлечение",
+        "rejected": True,
+        "triage": triage,
+    }
+
+TRANSACTION_FIELDS = ["ИНН поставщика", "Название контрагента", "Сумма", "Дата", "Назначение платежа"]
 
+# Схема структурированного ответа: массив транзакций с фиксированным набором полей
+EXTRACTION_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {field: {"type": "STRING", "nullable": True} for field in TRANSACTION_FIELDS},
+        "required": TRANSACTION_FIELDS,
+    },
+}
+EXTRACTION_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": EXTRACTION_SCHEMA,
+}
+
+def parse_extraction_response(text):
+    """Разбирает ответ модели в список транзакций."""
     try:
-        cleaned_text = clean_json_response(response.text)
+        cleaned_text = clean_json_response(text)
         result = json.loads(cleaned_text)
         
         if not isinstance(result, list):
@@ -83,6 +244,104 @@ def extract_invoice_data(file_path):
     except json.JSONDecodeError as e:
         return [{
             "error": f"Не удалось распарсить JSON: {str(e)}", 
-            "raw_output": response.text,
-            "cleaned_output": clean_json_response(response.text)
+            "raw_output": text,
+            "cleaned_output": clean_json_response(text)
         }]
+
+def _stream_tail(parser):
+    """Записи об ошибках, которые добавляются после окончания потока"""
+    if not parser.started:
+        # Ответ оказался не массивом (например, одним объектом) — разбираем его целиком
+        return parse_extraction_response(parser.raw_text)
+    tail = [
+        {"error": "Некорректная транзакция в ответе модели", "raw_output": fragment}
+        for fragment in parser.invalid_fragments
+    ]
+    if not parser.complete:
+        tail.append({
+            "error": f"Ответ модели обрезан после {parser.objects_parsed} транзакций",
+            "partial": True,
+            "raw_output": parser.raw_text
+        })
+    return tail
+
+def _stream_failure(parser, error):
+    """Запись об обрыве потока; без единой полученной транзакции ошибка выбрасывается дальше"""
+    if parser.objects_parsed == 0:
+        raise error
+    return {
+        "error": f"Ответ модели оборвался после {parser.objects_parsed} транзакций: {error}",
+        "partial": True
+    }
+
+def iter_invoice_transactions(file_path, payload=None):
+    """Генератор транзакций документа по мере их поступления в потоковом ответе модели.
+
+    Сначала документ сортируется локально: нефинансовые документы отклоняются
+    без вызова модели, для остальных тип документа уточняет запрос.
+    Ответ ограничен схемой EXTRACTION_SCHEMA. При обрыве или обрезке ответа
+    уже полученные транзакции сохраняются, а последним элементом идёт запись с "error".
+    """
+    if payload is None:
+        payload = DocumentPayload(file_path)
+
+    triage = payload.triage()
+    rejected = rejection_entry(triage)
+    if rejected:
+        yield rejected
+        return
+
+    parser = JsonArrayStreamParser()
+    try:
+        for text in stream_content(
+            [payload.as_part(), {"text": extraction_prompt(triage)}],
+            usage=payload.usage_info("extraction"),
+            generation_config=EXTRACTION_GENERATION_CONFIG
+        ):
+            yield from parser.feed(text)
+    except Exception as e:
+        yield _stream_failure(parser, e)
+        return
+    yield from _stream_tail(parser)
+
+async def iter_invoice_transactions_async(file_path, payload=None):
+    """Асинхронный вариант iter_invoice_transactions."""
+    if payload is None:
+        payload = DocumentPayload(file_path)
+
+    triage = await asyncio.to_thread(payload.triage)
+    rejected = rejection_entry(triage)
+    if rejected:
+        yield rejected
+        return
+
+    part = await payload.as_part_async()
+    parser = JsonArrayStreamParser()
+    try:
+        async for text in stream_content_async(
+            [part, {"text": extraction_prompt(triage)}],
+            usage=payload.usage_info("extraction"),
+            generation_config=EXTRACTION_GENERATION_CONFIG
+        ):
+            for transaction in parser.feed(text):
+                yield transaction
+    except Exception as e:
+        yield _stream_failure(parser, e)
+        return
+    for entry in _stream_tail(parser):
+        yield entry
+
+def extract_invoice_data(file_path, payload=None):
+    """Извлекает реквизиты из PDF или изображения счёта через Gemini API.
+    Может извлекать как одну, так и несколько транзакций."""
+    with span("extraction", document=Path(file_path).name) as extraction_span:
+        transactions = list(iter_invoice_transactions(file_path, payload))
+        extraction_span.set(entries=len(transactions))
+        return transactions
+
+async def extract_invoice_data_async(file_path, payload=None):
+    """Асинхронный вариант extract_invoice_data для asyncio-конвейера."""
+    with span("extraction", document=Path(file_path).name) as extraction_span:
+        transactions = [transaction async for transaction in iter_invoice_transactions_async(file_path, payload)]
+        extraction_span.set(entries=len(transactions))
+        return transactions
@@ -0,0 +1,104 @@
+"""
+Выгрузка транзакций в CSV, XLSX и Parquet.
+Данные читаются из базы частями, поэтому память не зависит от объёма выгрузки.
+CSV отдаётся по мере чтения; XLSX и Parquet сначала собираются во временном
+файле (формат требует оглавления в конце), затем файл отдаётся частями.
+"""
+import csv
+import io
+import os
+import tempfile
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+# Столбцы, которые в Parquet пишутся целыми числами, остальные — строками
+INTEGER_COLUMNS = {'id', 'file_id', 'counterparty_id', 'is_anomaly', 'anomaly_mask'}
+
+class ExportUnavailableError(Exception):
+    """Для формата выгрузки не установлена нужная библиотека"""
+
+def stream_csv(chunks, columns):
+    """Генератор CSV-текста: заголовок и затем по одному блоку на порцию строк"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM, чтобы Excel правильно открыл кириллицу
+    buffer.write('\ufeff')
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def _stream_file(path, chunk_size=64 * 1024):
+    """Отдаёт временный файл частями и удаляет его после отправки"""
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(chunk_size), b''):
+                yield block
+    finally:
+        os.unlink(path)
+
+def _build_file(suffix, write):
+    """Временный файл, заполненный write(path); при ошибке файл удаляется"""
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        write(path)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
+
+def build_xlsx(chunks, columns):
+    """XLSX через write-only режим openpyxl: строки сразу сбрасываются на диск.
+    Книга собирается целиком до отправки первого байта"""
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise ExportUnavailableError("Для выгрузки в XLSX установите пакет openpyxl")
+
+    def write(path):
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('Транзакции')
+        sheet.append(columns)
+        for rows in chunks:
+            for row in rows:
+                sheet.append(list(row))
+        workbook.save(path)
+
+    return _stream_file(_build_file('.xlsx', write))
+
+def build_parquet(chunks, columns):
+    """Parquet через pyarrow: каждая порция строк пишется отдельной row group.
+    Файл собирается целиком до отправки первого байта"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportUnavailableError("Для выгрузки в Parquet установите пакет pyarrow")
+
+    schema = pa.schema([
+        (name, pa.int64() if name in INTEGER_COLUMNS else pa.string())
+        for name in columns
+    ])
+
+    def write(path):
+        with pq.ParquetWriter(path, schema) as writer:
+            for rows in chunks:
+                data = {name: [row[i] for row in rows] for i, name in enumerate(columns)}
+                writer.write_table(pa.Table.from_pydict(data, schema=schema))
+
+    return _stream_file(_build_file('.parquet', write))
+
+EXPORTERS = {
+    'csv': stream_csv,
+    'xlsx': build_xlsx,
+    'parquet': build_parquet,
+}
@@ -0,0 +1,128 @@
+"""
+Локальный бэкенд-заглушка вместо Gemini API для тестов и нагрузочных прогонов.
+Имитирует задержки, троттлинг (429) и недоступность сервиса (503).
+
+Задержка — равномерная в диапазоне или логнормальная (медиана и 99-й перцентиль),
+вызовы с документом можно замедлить относительно текстовых.
+"""
+import asyncio
+import json
+import math
+import random
+import time
+from types import SimpleNamespace
+from config import (
+    FAKE_BACKEND_LATENCY, FAKE_BACKEND_FAILURE_RATE, FAKE_BACKEND_LATENCY_DIST, FAKE_BACKEND_DOCUMENT_FACTOR
+)
+from modules.usage_accounting import contents_size
+
+class FakeBackendError(Exception):
+    """Временная ошибка бэкенда с HTTP-кодом"""
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens=0):
+        self.text = text
+        # Грубая оценка токенов, около 4 байт на токен, в том же виде, что и у Gemini
+        response_tokens = len(text.encode("utf-8")) // 4
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=response_tokens,
+            total_token_count=prompt_tokens + response_tokens
+        )
+
+FAKE_TRANSACTION = {
+    "ИНН поставщика": "7707083893",
+    "Название контрагента": "ООО Ромашка",
+    "Сумма": "10000",
+    "Дата": "01.01.2024",
+    "Назначение платежа": "Оплата по счет-фактуре №1"
+}
+
+def has_document(contents):
+    """Есть ли среди частей запроса файл"""
+    return isinstance(contents, list) and any(
+        isinstance(part, dict) and "mime_type" in part for part in contents
+    )
+
+# z-оценка 99-го перцентиля стандартного нормального распределения
+Z_99 = 2.326
+
+def default_responder(model_name, contents):
+    """Ответ по умолчанию: транзакции для документов, текст для вопросов"""
+    prompt = contents if isinstance(contents, str) else " ".join(
+        part.get("text", "") for part in contents if isinstance(part, dict)
+    )
+    if has_document(contents) and "JSON" in prompt:
+        return json.dumps([FAKE_TRANSACTION], ensure_ascii=False)
+    return f"Тестовый ответ модели {model_name}."
+
+class FakeGeminiBackend:
+    STREAM_CHUNK_SIZE = 32
+
+    def __init__(self, latency=FAKE_BACKEND_LATENCY, failure_rate=FAKE_BACKEND_FAILURE_RATE,
+                 responder=default_responder, distribution=FAKE_BACKEND_LATENCY_DIST,
+                 document_factor=FAKE_BACKEND_DOCUMENT_FACTOR):
+        # Задержка ответа в секундах: (min, max) для uniform, (медиана, p99) для lognormal
+        self.latency = latency
+        self.distribution = distribution
+        self.document_factor = document_factor
+        # Доля вызовов, завершающихся временной ошибкой
+        self.failure_rate = failure_rate
+        self.responder = responder
+        self.calls = 0
+
+    def _delay(self, contents):
+        if self.distribution == "lognormal":
+            median, p99 = self.latency
+            sigma = math.log(max(p99, median) / median) / Z_99
+            delay = random.lognormvariate(math.log(median), sigma)
+        else:
+            delay = random.uniform(*self.latency)
+        return delay * self.document_factor if has_document(contents) else delay
+
+    def generate(self, model_name, contents, timeout=None, **kwargs):
+        self.calls += 1
+        delay = self._delay(contents)
+        if timeout and delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"Fake backend timed out after {timeout}s")
+        time.sleep(delay)
+        return self._respond(model_name, contents)
+
+    async def generate_async(self, model_name, contents, timeout=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self._delay(contents))
+        return self._respond(model_name, contents)
+
+    def stream(self, model_name, contents, timeout=None, **kwargs):
+        response = self.generate(model_name, contents, timeout=timeout, **kwargs)
+        return self._chunks(response)
+
+    async def stream_async(self, model_name, contents, timeout=None, **kwargs):
+        response = await self.generate_async(model_name, contents, timeout=timeout, **kwargs)
+
+        async def chunks():
+            for chunk in self._chunks(response):
+                yield chunk
+        return chunks()
+
+    def _chunks(self, response):
+        """Ответ фрагментами по STREAM_CHUNK_SIZE символов, токены — в последнем фрагменте"""
+        text = response.text
+        pieces = [text[i:i + self.STREAM_CHUNK_SIZE] for i in range(0, len(text), self.STREAM_CHUNK_SIZE)] or [""]
+        for i, piece in enumerate(pieces):
+            chunk = FakeResponse(piece)
+            if i == len(pieces) - 1:
+                chunk.usage_metadata = response.usage_metadata
+            yield chunk
+
+    def _respond(self, model_name, contents):
+        if random.random() < self.failure_rate:
+            raise FakeBackendError("Resource exhausted", random.choice([429, 503]))
+        return FakeResponse(self.responder(model_name, contents), contents_size(contents) // 4)
+
+    def upload_file(self, path, mime_type):
+        return {"mime_type": mime_type, "file_uri": f"fake://{path}"}
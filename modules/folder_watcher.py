@@ -0,0 +1,232 @@
+"""
+Наблюдатель за папкой: новые документы автоматически проходят полный конвейер.
+
+- События файловой системы через watchdog (inotify), если он установлен,
+  иначе периодический обход папки
+- Файл берётся в работу, только когда его размер и время изменения
+  не меняются settle_seconds (дописываемые файлы не читаются)
+- Ограниченная очередь и фиксированное число воркеров: когда воркеры заняты,
+  обход папки ждёт освобождения очереди
+- Каждый обработанный файл отмечается в ingestion_log по хэшу содержимого,
+  поэтому после перезапуска он не обрабатывается повторно
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from modules.database import (
+    record_ingestion, get_ingested_hashes, get_processed_content_hashes, is_content_ingested
+)
+from modules.document_parser import file_content_hash
+from modules.pipeline import process_document_file
+from modules.stats_tracker import stats_tracker
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = {".pdf", ".jpg", ".jpeg", ".png"}
+
+def is_candidate(path):
+    """Поддерживаемый документ, не скрытый и не временный файл загрузки"""
+    name = Path(path).name
+    return not name.startswith(".") and Path(name).suffix.lower() in SUPPORTED_EXTENSIONS
+
+class _EventHandler(FileSystemEventHandler):
+    """Передаёт пути из событий файловой системы наблюдателю"""
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher.notify(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.notify(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.watcher.notify(event.dest_path)
+
+class FolderWatcher:
+    def __init__(self, folder, max_workers=2, queue_size=8, settle_seconds=2.0,
+                 poll_interval=1.0, use_inotify=True, rescan_interval=60.0, retry_failed=False):
+        self.folder = Path(folder)
+        self.max_workers = max_workers
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and Observer is not None
+        # Даже с inotify папка изредка обходится целиком: события на сетевых дисках теряются
+        self.rescan_interval = rescan_interval if self.use_inotify else poll_interval
+        self.retry_failed = retry_failed
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        # Пути, о которых сообщили события: проверяются на следующем цикле
+        self.notified = set()
+        # Файлы, ждущие стабилизации: путь -> (размер, mtime, с какого момента не менялись)
+        self.pending = {}
+        # Уже рассмотренные файлы: путь -> (размер, mtime), чтобы не хэшировать их повторно
+        self.handled = {}
+        self.known_hashes = set()
+        self.threads = []
+        self.observer = None
+
+    def notify(self, path):
+        if is_candidate(path):
+            with self.lock:
+                self.notified.add(Path(path))
+
+    def scan(self):
+        """Все подходящие файлы в папке (без подкаталогов).
+        Удалённые файлы забываются, чтобы handled не рос всё время работы демона"""
+        try:
+            with os.scandir(self.folder) as entries:
+                paths = [Path(e.path) for e in entries if e.is_file() and is_candidate(e.name)]
+        except FileNotFoundError:
+            paths = []
+        present = set(paths)
+        self.handled = {path: signature for path, signature in self.handled.items() if path in present}
+        return paths
+
+    def check_settled(self, paths, now):
+        """Возвращает файлы, которые не менялись settle_seconds"""
+        ready = []
+        for path in paths:
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                self.pending.pop(path, None)
+                continue
+            signature = (st.st_size, st.st_mtime_ns)
+            if self.handled.get(path) == signature:
+                continue
+            previous = self.pending.get(path)
+            if previous is None or previous[:2] != signature:
+                self.pending[path] = signature + (now,)
+            elif st.st_size > 0 and now - previous[2] >= self.settle_seconds:
+                del self.pending[path]
+                self.handled[path] = signature
+                ready.append(path)
+        return ready
+
+    def enqueue(self, path):
+        try:
+            content_hash = file_content_hash(path)
+        except OSError as e:
+            logger.error("Не удалось прочитать %s: %s", path, e)
+            return
+        if content_hash in self.known_hashes:
+            return
+        self.known_hashes.add(content_hash)
+        # Блокирующая вставка: при заполненной очереди обход папки ждёт воркеров
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put((path, content_hash), timeout=self.poll_interval)
+                return
+            except queue.Full:
+                continue
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            path, content_hash = item
+            try:
+                self.process(path, content_hash)
+            except Exception as e:
+                # Воркер не должен умирать: без воркеров обход папки навсегда встанет на полной очереди
+                logger.exception("Ошибка обработки %s", path)
+                self.record_failure(path, content_hash, e)
+            finally:
+                self.queue.task_done()
+
+    def record_failure(self, path, content_hash, error):
+        try:
+            record_ingestion(content_hash, path, 'failed', str(error))
+        except Exception:
+            logger.exception("Не удалось отметить %s как failed", path)
+
+    def process(self, path, content_hash):
+        # Файл мог за это время загрузить кто-то через веб-интерфейс
+        if is_content_ingested(content_hash, exclude_failed=self.retry_failed):
+            return
+        job_id = stats_tracker.start_processing(path.name)
+        try:
+            stats_tracker.increment('uploads_received')
+            record = process_document_file(path, content_hash, save_db=True, session=f"watch:{self.folder}")
+        finally:
+            stats_tracker.finish_processing(job_id)
+        if record.get("rejected"):
+            # Отклонённые сортировкой документы не повторяются и с --retry-failed
+            stats_tracker.increment('documents_rejected')
+            record_ingestion(content_hash, path, 'rejected', record["error"], record.get("file_id"))
+            logger.info("%s: %s, не отправлялся модели", path.name, record['triage']['label'])
+        elif record.get("error"):
+            record_ingestion(content_hash, path, 'failed', record["error"], record.get("file_id"))
+            logger.warning("%s: %s", path.name, record['error'])
+        else:
+            stats_tracker.increment('extractions_done')
+            stats_tracker.increment('transactions_saved', record["saved_transactions"])
+            record_ingestion(content_hash, path, 'done', file_id=record.get("file_id"))
+            logger.info("%s: %s тр., %s с", path.name, record['saved_transactions'], record['seconds'])
+
+    def start(self):
+        os.makedirs(self.folder, exist_ok=True)
+        self.known_hashes = get_processed_content_hashes() | get_ingested_hashes(exclude_failed=self.retry_failed)
+        for _ in range(self.max_workers):
+            thread = threading.Thread(target=self.worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        if self.use_inotify:
+            self.observer = Observer()
+            self.observer.schedule(_EventHandler(self), str(self.folder), recursive=False)
+            self.observer.start()
+
+    def run(self):
+        """Основной цикл: обход или события -> стабилизация -> очередь. Блокирует до stop()"""
+        self.start()
+        logger.info("Наблюдение за %s (%s), воркеров: %s",
+                    self.folder, 'inotify' if self.use_inotify else 'опрос', self.max_workers)
+        last_scan = float('-inf')
+        try:
+            while not self.stop_event.is_set():
+                now = time.monotonic()
+                with self.lock:
+                    paths = set(self.notified)
+                    self.notified.clear()
+                if now - last_scan >= self.rescan_interval:
+                    paths.update(self.scan())
+                    last_scan = now
+                paths.update(self.pending)
+                for path in self.check_settled(paths, now):
+                    self.enqueue(path)
+                self.stop_event.wait(self.poll_interval)
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def shutdown(self):
+        """Дождаться файлов, уже взятых в очередь, и остановить воркеры"""
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
@@ -0,0 +1,61 @@
+"""
+HTTP-кэширование и сжатие ответов веб-интерфейса:
+- Отпечатки статических файлов для долгого кэширования в браузере
+- ETag и условные запросы (304 Not Modified)
+- gzip для текстовых ответов
+"""
+import gzip
+import hashlib
+from pathlib import Path
+
+# Год: статические файлы с отпечатком в URL никогда не меняются
+STATIC_MAX_AGE = 365 * 24 * 3600
+# Ответы меньше этого размера не сжимаем — выигрыш меньше накладных расходов
+MIN_GZIP_SIZE = 512
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/csv',
+    'application/json', 'application/javascript', 'text/javascript'
+}
+
+def build_static_fingerprints(static_dir):
+    """Считает короткие хэши содержимого всех статических файлов: путь -> хэш"""
+    fingerprints = {}
+    static_dir = Path(static_dir)
+    for path in static_dir.rglob('*'):
+        if path.is_file():
+            digest = hashlib.md5(path.read_bytes()).hexdigest()[:12]
+            fingerprints[path.relative_to(static_dir).as_posix()] = digest
+    return fingerprints
+
+def apply_http_caching(request, response, static_url_path='/static'):
+    """Заголовки кэширования, ETag и gzip для готового ответа"""
+    if request.path.startswith(static_url_path + '/') and request.args.get('v'):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+
+    if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+        return response
+    if response.direct_passthrough:
+        # Файлы из send_file отдаются напрямую; читаем их, чтобы посчитать ETag и сжать
+        response.direct_passthrough = False
+        response.make_sequence()
+    if response.is_streamed:
+        return response
+
+    data = response.get_data()
+
+    # Слабый ETag совпадает для сжатой и несжатой версии одного содержимого
+    response.set_etag(hashlib.md5(data).hexdigest(), weak=True)
+    response.make_conditional(request)
+    if response.status_code != 200:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if (response.mimetype in COMPRESSIBLE_MIMETYPES and len(data) >= MIN_GZIP_SIZE
+            and 'gzip' in request.headers.get('Accept-Encoding', '')
+            and 'Content-Encoding' not in response.headers):
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -0,0 +1,112 @@
+"""
+Подготовка сканов и фотографий документов перед отправкой модели:
+- Поворот по EXIF-ориентации
+- Перевод в оттенки серого
+- Уменьшение до целевого DPI (для фото без DPI — исходя из формата A4)
+- Пересжатие в JPEG
+- Растеризация только нужных страниц PDF (необязательно)
+
+Модели для распознавания реквизитов не нужны 12-мегапиксельные цветные фото:
+после подготовки запрос в разы меньше, а точность извлечения та же.
+"""
+import io
+import re
+from config import IMAGE_TARGET_DPI, IMAGE_JPEG_QUALITY, IMAGE_GRAYSCALE, PDF_MAX_RASTER_PAGES
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Длинная сторона листа A4 в дюймах: по ней оценивается DPI фотографий документов
+A4_LONG_SIDE_INCHES = 11.69
+
+# Признаки страницы с реквизитами платежа
+RELEVANT_PAGE_RE = re.compile(
+    r'ИНН|КПП|БИК|сумм|итого|оплат|счет|счёт|платеж|платёж|назначение|\b\d{10}\b|\b\d{12}\b',
+    re.IGNORECASE
+)
+
+class PreprocessingUnavailableError(Exception):
+    """Не установлены библиотеки для подготовки изображений"""
+
+def is_available():
+    return Image is not None
+
+def _require_pillow():
+    if Image is None:
+        raise PreprocessingUnavailableError("Для подготовки изображений установите Pillow")
+
+def _target_long_side(image, dpi):
+    """Длинная сторона в пикселях при целевом DPI"""
+    source_dpi = image.info.get("dpi")
+    if source_dpi and source_dpi[0] and source_dpi[0] > 1:
+        return round(max(image.size) * dpi / float(source_dpi[0]))
+    return round(A4_LONG_SIDE_INCHES * dpi)
+
+def normalize_image(image, dpi=IMAGE_TARGET_DPI, grayscale=IMAGE_GRAYSCALE):
+    """Ориентация, цвет и размер изображения"""
+    image = ImageOps.exif_transpose(image)
+    if grayscale:
+        image = image.convert("L")
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    long_side = _target_long_side(image, dpi)
+    if max(image.size) > long_side:
+        scale = long_side / max(image.size)
+        image = image.resize(
+            (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+            Image.LANCZOS
+        )
+    return image
+
+def encode_jpeg(image, quality=IMAGE_JPEG_QUALITY):
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+def preprocess_image(raw, dpi=IMAGE_TARGET_DPI, grayscale=IMAGE_GRAYSCALE, quality=IMAGE_JPEG_QUALITY):
+    """Подготовить изображение. Возвращает (байты, MIME-тип); исходник, если он и так меньше"""
+    _require_pillow()
+    with Image.open(io.BytesIO(raw)) as image:
+        prepared = encode_jpeg(normalize_image(image, dpi, grayscale), quality)
+    if len(prepared) >= len(raw):
+        return raw, None
+    return prepared, "image/jpeg"
+
+def select_relevant_pages(pdf, max_pages=PDF_MAX_RASTER_PAGES):
+    """Номера страниц с реквизитами. Страницы без текстового слоя (сканы) считаются нужными,
+    если на них есть изображения"""
+    relevant = []
+    for index, page in enumerate(pdf.pages):
+        text = page.extract_text() or ""
+        if RELEVANT_PAGE_RE.search(text) or (not text.strip() and page.images):
+            relevant.append(index)
+        if len(relevant) >= max_pages:
+            break
+    # Ничего не распознали — отдаём первые страницы, чтобы не потерять документ
+    return relevant or list(range(min(len(pdf.pages), max_pages)))
+
+def rasterize_pdf(raw, dpi=IMAGE_TARGET_DPI, grayscale=IMAGE_GRAYSCALE, quality=IMAGE_JPEG_QUALITY,
+                  max_pages=PDF_MAX_RASTER_PAGES):
+    """Растеризует нужные страницы PDF в компактный PDF из JPEG-страниц.
+
+    Returns:
+        (байты PDF, номера выбранных страниц) или (исходник, None), если результат не меньше
+    """
+    _require_pillow()
+    import pdfplumber
+
+    with pdfplumber.open(io.BytesIO(raw)) as pdf:
+        pages = select_relevant_pages(pdf, max_pages)
+        images = []
+        for index in pages:
+            rendered = pdf.pages[index].to_image(resolution=dpi).original
+            images.append(rendered.convert("L") if grayscale else rendered.convert("RGB"))
+    buffer = io.BytesIO()
+    # Страницы в оттенках серого и RGB Pillow встраивает в PDF как JPEG с заданным качеством
+    images[0].save(buffer, "PDF", save_all=True, append_images=images[1:], resolution=dpi, quality=quality)
+    prepared = buffer.getvalue()
+    if len(prepared) >= len(raw):
+        return raw, None
+    return prepared, pages
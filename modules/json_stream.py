@@ -0,0 +1,84 @@
+"""
+Инкрементальный разбор JSON-массива объектов из потокового ответа модели.
+
+Каждый объект верхнего уровня отдаётся, как только получена его закрывающая
+скобка, не дожидаясь конца ответа. При обрыве потока уже полученные объекты
+остаются разобранными, теряется только незавершённый хвост.
+"""
+import json
+
+class JsonArrayStreamParser:
+    def __init__(self):
+        # Незавершённый текст, начиная с текущего объекта верхнего уровня
+        self.buffer = ""
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        # Открывающая скобка массива уже встречена (markdown и текст до неё пропускаются)
+        self.started = False
+        self.finished = False
+        self.object_start = None
+        self.objects_parsed = 0
+        # Сбалансированные по скобкам, но некорректные объекты
+        self.invalid_fragments = []
+        # Весь полученный текст — для разбора ответа, который оказался не массивом
+        self.raw_parts = []
+
+    @property
+    def raw_text(self):
+        return "".join(self.raw_parts)
+
+    def feed(self, text):
+        """Добавить фрагмент ответа. Возвращает список объектов, завершённых в этом фрагменте"""
+        self.raw_parts.append(text)
+        completed = []
+        if self.finished:
+            return completed
+        offset = len(self.buffer)
+        self.buffer += text
+        for i in range(offset, len(self.buffer)):
+            char = self.buffer[i]
+            if not self.started:
+                if char == "[":
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+            if char == '"':
+                self.in_string = True
+            elif char in "{[":
+                if self.depth == 1:
+                    self.object_start = i
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 1 and self.object_start is not None:
+                    fragment = self.buffer[self.object_start:i + 1]
+                    try:
+                        completed.append(json.loads(fragment))
+                        self.objects_parsed += 1
+                    except json.JSONDecodeError:
+                        self.invalid_fragments.append(fragment)
+                    self.object_start = None
+                elif self.depth == 0:
+                    self.finished = True
+                    break
+        # Храним только незавершённый объект, чтобы длинный ответ не копировался целиком на каждом фрагменте
+        if self.object_start is not None:
+            self.buffer = self.buffer[self.object_start:]
+            self.object_start = 0
+        else:
+            self.buffer = ""
+        return completed
+
+    @property
+    def complete(self):
+        """Массив получен полностью"""
+        return self.finished
@@ -0,0 +1,528 @@
+"""
+Единый слой исходящих вызовов модели:
+- Token bucket, общий для всех воркеров (через SQLite)
+- Таймауты на каждый вызов
+- Экспоненциальные повторы с джиттером на временных ошибках
+- Circuit breaker: быстрый отказ, пока бэкенд нездоров
+- Планировщик: приоритет чата над загрузками и пакетной обработкой, очередь по сессиям
+- Учёт токенов, байтов и стоимости каждого вызова, дневной бюджет арендатора
+"""
+import asyncio
+import random
+import sqlite3
+import time
+from threading import Lock
+from types import SimpleNamespace
+import google.generativeai as genai
+from config import (
+    GEMINI_API_KEY, MODEL_BACKEND, MODEL_STATE_DB, MODEL_RATE_LIMIT, MODEL_RATE_BURST,
+    MODEL_TIMEOUT, MODEL_MAX_RETRIES, MODEL_BACKOFF_BASE, MODEL_BACKOFF_MAX,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT
+)
+from modules.usage_accounting import usage_tracker, current_tenant
+from modules.model_scheduler import model_scheduler, SchedulerTimeout
+from modules.tracing import span
+
+DEFAULT_MODEL = "gemini-2.5-flash"
+
+# Ошибки google.api_core и сетевые ошибки, после которых имеет смысл повторить вызов
+RETRYABLE_ERROR_NAMES = {
+    'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'InternalServerError',
+    'DeadlineExceeded', 'GatewayTimeout', 'BadGateway', 'Aborted',
+    'TimeoutError', 'ConnectionError', 'ConnectionResetError'
+}
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class ModelCallError(Exception):
+    """Вызов модели не удался после всех повторов"""
+
+class ModelUnavailableError(ModelCallError):
+    """Бэкенд модели временно недоступен (открыт circuit breaker или исчерпан лимит)"""
+
+class BudgetExceededError(ModelUnavailableError):
+    """Арендатор исчерпал дневной бюджет на вызовы модели"""
+
+def is_retryable_error(error):
+    """Можно ли повторить вызов после этой ошибки"""
+    for cls in type(error).__mro__:
+        if cls.__name__ in RETRYABLE_ERROR_NAMES:
+            return True
+    code = getattr(error, 'code', None)
+    return isinstance(code, int) and code in RETRYABLE_STATUS_CODES
+
+def backoff_delay(attempt, base=MODEL_BACKOFF_BASE, max_delay=MODEL_BACKOFF_MAX):
+    """Задержка перед повтором: экспонента с полным джиттером"""
+    return random.uniform(0, min(max_delay, base * (2 ** attempt)))
+
+class TokenBucket:
+    def __init__(self, rate, capacity, db_path=None, name="model"):
+        self.rate = rate
+        self.capacity = capacity
+        # Путь к SQLite для общего между процессами состояния (None — только процесс)
+        self.db_path = db_path
+        self.name = name
+        self.lock = Lock()
+        self.tokens = float(capacity)
+        self.updated_at = time.time()
+        if self.db_path:
+            self._init_shared_state()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+
+    def _init_shared_state(self):
+        """Создание таблицы состояния лимитера"""
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limiter (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.execute(
+            'INSERT OR IGNORE INTO rate_limiter (name, tokens, updated_at) VALUES (?, ?, ?)',
+            (self.name, float(self.capacity), time.time())
+        )
+        conn.close()
+
+    def _refill(self, tokens, updated_at, now):
+        return min(self.capacity, tokens + max(0.0, now - updated_at) * self.rate)
+
+    def _try_acquire_local(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = self._refill(self.tokens, self.updated_at, now)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def _try_acquire_shared(self):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT tokens, updated_at FROM rate_limiter WHERE name = ?', (self.name,)
+            ).fetchone()
+            now = time.time()
+            tokens = self._refill(row[0], row[1], now) if row else float(self.capacity)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_limiter (name, tokens, updated_at) VALUES (?, ?, ?)',
+                (self.name, tokens, now)
+            )
+            conn.execute('COMMIT')
+            return wait
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            # Общее состояние недоступно — ограничиваем хотя бы в пределах процесса
+            return self._try_acquire_local()
+        finally:
+            conn.close()
+
+    def acquire(self, timeout):
+        """Дождаться токена. Возвращает False, если не удалось за timeout секунд"""
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self._try_acquire_shared() if self.db_path else self._try_acquire_local()
+            if wait <= 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout):
+        """Асинхронное ожидание токена без блокировки цикла событий"""
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.db_path:
+                wait = await asyncio.to_thread(self._try_acquire_shared)
+            else:
+                wait = self._try_acquire_local()
+            if wait <= 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.lock = Lock()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def allow_request(self):
+        """Разрешён ли вызов бэкенда сейчас"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self.probe_in_flight:
+                # В полуоткрытом состоянии пропускаем один пробный вызов
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def get_state(self):
+        with self.lock:
+            return {'state': self.state, 'failures': self.failures}
+
+class GeminiBackend:
+    """Реальный бэкенд Gemini API"""
+    def __init__(self):
+        genai.configure(api_key=GEMINI_API_KEY)
+        self.models = {}
+
+    def generate(self, model_name, contents, timeout=None, **kwargs):
+        model = self.models.get(model_name)
+        if model is None:
+            model = self.models[model_name] = genai.GenerativeModel(model_name)
+        request_options = {"timeout": timeout} if timeout else None
+        return model.generate_content(contents, request_options=request_options, **kwargs)
+
+    async def generate_async(self, model_name, contents, timeout=None, **kwargs):
+        model = self.models.get(model_name)
+        if model is None:
+            model = self.models[model_name] = genai.GenerativeModel(model_name)
+        request_options = {"timeout": timeout} if timeout else None
+        return await model.generate_content_async(contents, request_options=request_options, **kwargs)
+
+    def stream(self, model_name, contents, timeout=None, **kwargs):
+        """Потоковый ответ: итерируемые фрагменты с .text"""
+        model = self.models.get(model_name)
+        if model is None:
+            model = self.models[model_name] = genai.GenerativeModel(model_name)
+        request_options = {"timeout": timeout} if timeout else None
+        return model.generate_content(contents, stream=True, request_options=request_options, **kwargs)
+
+    async def stream_async(self, model_name, contents, timeout=None, **kwargs):
+        """Асинхронный потоковый ответ: фрагменты перебираются через async for"""
+        model = self.models.get(model_name)
+        if model is None:
+            model = self.models[model_name] = genai.GenerativeModel(model_name)
+        request_options = {"timeout": timeout} if timeout else None
+        return await model.generate_content_async(contents, stream=True, request_options=request_options, **kwargs)
+
+    def upload_file(self, path, mime_type):
+        return genai.upload_file(path=str(path), mime_type=mime_type)
+
+def chunk_text(chunk):
+    """Текст фрагмента потока; служебные фрагменты без частей дают пустую строку"""
+    try:
+        return chunk.text or ""
+    except ValueError:
+        return ""
+
+class ModelClient:
+    def __init__(self, backend, rate_limiter=None, circuit_breaker=None,
+                 timeout=MODEL_TIMEOUT, max_retries=MODEL_MAX_RETRIES, usage_tracker=None, scheduler=None):
+        self.backend = backend
+        self.scheduler = scheduler
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.usage_tracker = usage_tracker
+
+    def generate_content(self, contents, model_name=DEFAULT_MODEL, timeout=None, usage=None, **kwargs):
+        """Вызов модели с лимитером, таймаутом, повторами и circuit breaker.
+
+        usage — сведения для учёта расхода: operation, document, file_type, pages, document_bytes.
+        """
+        timeout = timeout or self.timeout
+        self._check_budget()
+        self._acquire_slot(timeout)
+        started = time.monotonic()
+        try:
+            with span("model.call", model=model_name, operation=(usage or {}).get("operation")):
+                response = self._call(lambda: self.backend.generate(model_name, contents, timeout=timeout, **kwargs), timeout)
+        except Exception as e:
+            self._record_usage(model_name, contents, usage, started, error=e)
+            raise
+        finally:
+            self._release_slot()
+        self._record_usage(model_name, contents, usage, started, response)
+        return response
+
+    async def generate_content_async(self, contents, model_name=DEFAULT_MODEL, timeout=None, usage=None, **kwargs):
+        """Асинхронный вызов модели с той же обвязкой, что и generate_content"""
+        timeout = timeout or self.timeout
+        await asyncio.to_thread(self._check_budget)
+        await self._acquire_slot_async(timeout)
+        started = time.monotonic()
+        try:
+            with span("model.call", model=model_name, operation=(usage or {}).get("operation")):
+                response = await self._call_async(
+                    lambda: self.backend.generate_async(model_name, contents, timeout=timeout, **kwargs), timeout
+                )
+        except Exception as e:
+            await asyncio.to_thread(self._record_usage, model_name, contents, usage, started, error=e)
+            raise
+        finally:
+            self._release_slot()
+        await asyncio.to_thread(self._record_usage, model_name, contents, usage, started, response)
+        return response
+
+    def stream_content(self, contents, model_name=DEFAULT_MODEL, timeout=None, usage=None, **kwargs):
+        """Потоковый вызов модели: генератор фрагментов текста ответа.
+
+        Лимитер, повторы и circuit breaker действуют до первого фрагмента.
+        Обрыв после него выбрасывается вызывающему, а уже полученные
+        фрагменты остаются у него.
+        """
+        timeout = timeout or self.timeout
+        self._check_budget()
+        # Место у модели занято, пока поток не дочитан
+        self._acquire_slot(timeout)
+        started = time.monotonic()
+        parts = []
+        last_chunk = None
+        error = None
+        # Спан не делается текущим: между фрагментами управление у вызывающего
+        stream_span = span("model.stream", model=model_name, operation=(usage or {}).get("operation"))
+
+        def open_stream():
+            stream = iter(self.backend.stream(model_name, contents, timeout=timeout, **kwargs))
+            return stream, next(stream, None)
+
+        try:
+            stream, chunk = self._call(open_stream, timeout)
+            stream_span.set(first_chunk_ms=round((time.monotonic() - started) * 1000, 1))
+            while chunk is not None:
+                last_chunk = chunk
+                text = chunk_text(chunk)
+                parts.append(text)
+                yield text
+                chunk = next(stream, None)
+        except Exception as e:
+            error = e
+            stream_span.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            self._release_slot()
+            stream_span.set(chunks=len(parts))
+            stream_span.end()
+            self._record_stream_usage(model_name, contents, usage, started, parts, last_chunk, error)
+
+    async def stream_content_async(self, contents, model_name=DEFAULT_MODEL, timeout=None, usage=None, **kwargs):
+        """Асинхронный вариант stream_content"""
+        timeout = timeout or self.timeout
+        await asyncio.to_thread(self._check_budget)
+        await self._acquire_slot_async(timeout)
+        started = time.monotonic()
+        parts = []
+        last_chunk = None
+        error = None
+        stream_span = span("model.stream", model=model_name, operation=(usage or {}).get("operation"))
+
+        async def open_stream():
+            stream = (await self.backend.stream_async(model_name, contents, timeout=timeout, **kwargs)).__aiter__()
+            try:
+                return stream, await stream.__anext__()
+            except StopAsyncIteration:
+                return stream, None
+
+        try:
+            stream, chunk = await self._call_async(open_stream, timeout)
+            stream_span.set(first_chunk_ms=round((time.monotonic() - started) * 1000, 1))
+            while chunk is not None:
+                last_chunk = chunk
+                text = chunk_text(chunk)
+                parts.append(text)
+                yield text
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), timeout)
+                except StopAsyncIteration:
+                    chunk = None
+        except Exception as e:
+            error = e
+            stream_span.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            self._release_slot()
+            stream_span.set(chunks=len(parts))
+            stream_span.end()
+            await asyncio.to_thread(
+                self._record_stream_usage, model_name, contents, usage, started, parts, last_chunk, error
+            )
+
+    def upload_file(self, path, mime_type, timeout=None, usage=None):
+        """Загрузка файла в File API бэкенда, возвращает ссылку для передачи в generate_content"""
+        timeout = timeout or self.timeout
+        usage = dict(usage or {}, operation='file_upload')
+        self._acquire_slot(timeout)
+        started = time.monotonic()
+        try:
+            with span("model.upload", mime_type=mime_type):
+                ref = self._call(lambda: self.backend.upload_file(path, mime_type), timeout)
+        except Exception as e:
+            self._record_usage('file_api', None, usage, started, error=e)
+            raise
+        finally:
+            self._release_slot()
+        self._record_usage('file_api', None, usage, started)
+        return ref
+
+    def _acquire_slot(self, timeout):
+        """Ожидание места у планировщика; время в очереди не входит в задержку вызова"""
+        if self.scheduler is None:
+            return
+        try:
+            with span("model.queue"):
+                self.scheduler.acquire(timeout)
+        except SchedulerTimeout as e:
+            raise ModelUnavailableError(f"Сервис ИИ перегружен, попробуйте позже ({e})") from e
+
+    async def _acquire_slot_async(self, timeout):
+        if self.scheduler is None:
+            return
+        try:
+            with span("model.queue"):
+                await self.scheduler.acquire_async(timeout)
+        except SchedulerTimeout as e:
+            raise ModelUnavailableError(f"Сервис ИИ перегружен, попробуйте позже ({e})") from e
+
+    def _release_slot(self):
+        if self.scheduler is not None:
+            self.scheduler.release()
+
+    def _check_budget(self):
+        """Отказ без обращения к бэкенду, если арендатор исчерпал дневной бюджет"""
+        if self.usage_tracker is None:
+            return
+        tenant = current_tenant.get()
+        if self.usage_tracker.is_over_budget(tenant):
+            raise BudgetExceededError(f"Исчерпан дневной бюджет запросов к ИИ для «{tenant}», попробуйте завтра")
+
+    def _record_usage(self, model_name, contents, usage, started, response=None, error=None):
+        if self.usage_tracker is not None:
+            self.usage_tracker.record(model_name, contents, usage, time.monotonic() - started, response, error)
+
+    def _record_stream_usage(self, model_name, contents, usage, started, parts, last_chunk, error):
+        """Учёт потокового вызова: итоговые токены приходят в последнем фрагменте"""
+        response = None
+        if last_chunk is not None:
+            response = SimpleNamespace(
+                text="".join(parts), usage_metadata=getattr(last_chunk, 'usage_metadata', None)
+            )
+        self._record_usage(model_name, contents, usage, started, response, error)
+
+    def _call(self, fn, timeout):
+        """Общая обвязка вызова бэкенда: лимитер, повторы и circuit breaker"""
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if not self.circuit_breaker.allow_request():
+                raise ModelUnavailableError("Сервис ИИ временно недоступен, попробуйте позже")
+            if self.rate_limiter and not self.rate_limiter.acquire(timeout):
+                raise ModelUnavailableError("Превышен лимит запросов к ИИ, попробуйте позже")
+            try:
+                response = fn()
+            except Exception as e:
+                if not is_retryable_error(e):
+                    # Бэкенд ответил, но запрос некорректен — это не признак его нездоровья
+                    self.circuit_breaker.record_success()
+                    raise
+                self.circuit_breaker.record_failure()
+                last_error = e
+                if attempt < self.max_retries:
+                    time.sleep(backoff_delay(attempt))
+                continue
+            self.circuit_breaker.record_success()
+            return response
+        raise ModelUnavailableError(f"Сервис ИИ не ответил после {self.max_retries + 1} попыток: {last_error}")
+
+    async def _call_async(self, make_coroutine, timeout):
+        """Асинхронная обвязка вызова: ожидания не занимают поток"""
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if not self.circuit_breaker.allow_request():
+                raise ModelUnavailableError("Сервис ИИ временно недоступен, попробуйте позже")
+            if self.rate_limiter and not await self.rate_limiter.acquire_async(timeout):
+                raise ModelUnavailableError("Превышен лимит запросов к ИИ, попробуйте позже")
+            try:
+                response = await asyncio.wait_for(make_coroutine(), timeout)
+            except Exception as e:
+                if not is_retryable_error(e):
+                    self.circuit_breaker.record_success()
+                    raise
+                self.circuit_breaker.record_failure()
+                last_error = e
+                if attempt < self.max_retries:
+                    await asyncio.sleep(backoff_delay(attempt))
+                continue
+            self.circuit_breaker.record_success()
+            return response
+        raise ModelUnavailableError(f"Сервис ИИ не ответил после {self.max_retries + 1} попыток: {last_error}")
+
+def create_backend(name=MODEL_BACKEND):
+    """Выбор бэкенда модели по имени из конфигурации"""
+    if name == "fake":
+        from modules.fake_backend import FakeGeminiBackend
+        return FakeGeminiBackend()
+    return GeminiBackend()
+
+# Глобальный клиент модели
+model_client = ModelClient(
+    backend=create_backend(),
+    rate_limiter=TokenBucket(MODEL_RATE_LIMIT, MODEL_RATE_BURST, db_path=MODEL_STATE_DB),
+    circuit_breaker=CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT),
+    usage_tracker=usage_tracker,
+    scheduler=model_scheduler
+)
+
+def generate_content(contents, model_name=DEFAULT_MODEL, timeout=None, usage=None, **kwargs):
+    """Вызов модели через глобальный клиент"""
+    return model_client.generate_content(contents, model_name=model_name, timeout=timeout, usage=usage, **kwargs)
+
+async def generate_content_async(contents, model_name=DEFAULT_MODEL, timeout=None, usage=None, **kwargs):
+    """Асинхронный вызов модели через глобальный клиент"""
+    return await model_client.generate_content_async(
+        contents, model_name=model_name, timeout=timeout, usage=usage, **kwargs
+    )
+
+def stream_content(contents, model_name=DEFAULT_MODEL, timeout=None, usage=None, **kwargs):
+    """Потоковый вызов модели через глобальный клиент"""
+    return model_client.stream_content(contents, model_name=model_name, timeout=timeout, usage=usage, **kwargs)
+
+def stream_content_async(contents, model_name=DEFAULT_MODEL, timeout=None, usage=None, **kwargs):
+    """Асинхронный потоковый вызов модели через глобальный клиент"""
+    return model_client.stream_content_async(contents, model_name=model_name, timeout=timeout, usage=usage, **kwargs)
+
+def upload_file(path, mime_type, timeout=None, usage=None):
+    """Загрузка файла в File API через глобальный клиент"""
+    return model_client.upload_file(path, mime_type, timeout=timeout, usage=usage)
@@ -0,0 +1,236 @@
+"""
+Планировщик вызовов модели: приоритетные классы и справедливая очередь по сессиям.
+
+- Число одновременных вызовов модели ограничено; остальные ждут в очереди
+- Классы: interactive (вопросы в чате), upload (загрузка одного документа),
+  batch (пакетная обработка и наблюдатель за папкой). Свободное место получает
+  класс с наименьшим «виртуальным временем»: каждый допуск сдвигает его на 1/вес,
+  поэтому чат почти всегда проходит первым, а пакетная обработка не голодает
+- Внутри класса сессии обслуживаются по кругу: пакет из 200 страниц одной сессии
+  не задерживает одиночные запросы других сверх одного вызова
+- Время ожидания в очереди учитывается по каждому классу
+
+Класс и сессия текущего вызова берутся из контекста (current_priority, current_session).
+Лимит действует в пределах процесса.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from config import MODEL_MAX_CONCURRENT, MODEL_PRIORITY_WEIGHTS
+
+PRIORITY_CLASSES = ('interactive', 'upload', 'batch')
+DEFAULT_WEIGHTS = {'interactive': 8, 'upload': 3, 'batch': 1}
+
+# Класс приоритета и сессия текущего вызова модели
+current_priority = contextvars.ContextVar('model_priority', default='upload')
+current_session = contextvars.ContextVar('model_session', default='default')
+
+@contextmanager
+def model_priority(priority, session=None):
+    """Выполнить блок с заданным классом приоритета (и сессией) для вызовов модели"""
+    priority_token = current_priority.set(priority)
+    session_token = current_session.set(session) if session is not None else None
+    try:
+        yield
+    finally:
+        current_priority.reset(priority_token)
+        if session_token is not None:
+            current_session.reset(session_token)
+
+class SchedulerTimeout(Exception):
+    """Вызов не дождался свободного места у модели"""
+
+def validate_weights(weights):
+    """Веса классов с умолчаниями для не заданных; ValueError при неизвестном классе или весе <= 0.
+
+    Проверка при создании планировщика: ошибка в MODEL_PRIORITY_WEIGHTS видна при запуске,
+    а не в каждом вызове модели.
+    """
+    unknown = sorted(set(weights) - set(PRIORITY_CLASSES))
+    if unknown:
+        raise ValueError(
+            f"MODEL_PRIORITY_WEIGHTS: неизвестные классы {', '.join(unknown)}; допустимы {', '.join(PRIORITY_CLASSES)}"
+        )
+    invalid = sorted(name for name, weight in weights.items() if not weight > 0)
+    if invalid:
+        raise ValueError(f"MODEL_PRIORITY_WEIGHTS: вес должен быть больше нуля ({', '.join(invalid)})")
+    return {**DEFAULT_WEIGHTS, **weights}
+
+class _Waiter:
+    def __init__(self, loop=None):
+        self.enqueued = time.monotonic()
+        if loop is None:
+            self.event = threading.Event()
+            self.future = None
+        else:
+            self.event = None
+            self.loop = loop
+            self.future = loop.create_future()
+
+    def grant(self):
+        if self.future is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+class ClassStats:
+    """Метрики ожидания одного класса: последние WINDOW ожиданий для перцентилей"""
+    WINDOW = 1000
+
+    def __init__(self):
+        self.granted = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent = deque(maxlen=self.WINDOW)
+
+    def record(self, wait):
+        self.granted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent.append(wait)
+
+    def as_dict(self, queued):
+        recent = sorted(self.recent)
+
+        def percentile(p):
+            return round(recent[min(len(recent) - 1, int(len(recent) * p))], 4) if recent else None
+
+        return {
+            'queued': queued,
+            'granted': self.granted,
+            'timed_out': self.timed_out,
+            'avg_wait': round(self.total_wait / self.granted, 4) if self.granted else None,
+            'p50_wait': percentile(0.50),
+            'p95_wait': percentile(0.95),
+            'max_wait': round(self.max_wait, 4),
+        }
+
+class ModelScheduler:
+    def __init__(self, max_concurrent=4, weights=None):
+        self.max_concurrent = max_concurrent
+        self.weights = validate_weights(weights or {})
+        self.lock = threading.Lock()
+        self.active = 0
+        # Класс -> (сессия -> очередь её ожиданий); порядок сессий — порядок обхода по кругу
+        self.queues = {priority: OrderedDict() for priority in self.weights}
+        # Виртуальное время классов для взвешенного разделения мест
+        self.virtual_time = {priority: 0.0 for priority in self.weights}
+        self.stats = {priority: ClassStats() for priority in self.weights}
+
+    def _queued(self, priority):
+        return sum(len(waiters) for waiters in self.queues[priority].values())
+
+    def _enqueue(self, priority, session, waiter):
+        sessions = self.queues[priority]
+        if not sessions:
+            # Простаивавший класс не копит «долг»: стартует с текущего минимума активных
+            busy = [self.virtual_time[p] for p, queue in self.queues.items() if queue]
+            self.virtual_time[priority] = max(self.virtual_time[priority], min(busy, default=0.0))
+        sessions.setdefault(session, deque()).append(waiter)
+
+    def _dispatch(self):
+        """Раздать свободные места ожидающим. Вызывается под блокировкой"""
+        while self.active < self.max_concurrent:
+            ready = [priority for priority, sessions in self.queues.items() if sessions]
+            if not ready:
+                return
+            priority = min(ready, key=lambda p: (self.virtual_time[p], PRIORITY_CLASSES.index(p)))
+            sessions = self.queues[priority]
+            session, waiters = next(iter(sessions.items()))
+            waiter = waiters.popleft()
+            # Сессия уходит в конец круга, пустая — удаляется
+            sessions.pop(session)
+            if waiters:
+                sessions[session] = waiters
+            self.virtual_time[priority] += 1.0 / self.weights[priority]
+            self.active += 1
+            self.stats[priority].record(time.monotonic() - waiter.enqueued)
+            waiter.grant()
+
+    def _remove(self, priority, session, waiter):
+        waiters = self.queues[priority].get(session)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                self.queues[priority].pop(session)
+            return True
+        return False
+
+    def _resolve_priority(self, priority):
+        priority = priority or current_priority.get()
+        return priority if priority in self.weights else 'upload'
+
+    def acquire(self, timeout, priority=None, session=None):
+        """Дождаться места для вызова модели. SchedulerTimeout, если не дождались за timeout"""
+        priority = self._resolve_priority(priority)
+        session = session or current_session.get()
+        waiter = _Waiter()
+        with self.lock:
+            self._enqueue(priority, session, waiter)
+            self._dispatch()
+        if waiter.event.wait(timeout):
+            return
+        with self.lock:
+            if self._remove(priority, session, waiter):
+                self.stats[priority].timed_out += 1
+                raise SchedulerTimeout(f"Очередь к ИИ не продвинулась за {timeout:.0f} с")
+        # Место выдано одновременно с истечением таймаута — используем его
+
+    async def acquire_async(self, timeout, priority=None, session=None):
+        """Асинхронное ожидание места без занятия потока"""
+        priority = self._resolve_priority(priority)
+        session = session or current_session.get()
+        waiter = _Waiter(loop=asyncio.get_running_loop())
+        with self.lock:
+            self._enqueue(priority, session, waiter)
+            self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                if self._remove(priority, session, waiter):
+                    self.stats[priority].timed_out += 1
+                    raise SchedulerTimeout(f"Очередь к ИИ не продвинулась за {timeout:.0f} с") from None
+        except asyncio.CancelledError:
+            with self.lock:
+                removed = self._remove(priority, session, waiter)
+            if not removed:
+                # Место уже выдано — возвращаем его, раз вызов не состоится
+                self.release()
+            raise
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, timeout, priority=None, session=None):
+        self.acquire(timeout, priority, session)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_stats(self):
+        """Занятые места и метрики ожидания по классам"""
+        with self.lock:
+            return {
+                'active': self.active,
+                'max_concurrent': self.max_concurrent,
+                'weights': dict(self.weights),
+                'classes': {
+                    priority: self.stats[priority].as_dict(self._queued(priority)) for priority in self.weights
+                },
+            }
+
+# Глобальный планировщик вызовов модели
+model_scheduler = ModelScheduler(MODEL_MAX_CONCURRENT, MODEL_PRIORITY_WEIGHTS)
@@ -0,0 +1,79 @@
+"""
+Общие этапы конвейера обработки документа, используемые веб-интерфейсом,
+асинхронным конвейером и пакетной обработкой.
+"""
+import time
+from pathlib import Path
+from modules.accounting_logic import classify_transaction
+from modules.anomaly_detector import detect_anomalies_in_transactions
+from modules.database import save_file_and_transactions, compress_extraction
+from modules.document_parser import extract_invoice_data
+from modules.model_scheduler import model_priority
+from modules.tracing import span, start_trace
+
+def document_question_prompt(question):
+    """Текст запроса к модели для вопроса по загруженному документу."""
+    return f"Ответь на вопрос по этому документу: {question}"
+
+def is_rejected(transactions):
+    """Документ отклонён локальной сортировкой, модель не вызывалась"""
+    return bool(transactions) and isinstance(transactions[0], dict) and transactions[0].get("rejected", False)
+
+def enrich_transactions(transactions):
+    """Классифицирует транзакции по счетам и ищет среди них аномалии.
+    
+    Returns:
+        (все элементы ответа модели, успешно разобранные транзакции)
+    """
+    if not isinstance(transactions, list):
+        transactions = [transactions]
+    
+    successful_transactions = []
+    with span("classification") as classification:
+        for transaction in transactions:
+            if isinstance(transaction, dict) and "error" not in transaction:
+                transaction["Счет"] = classify_transaction(transaction.get("Назначение платежа", ""))
+                successful_transactions.append(transaction)
+        classification.set(transactions=len(successful_transactions))
+    
+    if successful_transactions:
+        with span("anomaly_detection") as detection:
+            successful_transactions = detect_anomalies_in_transactions(successful_transactions)
+            detection.set(anomalies=sum(1 for t in successful_transactions if t.get('is_anomaly', False)))
+    
+    return transactions, successful_transactions
+
+def process_document_file(file_path, content_hash, save_db=False, session="batch"):
+    """Обрабатывает один файл с диска целиком и возвращает запись о результате.
+    
+    Используется пакетной обработкой и наблюдателем за папкой; ошибки
+    не выбрасываются, а попадают в поле "error" записи. Вызовы модели идут
+    с низким приоритетом batch от имени сессии session.
+    """
+    with model_priority("batch", session), start_trace("document", file=Path(file_path).name):
+        return _process_document_file(file_path, content_hash, save_db)
+
+def _process_document_file(file_path, content_hash, save_db):
+    started = time.perf_counter()
+    record = {"file": str(file_path), "content_hash": content_hash}
+    try:
+        transactions = extract_invoice_data(file_path)
+        if is_rejected(transactions):
+            record["rejected"] = True
+            record["triage"] = transactions[0]["triage"]
+        raw_extraction = compress_extraction(transactions) if save_db else None
+        transactions, successful_transactions = enrich_transactions(transactions)
+        record["transactions"] = transactions
+        record["saved_transactions"] = len(successful_transactions)
+        if save_db:
+            record["file_id"] = save_file_and_transactions(
+                Path(file_path).name, Path(file_path).suffix.lower(), successful_transactions,
+                content_hash=content_hash, raw_extraction=raw_extraction
+            )
+        if not successful_transactions:
+            errors = [t.get("error") for t in transactions if isinstance(t, dict) and t.get("error")]
+            record["error"] = errors[0] if errors else "Транзакции не найдены"
+    except Exception as e:
+        record["error"] = str(e)
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    return record
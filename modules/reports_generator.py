@@ -1,11 +1,7 @@
-import google.generativeai as genai
-from config import GEMINI_API_KEY
-
-genai.configure(api_key=GEMINI_API_KEY)
+from modules.model_client import generate_content
 
 def generate_financial_report(data_summary: str) -> str:
     """Формирует аналитическую записку на основе данных."""
-    model = genai.GenerativeModel("gemini-1.5-pro")
     prompt = f"""
     На основе данных о движении денежных средств:
     {data_summary}
@@ -13,5 +9,5 @@ def generate_financial_report(data_summary: str) -> str:
     Составь краткую аналитическую записку для руководства.
     Сделай акцент на изменениях расходов, прибыли и налоговой нагрузке.
     """
-    response = model.generate_content(prompt)
+    response = generate_content(prompt, model_name="gemini-1.5-pro", usage={"operation": "report"})
     return response.text
@@ -0,0 +1,103 @@
+"""
+Переобработка архива по сохранённым ответам модели (raw_extractions).
+
+После исправления classify_transaction или правил аномалий история пересчитывается
+без повторного извлечения: классификация, привязка контрагентов и поиск аномалий
+запускаются заново на сохранённых ответах, пачками по batch_size файлов.
+Модель не вызывается, поэтому переобработка бесплатна.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from config import REPROCESS_BATCH_SIZE, REPROCESS_WORKERS
+from modules.database import iter_stored_extractions, replace_file_transactions
+from modules.pipeline import enrich_transactions
+
+logger = logging.getLogger(__name__)
+
+def _enrich_file(transactions):
+    return enrich_transactions(transactions)[1]
+
+def reprocess_extractions(file_ids=None, batch_size=REPROCESS_BATCH_SIZE, workers=REPROCESS_WORKERS,
+                          dry_run=False, progress=None):
+    """Переобрабатывает сохранённые ответы модели и обновляет транзакции в БД.
+    
+    Args:
+        file_ids: только эти файлы (по умолчанию — все)
+        workers: процессов для классификации и поиска аномалий (1 — в текущем процессе)
+        dry_run: посчитать изменения, ничего не записывая
+        progress: функция, получающая сводку после каждой пачки
+    
+    Returns:
+        Сводка: файлов, транзакций, изменённых транзакций, файлов по источникам, время
+    """
+    started = time.perf_counter()
+    summary = {
+        'files': 0, 'transactions': 0, 'changed': 0,
+        'from_raw': 0, 'from_rows': 0, 'dry_run': dry_run,
+    }
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for batch in iter_stored_extractions(batch_size, file_ids):
+            extractions = [transactions for _, transactions, _ in batch]
+            if pool:
+                enriched = list(pool.map(_enrich_file, extractions, chunksize=max(1, len(extractions) // (workers * 4))))
+            else:
+                enriched = [_enrich_file(transactions) for transactions in extractions]
+            summary['changed'] += replace_file_transactions(
+                [(file_id, transactions) for (file_id, _, _), transactions in zip(batch, enriched)],
+                dry_run=dry_run
+            )
+            summary['files'] += len(batch)
+            summary['transactions'] += sum(len(transactions) for transactions in enriched)
+            for _, _, source in batch:
+                summary['from_' + source] += 1
+            summary['seconds'] = round(time.perf_counter() - started, 3)
+            if progress:
+                progress(dict(summary))
+    finally:
+        if pool:
+            pool.shutdown()
+    summary['seconds'] = round(time.perf_counter() - started, 3)
+    return summary
+
+class ReprocessJob:
+    """Фоновая переобработка для веб-интерфейса: одновременно выполняется не больше одной"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.status = {'state': 'idle'}
+
+    def start(self, **kwargs):
+        """Запускает переобработку в фоне. False, если она уже идёт"""
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return False
+            self.status = {'state': 'running', 'started_at': time.time(), 'progress': None}
+            self.thread = threading.Thread(target=self._run, kwargs=kwargs, daemon=True)
+            self.thread.start()
+        return True
+
+    def _run(self, **kwargs):
+        try:
+            summary = reprocess_extractions(progress=self._update_progress, **kwargs)
+            self._finish(state='done', summary=summary)
+        except Exception as e:
+            logger.exception("Ошибка переобработки")
+            self._finish(state='failed', error=str(e))
+
+    def _update_progress(self, summary):
+        with self.lock:
+            self.status['progress'] = summary
+
+    def _finish(self, **fields):
+        with self.lock:
+            self.status.update(fields, finished_at=time.time())
+
+    def get_status(self):
+        with self.lock:
+            return dict(self.status)
+
+# Глобальное задание переобработки
+reprocess_job = ReprocessJob()
@@ -0,0 +1,294 @@
+"""
+Объединение одинаковых одновременных извлечений (single-flight):
+- Внутри процесса повторные запросы ждут первый и получают его результат
+- Между воркерами координация идёт через таблицу блокировок в SQLite; готовый результат
+  получают только воркеры, ждавшие его, и только без записей об ошибках — это объединение
+  одновременных вызовов, а не кэш
+- stream — то же для потоковой выдачи: ведущий отдаёт элементы по мере получения
+- run_shared_async — межпроцессная часть для asyncio-конвейера: ожидание не занимает поток
+"""
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+import time
+import uuid
+from threading import Lock, Event
+from config import MODEL_STATE_DB, SINGLE_FLIGHT_TIMEOUT
+
+def has_no_errors(result):
+    """Результат извлечения без записей с "error" (ошибка модели или разбора ответа)"""
+    items = result if isinstance(result, list) else [result]
+    return not any(isinstance(item, dict) and "error" in item for item in items)
+
+class _Call:
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
+        # Ведущий вернул результат (а не упал и не был прерван)
+        self.succeeded = False
+
+class SingleFlight:
+    def __init__(self, db_path=None, timeout=600, poll_interval=0.5, result_ttl=30, shareable=None):
+        self.lock = Lock()
+        # Выполняющиеся сейчас вызовы в этом процессе: ключ -> _Call
+        self.calls = {}
+        # Путь к SQLite для координации между воркерами (None — только процесс)
+        self.db_path = db_path
+        # Сколько ждать чужой результат, прежде чем выполнить работу самостоятельно
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        # Сколько хранить готовый результат, если ожидавший его воркер так и не забрал
+        self.result_ttl = result_ttl
+        # shareable(result) — можно ли отдать результат ожидающим воркерам (None — любой не-None)
+        self.shareable = shareable
+        self.stats = {'leaders': 0, 'followers': 0, 'shared_followers': 0}
+        if self.db_path:
+            self._init_shared_state()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+
+    def _init_shared_state(self):
+        """Создание таблиц блокировок и готовых результатов"""
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS flight_locks (
+                flight_key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                acquired_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS flight_results (
+                flight_key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        # Воркеры, ждущие результат по ключу: результат публикуется только для них
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS flight_waiters (
+                flight_key TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                since REAL NOT NULL,
+                PRIMARY KEY (flight_key, owner)
+            )
+        ''')
+        conn.close()
+
+    def _join(self, key):
+        """Вызов по ключу в этом процессе. Возвращает (_Call, ведущий ли)"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.stats['leaders'] += 1
+            else:
+                self.stats['followers'] += 1
+        return call, leader
+
+    def _follow(self, call):
+        """Дождаться ведущего этого процесса. Возвращает его результат или None, если выполнять самим"""
+        call.event.wait(self.timeout)
+        if call.error is not None:
+            raise call.error
+        if not call.succeeded:
+            # Не дождались или ведущий прерван (таймаут воркера, GeneratorExit) — выполняем сами
+            return None
+        return copy.deepcopy(call.result)
+
+    def _finish(self, key, call):
+        with self.lock:
+            self.calls.pop(key, None)
+        call.event.set()
+
+    def do(self, key, fn):
+        """Выполнить fn() один раз для всех одновременных вызовов с одинаковым ключом"""
+        call, leader = self._join(key)
+        if not leader:
+            result = self._follow(call)
+            return fn() if result is None else result
+
+        try:
+            result = self._run_shared(key, fn) if self.db_path else fn()
+            # Снимок для ожидающих: вызывающий может менять свой экземпляр
+            call.result = copy.deepcopy(result)
+            call.succeeded = True
+            return result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
+
+    def stream(self, key, make_iter):
+        """Потоковый вариант do: ведущий отдаёт элементы make_iter() по мере получения,
+        одновременные вызовы с тем же ключом (и do с ним же) получают весь список после него"""
+        call, leader = self._join(key)
+        if not leader:
+            result = self._follow(call)
+            yield from make_iter() if result is None else result
+            return
+
+        owner = None
+        try:
+            shared = None
+            if self.db_path:
+                owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+                is_owner, shared = self._lead_or_wait(key, owner)
+                if not is_owner:
+                    owner = None
+            items = []
+            for item in make_iter() if shared is None else shared:
+                items.append(copy.deepcopy(item))
+                yield item
+            call.result = items
+            call.succeeded = True
+            if owner is not None:
+                self._release(key, owner, items)
+                owner = None
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            # Прерванный поток (клиент отключился) снимает блокировку без результата
+            if owner is not None:
+                self._release(key, owner, None)
+            self._finish(key, call)
+
+    def _lead_or_wait(self, key, owner):
+        """Взять межпроцессную блокировку или дождаться чужого результата.
+        Возвращает (владелец ли, результат); (False, None) — не дождались за timeout"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            is_owner, result = self._acquire_or_fetch(key, owner)
+            if is_owner:
+                return True, None
+            if result is not None:
+                with self.lock:
+                    self.stats['shared_followers'] += 1
+                return False, result
+            if time.monotonic() > deadline:
+                return False, None
+            time.sleep(self.poll_interval)
+
+    def _run_shared(self, key, fn):
+        """Выполнить fn() под межпроцессной блокировкой или дождаться чужого результата"""
+        owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+        is_owner, result = self._lead_or_wait(key, owner)
+        if not is_owner:
+            return fn() if result is None else result
+
+        try:
+            result = fn()
+        except BaseException:
+            self._release(key, owner, None)
+            raise
+        self._release(key, owner, result)
+        return result
+
+    async def run_shared_async(self, key, make_coroutine):
+        """Асинхронный вариант _run_shared: блокировка между воркерами, ожидание через asyncio.sleep.
+
+        Объединение внутри процесса остаётся за вызывающим (задачи одного цикла событий).
+        """
+        if not self.db_path:
+            return await make_coroutine()
+        owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+        deadline = time.monotonic() + self.timeout
+        while True:
+            is_owner, result = await asyncio.to_thread(self._acquire_or_fetch, key, owner)
+            if is_owner:
+                break
+            if result is not None:
+                with self.lock:
+                    self.stats['shared_followers'] += 1
+                return result
+            if time.monotonic() > deadline:
+                return await make_coroutine()
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            result = await make_coroutine()
+        except BaseException:
+            # В том числе отмена: блокировка не должна висеть до таймаута
+            await asyncio.to_thread(self._release, key, owner, None)
+            raise
+        await asyncio.to_thread(self._release, key, owner, result)
+        return result
+
+    def _acquire_or_fetch(self, key, owner):
+        """Взять блокировку по ключу или встать в ожидающие. Возвращает (владелец ли, готовый результат).
+
+        Результат отдаётся только тому, кто ждал его, пока работа шла; последний забравший удаляет его.
+        """
+        conn = self._connect()
+        try:
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM flight_results WHERE created_at < ?', (now - self.result_ttl,))
+            conn.execute('DELETE FROM flight_waiters WHERE since < ?', (now - self.timeout - self.result_ttl,))
+            waiting = conn.execute(
+                'DELETE FROM flight_waiters WHERE flight_key = ? AND owner = ?', (key, owner)
+            ).rowcount == 1
+            row = conn.execute('SELECT result FROM flight_results WHERE flight_key = ?', (key,)).fetchone()
+            if row and waiting:
+                remaining = conn.execute(
+                    'SELECT COUNT(*) FROM flight_waiters WHERE flight_key = ?', (key,)
+                ).fetchone()[0]
+                if not remaining:
+                    conn.execute('DELETE FROM flight_results WHERE flight_key = ?', (key,))
+                conn.execute('COMMIT')
+                return False, json.loads(row[0])
+            # Блокировка упавшего воркера не должна держать остальных вечно
+            conn.execute(
+                'DELETE FROM flight_locks WHERE flight_key = ? AND acquired_at < ?',
+                (key, now - self.timeout)
+            )
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO flight_locks (flight_key, owner, acquired_at) VALUES (?, ?, ?)',
+                (key, owner, now)
+            )
+            if cursor.rowcount == 1:
+                conn.execute('COMMIT')
+                return True, None
+            conn.execute(
+                'INSERT INTO flight_waiters (flight_key, owner, since) VALUES (?, ?, ?)',
+                (key, owner, now)
+            )
+            conn.execute('COMMIT')
+            return False, None
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            # Без общей координации просто выполняем работу сами
+            return True, None
+        finally:
+            conn.close()
+
+    def _release(self, key, owner, result):
+        """Снять блокировку и опубликовать результат, если его ждут другие воркеры.
+        Без ожидающих или с ошибками результат не сохраняется: повторная загрузка извлекается заново"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            waiters = conn.execute('SELECT COUNT(*) FROM flight_waiters WHERE flight_key = ?', (key,)).fetchone()[0]
+            if result is not None and waiters and (self.shareable is None or self.shareable(result)):
+                conn.execute(
+                    'INSERT OR REPLACE INTO flight_results (flight_key, result, created_at) VALUES (?, ?, ?)',
+                    (key, json.dumps(result, ensure_ascii=False), time.time())
+                )
+            conn.execute('DELETE FROM flight_locks WHERE flight_key = ? AND owner = ?', (key, owner))
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+        finally:
+            conn.close()
+
+# Глобальный экземпляр для извлечения транзакций из документов
+extraction_flight = SingleFlight(db_path=MODEL_STATE_DB, timeout=SINGLE_FLIGHT_TIMEOUT, shareable=has_no_errors)
@@ -0,0 +1,39 @@
+function renderStats(data) {
+    document.getElementById('onlineUsers').textContent = data.online_users;
+    document.getElementById('processingFiles').textContent = data.processing_files;
+}
+
+function updateStats() {
+    fetch('/api/stats')
+        .then(response => response.json())
+        .then(renderStats)
+        .catch(error => console.error('Ошибка загрузки статистики:', error));
+}
+
+if (window.EventSource) {
+    // Сервер присылает статистику только при изменениях и сам держит соединение
+    const statsStream = new EventSource('/api/stats/stream');
+    statsStream.onmessage = event => renderStats(JSON.parse(event.data));
+} else {
+    updateStats();
+    setInterval(updateStats, 5000);
+}
+
+function showLoading(text) {
+    const overlay = document.getElementById('loadingOverlay');
+    const loadingText = overlay.querySelector('.loading-text');
+    loadingText.textContent = text;
+    overlay.classList.add('show');
+}
+
+document.getElementById('uploadForm').addEventListener('submit', function(e) {
+    const submitBtn = document.getElementById('uploadSubmit');
+    submitBtn.disabled = true;
+    showLoading('Обработка документа...');
+});
+
+document.getElementById('chatForm').addEventListener('submit', function(e) {
+    const submitBtn = document.getElementById('chatSubmit');
+    submitBtn.disabled = true;
+    showLoading('Получение ответа от ИИ...');
+});
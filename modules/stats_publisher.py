@@ -0,0 +1,84 @@
+"""
+Рассылка статистики подписчикам через Server-Sent Events.
+
+Один фоновый поток на процесс опрашивает StatsTracker и будит подписчиков
+только при изменении данных. Между изменениями поток подписчика шлёт
+heartbeat-комментарии, которые заодно отмечают активность пользователя.
+"""
+import json
+import time
+from threading import Condition, Thread
+from config import STATS_POLL_INTERVAL, STATS_HEARTBEAT_INTERVAL, STATS_STREAM_MAX_DURATION
+from modules.stats_tracker import stats_tracker
+
+# Через сколько браузер переподключается к закрытому потоку (мс)
+RECONNECT_DELAY_MS = 5000
+
+class StatsPublisher:
+    def __init__(self, tracker, poll_interval=1.0, heartbeat_interval=15.0, max_stream_duration=300.0):
+        self.tracker = tracker
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        # Поток закрывается по истечении этого срока, браузер сам переподключится
+        self.max_stream_duration = max_stream_duration
+        self.condition = Condition()
+        # Номер версии растёт при каждом изменении снимка статистики
+        self.version = 0
+        self.snapshot = None
+        self.subscribers = 0
+        self.thread = None
+
+    def _ensure_started(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="stats-publisher", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        """Опрос трекера, пока есть подписчики"""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.subscribers > 0)
+            stats = self.tracker.get_stats()
+            with self.condition:
+                if stats != self.snapshot:
+                    self.snapshot = stats
+                    self.version += 1
+                    self.condition.notify_all()
+            time.sleep(self.poll_interval)
+
+    def subscribe(self, on_heartbeat=None):
+        """Генератор SSE-событий для одного подписчика"""
+        self._ensure_started()
+        with self.condition:
+            self.subscribers += 1
+            self.condition.notify_all()
+        try:
+            yield f"retry: {RECONNECT_DELAY_MS}\n\n"
+            seen_version = None
+            deadline = time.monotonic() + self.max_stream_duration
+            while time.monotonic() < deadline:
+                if on_heartbeat:
+                    on_heartbeat()
+                with self.condition:
+                    self.condition.wait_for(
+                        lambda: self.snapshot is not None and self.version != seen_version,
+                        timeout=self.heartbeat_interval
+                    )
+                    version, snapshot = self.version, self.snapshot
+                if snapshot is not None and version != seen_version:
+                    seen_version = version
+                    yield f"data: {json.dumps(snapshot)}\n\n"
+                else:
+                    yield ": heartbeat\n\n"
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+# Глобальный издатель статистики
+stats_publisher = StatsPublisher(
+    stats_tracker,
+    poll_interval=STATS_POLL_INTERVAL,
+    heartbeat_interval=STATS_HEARTBEAT_INTERVAL,
+    max_stream_duration=STATS_STREAM_MAX_DURATION
+)
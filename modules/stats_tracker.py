@@ -2,64 +2,289 @@
 Модуль для отслеживания статистики в реальном времени:
 - Активные пользователи онлайн
 - Файлы в процессе обработки
+- Счётчики этапов обработки
+
+При нескольких воркерах gunicorn статистика сводится через общую SQLite-базу.
 """
+import logging
+import os
+import sqlite3
 import time
+import uuid
 from threading import Lock
-from collections import defaultdict
+from collections import OrderedDict
+from config import STATS_BACKEND, STATS_DB
+
+logger = logging.getLogger(__name__)
+
+def _pid_alive(pid):
+    """Жив ли процесс на этой машине (общая база SQLite — локальный файл, воркеры на одном хосте)"""
+    if os.name != 'posix' or not pid:
+        # На Windows сигнал 0 завершил бы процесс: там полагаемся только на stale_job_timeout
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Процесс есть, но принадлежит другому пользователю
+        return True
+    return True
+
+class SharedStatsStore:
+    """Общее для всех воркеров хранилище статистики в SQLite"""
+    def __init__(self, db_path, stale_job_timeout=3600, cleanup_interval=30):
+        self.db_path = db_path
+        # Задачи воркеров старше этого срока не учитываются (в секундах); задачи завершившихся
+        # воркеров удаляются раньше, при очистке по проверке pid
+        self.stale_job_timeout = stale_job_timeout
+        self.cleanup_interval = cleanup_interval
+        self.last_cleanup = 0.0
+        self._init_tables()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+
+    def _init_tables(self):
+        """Создание таблиц общей статистики"""
+        conn = self._connect()
+        # WAL: читатели не блокируют запись из других воркеров
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS presence (
+                session_id TEXT PRIMARY KEY,
+                last_seen REAL NOT NULL,
+                since REAL
+            )
+        ''')
+        # since — начало текущего периода присутствия: после ухода в offline строка удаляется,
+        # и по возвращении период начинается заново (по нему история чата отличает старые разговоры)
+        if 'since' not in {row[1] for row in conn.execute('PRAGMA table_info(presence)')}:
+            conn.execute('ALTER TABLE presence ADD COLUMN since REAL')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_presence_last_seen ON presence (last_seen)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS processing_jobs (
+                job_id TEXT PRIMARY KEY,
+                filename TEXT,
+                pid INTEGER,
+                started_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS stage_counters (
+                stage TEXT PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        conn.close()
+
+    def touch_session(self, session_id, last_seen, user_timeout):
+        """Отметить активность сессии и изредка удалить устаревшие записи"""
+        conn = self._connect()
+        conn.execute(
+            'INSERT INTO presence (session_id, last_seen, since) VALUES (?, ?, ?) '
+            'ON CONFLICT(session_id) DO UPDATE SET last_seen = excluded.last_seen, '
+            # Вернулся после offline, а очистка строку ещё не удалила — новый период присутствия
+            'since = CASE WHEN presence.last_seen < ? THEN excluded.since ELSE presence.since END',
+            (session_id, last_seen, last_seen, last_seen - user_timeout)
+        )
+        if last_seen - self.last_cleanup > self.cleanup_interval:
+            self.last_cleanup = last_seen
+            conn.execute('DELETE FROM presence WHERE last_seen < ?', (last_seen - user_timeout,))
+            conn.execute('DELETE FROM processing_jobs WHERE started_at < ?', (last_seen - self.stale_job_timeout,))
+            self._remove_dead_jobs(conn)
+        conn.close()
+
+    def _remove_dead_jobs(self, conn):
+        """Удалить задачи упавших или перезапущенных воркеров, не дожидаясь stale_job_timeout"""
+        pids = [pid for (pid,) in conn.execute('SELECT DISTINCT pid FROM processing_jobs')]
+        dead = [pid for pid in pids if not _pid_alive(pid)]
+        if dead:
+            conn.executemany('DELETE FROM processing_jobs WHERE pid = ?', [(pid,) for pid in dead])
+
+    def count_sessions(self, since):
+        conn = self._connect()
+        count = conn.execute('SELECT COUNT(*) FROM presence WHERE last_seen >= ?', (since,)).fetchone()[0]
+        conn.close()
+        return count
+
+    def add_job(self, job_id, filename, started_at):
+        conn = self._connect()
+        conn.execute(
+            'INSERT OR REPLACE INTO processing_jobs (job_id, filename, pid, started_at) VALUES (?, ?, ?, ?)',
+            (job_id, filename, os.getpid(), started_at)
+        )
+        conn.close()
+
+    def remove_job(self, job_id):
+        conn = self._connect()
+        conn.execute('DELETE FROM processing_jobs WHERE job_id = ?', (job_id,))
+        conn.close()
+
+    def count_jobs(self, since):
+        conn = self._connect()
+        count = conn.execute('SELECT COUNT(*) FROM processing_jobs WHERE started_at >= ?', (since,)).fetchone()[0]
+        conn.close()
+        return count
+
+    def increment(self, stage, amount):
+        """Атомарное увеличение счётчика этапа"""
+        conn = self._connect()
+        conn.execute(
+            'INSERT INTO stage_counters (stage, count) VALUES (?, ?) '
+            'ON CONFLICT(stage) DO UPDATE SET count = count + excluded.count',
+            (stage, amount)
+        )
+        conn.close()
+
+    def get_counters(self):
+        conn = self._connect()
+        counters = dict(conn.execute('SELECT stage, count FROM stage_counters').fetchall())
+        conn.close()
+        return counters
 
 class StatsTracker:
-    def __init__(self):
+    def __init__(self, user_timeout=60, activity_throttle=10, store=None, stats_cache_ttl=1.0):
         self.lock = Lock()
-        # Храним время последней активности для каждого пользователя (по session ID)
-        self.active_users = {}
-        # Храним файлы в обработке
-        self.processing_files = set()
+        # Время последней активности по session ID, упорядочено от самой старой к самой свежей:
+        # устаревшие сессии всегда в начале, и очистка не просматривает весь словарь
+        self.active_users = OrderedDict()
+        # Храним задачи обработки: job_id -> имя файла
+        self.processing_files = {}
+        # Счётчики этапов обработки этого процесса
+        self.counters = {}
         # Время бездействия после которого пользователь считается offline (в секундах)
-        self.user_timeout = 60
-    
+        self.user_timeout = user_timeout
+        # Одна сессия обновляется не чаще раза в этот интервал (в секундах)
+        self.activity_throttle = activity_throttle
+        # Общее хранилище для нескольких воркеров (None — статистика только этого процесса)
+        self.store = store
+        # Сводка из общего хранилища кэшируется на этот срок, чтобы частые опросы не нагружали базу
+        self.stats_cache_ttl = stats_cache_ttl
+        self.cached_stats = None
+        self.cached_stats_at = 0.0
+        # Обработчики ухода сессии в offline: получают session ID (например, очистка истории чата)
+        self.expiry_listeners = []
+
+    def add_expiry_listener(self, callback):
+        """Подписать обработчик на истечение неактивных сессий этого процесса"""
+        self.expiry_listeners.append(callback)
+
+    def _notify_expired(self, expired):
+        """Вызов обработчиков вне блокировки: они могут брать свои блокировки"""
+        for session_id in expired:
+            for callback in self.expiry_listeners:
+                try:
+                    callback(session_id)
+                except Exception:
+                    logger.exception("Ошибка обработчика истечения сессии")
+
     def update_user_activity(self, session_id):
-        """Обновить активность пользователя"""
-        with self.lock:
-            self.active_users[session_id] = time.time()
-            self._cleanup_inactive_users()
-    
-    def _cleanup_inactive_users(self):
-        """Удалить неактивных пользователей"""
+        """Обновить активность пользователя (амортизированно O(1))"""
         current_time = time.time()
-        inactive = [
-            sid for sid, last_active in self.active_users.items()
-            if current_time - last_active > self.user_timeout
-        ]
-        for sid in inactive:
+        # Быстрая проверка без блокировки: недавно обновлённую сессию не трогаем
+        last_active = self.active_users.get(session_id)
+        if last_active is not None and current_time - last_active < self.activity_throttle:
+            return
+        with self.lock:
+            self.active_users[session_id] = current_time
+            self.active_users.move_to_end(session_id)
+            expired = self._cleanup_inactive_users(current_time)
+        self._notify_expired(expired)
+        if self.store:
+            self._safe_store_call(self.store.touch_session, session_id, current_time, self.user_timeout)
+
+    def _cleanup_inactive_users(self, current_time=None):
+        """Удалить неактивных пользователей с начала очереди. Возвращает их session ID"""
+        if current_time is None:
+            current_time = time.time()
+        deadline = current_time - self.user_timeout
+        expired = []
+        while self.active_users:
+            sid, last_active = next(iter(self.active_users.items()))
+            if last_active >= deadline:
+                break
             del self.active_users[sid]
-    
+            expired.append(sid)
+        return expired
+
+    def _safe_store_call(self, method, *args):
+        """Ошибки общего хранилища не должны ломать обработку запроса"""
+        try:
+            return method(*args)
+        except sqlite3.Error:
+            return None
+
     def get_online_users_count(self):
         """Получить количество активных пользователей"""
         with self.lock:
-            self._cleanup_inactive_users()
-            return len(self.active_users)
-    
+            expired = self._cleanup_inactive_users()
+            count = len(self.active_users)
+        self._notify_expired(expired)
+        return count
+
     def start_processing(self, filename):
-        """Начать обработку файла"""
+        """Начать обработку файла. Возвращает идентификатор задачи"""
+        job_id = uuid.uuid4().hex
         with self.lock:
-            self.processing_files.add(filename)
-    
-    def finish_processing(self, filename):
-        """Завершить обработку файла"""
+            self.processing_files[job_id] = filename
+        if self.store:
+            self._safe_store_call(self.store.add_job, job_id, filename, time.time())
+        return job_id
+
+    def finish_processing(self, job_id):
+        """Завершить обработку задачи"""
         with self.lock:
-            self.processing_files.discard(filename)
-    
+            self.processing_files.pop(job_id, None)
+        if self.store:
+            self._safe_store_call(self.store.remove_job, job_id)
+
     def get_processing_files_count(self):
         """Получить количество файлов в обработке"""
         with self.lock:
             return len(self.processing_files)
-    
+
+    def increment(self, stage, amount=1):
+        """Увеличить счётчик этапа обработки"""
+        with self.lock:
+            self.counters[stage] = self.counters.get(stage, 0) + amount
+        if self.store:
+            self._safe_store_call(self.store.increment, stage, amount)
+
     def get_stats(self):
-        """Получить полную статистику"""
+        """Получить полную статистику (по всем воркерам, если есть общее хранилище)"""
+        if self.store:
+            current_time = time.time()
+            if self.cached_stats is not None and current_time - self.cached_stats_at < self.stats_cache_ttl:
+                return self.cached_stats
+            shared = self._get_shared_stats(current_time)
+            if shared is not None:
+                self.cached_stats = shared
+                self.cached_stats_at = current_time
+                return shared
+        with self.lock:
+            counters = dict(self.counters)
         return {
             'online_users': self.get_online_users_count(),
-            'processing_files': self.get_processing_files_count()
+            'processing_files': self.get_processing_files_count(),
+            'counters': counters
         }
 
+    def _get_shared_stats(self, current_time):
+        """Сводка по всем воркерам из общего хранилища"""
+        try:
+            return {
+                'online_users': self.store.count_sessions(current_time - self.user_timeout),
+                'processing_files': self.store.count_jobs(current_time - self.store.stale_job_timeout),
+                'counters': self.store.get_counters()
+            }
+        except sqlite3.Error:
+            return None
+
+def create_stats_tracker(backend=STATS_BACKEND, db_path=STATS_DB):
+    """Трекер с общим SQLite-хранилищем или только в памяти процесса"""
+    store = SharedStatsStore(db_path) if backend == "sqlite" else None
+    return StatsTracker(store=store)
+
 # Глобальный экземпляр трекера
-stats_tracker = StatsTracker()
+stats_tracker = create_stats_tracker()
@@ -0,0 +1,283 @@
+"""
+Лёгкая трассировка запросов: спаны этапов обработки в локальном JSONL-файле.
+
+- Трейс начинается в start_trace (запрос /upload, /chat, обработка файла из папки)
+  с вероятностью TRACE_SAMPLE_RATE; заголовок X-Trace: 1 от администратора
+  трассирует запрос принудительно
+- Этапы внутри трейса — span(name, **атрибуты); текущий спан хранится в ContextVar,
+  поэтому переходит в asyncio-задачи и в потоки, запущенные через propagate()
+- Спаны трейса пишутся в файл одной записью, когда завершается корневой спан;
+  файл ротируется по размеру (TRACE_MAX_BYTES, TRACE_BACKUP_COUNT), запись и
+  ротация безопасны для нескольких воркеров
+- Вне трейса span() возвращает общий пустой объект: при выключенной трассировке
+  накладные расходы — одно чтение ContextVar на этап
+
+set_trace_attribute(file_id=...) помечает трейс, чтобы его можно было найти по файлу.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+from pathlib import Path
+from config import TRACE_SAMPLE_RATE, TRACE_FILE, TRACE_MAX_BYTES, TRACE_BACKUP_COUNT
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Текущий спан (None — вне трейса или трейс не попал в выборку)
+current_span = contextvars.ContextVar('trace_span', default=None)
+
+class _NoopSpan:
+    """Спан вне трейса: ничего не измеряет и не пишет"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def end(self):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+class Trace:
+    """Спаны одного трейса, накопленные до завершения корневого спана"""
+    def __init__(self, exporter):
+        self.trace_id = secrets.token_hex(8)
+        self.exporter = exporter
+        self.lock = threading.Lock()
+        self.records = []
+        self.closed = False
+        self.root = None
+
+    def finish(self, span):
+        record = span.as_dict()
+        with self.lock:
+            if self.closed:
+                # Спан фонового потока пережил корневой — пишется отдельно
+                records = [record]
+            else:
+                self.records.append(record)
+                if span is not self.root:
+                    return
+                self.closed = True
+                records, self.records = self.records, []
+        self.exporter.export(records)
+
+class Span:
+    """Этап трейса. Время начала фиксируется при создании, конец — в end() или при выходе из with"""
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes', 'start', '_started', 'duration',
+                 'thread', '_token')
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(4)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.duration = None
+        self.thread = threading.current_thread().name
+        self._token = None
+
+    def __enter__(self):
+        self._token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            current_span.reset(self._token)
+        except ValueError:
+            # Генератор продолжили в другом контексте (например, в другом потоке)
+            pass
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            self.attributes['error'] = f"{exc_type.__name__}: {exc}"
+        self.end()
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self._started
+            self.trace.finish(self)
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': round(self.start, 6),
+            'duration_ms': round(self.duration * 1000, 3),
+            'pid': os.getpid(),
+            'thread': self.thread,
+            'attributes': self.attributes,
+        }
+
+class JsonlSpanExporter:
+    """Запись спанов в JSONL с ротацией по размеру: path, path.1 ... path.N"""
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+        self.fd = None
+        self.exported = 0
+        self.errors = 0
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _current_fd(self):
+        """Дескриптор текущего файла: после ротации другим воркером открываем новый"""
+        if self.fd is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.fd).st_ino:
+                    return self.fd
+            except FileNotFoundError:
+                pass
+            os.close(self.fd)
+        self.fd = self._open()
+        return self.fd
+
+    def _rotate(self):
+        """Сдвиг файлов под межпроцессной блокировкой; размер перепроверяется — другой воркер мог успеть"""
+        lock_fd = os.open(str(self.path) + ".lock", os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            if not self.path.exists() or self.path.stat().st_size < self.max_bytes:
+                return
+            for index in range(self.backup_count - 1, 0, -1):
+                source = Path(f"{self.path}.{index}")
+                if source.exists():
+                    os.replace(source, f"{self.path}.{index + 1}")
+            if self.backup_count > 0:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+        finally:
+            os.close(lock_fd)
+
+    def export(self, records):
+        # Одна запись write() на трейс: строки разных воркеров не перемешиваются
+        data = "".join(json.dumps(record, ensure_ascii=False, default=str, separators=(',', ':')) + "\n"
+                       for record in records).encode("utf-8")
+        try:
+            with self.lock:
+                fd = self._current_fd()
+                os.write(fd, data)
+                self.exported += len(records)
+                if os.fstat(fd).st_size >= self.max_bytes:
+                    self._rotate()
+        except OSError as e:
+            self.errors += 1
+            logger.warning("Не удалось записать трейс: %s", e)
+
+    def files(self):
+        """Файлы трейсов от старых к новым"""
+        backups = [Path(f"{self.path}.{index}") for index in range(self.backup_count, 0, -1)]
+        return [path for path in backups + [self.path] if path.exists()]
+
+    def read(self, marker):
+        """Записи спанов, в строке которых встречается marker (быстрый отсев до разбора JSON)"""
+        for path in self.files():
+            with open(path, encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    if marker in line:
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            continue
+
+def start_trace(name, force=False, **attributes):
+    """Корневой спан нового трейса, если он попал в выборку (или force).
+
+    Внутри уже идущего трейса возвращает дочерний спан.
+    """
+    parent = current_span.get()
+    if parent is not None:
+        return Span(parent.trace, name, parent.span_id, attributes)
+    if not force and (TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE):
+        return NOOP_SPAN
+    trace = Trace(span_exporter)
+    trace.root = Span(trace, name, None, attributes)
+    return trace.root
+
+def span(name, **attributes):
+    """Дочерний спан текущего этапа или пустой спан вне трейса"""
+    parent = current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+def set_trace_attribute(**attributes):
+    """Атрибуты корневого спана текущего трейса (например, file_id для поиска трейса)"""
+    parent = current_span.get()
+    if parent is not None:
+        parent.trace.root.set(**attributes)
+
+def propagate(fn):
+    """Функция, выполняемая в копии текущего контекста: спан переходит в поток пула"""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.run(fn, *args, **kwargs)
+    return run
+
+def load_trace(trace_id):
+    """Спаны трейса в порядке начала"""
+    spans = [record for record in span_exporter.read(f'"trace_id":"{trace_id}"') if record.get('trace_id') == trace_id]
+    return sorted(spans, key=lambda record: record['start'])
+
+def find_traces(file_id):
+    """Трейсы обработки файла, от новых к старым: [(trace_id, спаны)]"""
+    trace_ids = []
+    for record in span_exporter.read(f'"file_id":{file_id}'):
+        if record.get('attributes', {}).get('file_id') == file_id and record['trace_id'] not in trace_ids:
+            trace_ids.append(record['trace_id'])
+    return [(trace_id, load_trace(trace_id)) for trace_id in reversed(trace_ids)]
+
+def waterfall_rows(spans):
+    """Строки диаграммы трейса: спаны в порядке дерева с глубиной и положением полосы (в % от длительности трейса)"""
+    if not spans:
+        return []
+    started = min(record['start'] for record in spans)
+    finished = max(record['start'] + record['duration_ms'] / 1000 for record in spans)
+    total = max(finished - started, 1e-6)
+    children = {}
+    known = {record['span_id'] for record in spans}
+    for record in spans:
+        parent_id = record['parent_id'] if record['parent_id'] in known else None
+        children.setdefault(parent_id, []).append(record)
+
+    rows = []
+    stack = [(record, 0) for record in reversed(children.get(None, []))]
+    while stack:
+        record, depth = stack.pop()
+        rows.append({
+            **record,
+            'depth': depth,
+            'offset': round((record['start'] - started) / total * 100, 2),
+            'width': round(record['duration_ms'] / 1000 / total * 100, 2),
+        })
+        stack.extend((child, depth + 1) for child in reversed(children.get(record['span_id'], [])))
+    return rows
+
+# Глобальный экспортёр спанов
+span_exporter = JsonlSpanExporter(TRACE_FILE, TRACE_MAX_BYTES, TRACE_BACKUP_COUNT)
@@ -0,0 +1,183 @@
+"""
+Быстрая локальная сортировка документов перед извлечением через модель.
+
+Текст берётся из текстового слоя PDF (pypdfium2 — движок pdfplumber без разбора
+макета, на сканах в десятки раз быстрее), а для сканов и фотографий — из OCR
+первой страницы (tesseract, если установлен). По ключевым словам и
+структурным признакам (даты, суммы, ИНН) документ получает метку:
+- invoice — счёт, счёт-фактура, платёжное поручение
+- statement — выписка или реестр операций
+- act — акт выполненных работ / оказанных услуг
+- irrelevant — не финансовый документ (руководства, договоры без сумм и т.п.)
+- unknown — текст получить не удалось (скан без tesseract), решает модель
+
+Метка выбирает подсказку для извлечения, а irrelevant отклоняется без вызова модели.
+"""
+import logging
+import re
+from pathlib import Path
+from config import TRIAGE_MAX_PAGES, TRIAGE_OCR, TRIAGE_OCR_LANG, TRIAGE_OCR_TIMEOUT
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:
+    pytesseract = None
+
+logger = logging.getLogger(__name__)
+
+LABELS = ("invoice", "statement", "act", "irrelevant", "unknown")
+
+# Ключевые слова меток и их веса
+KEYWORDS = {
+    "invoice": [
+        (re.compile(r"сч[её]т\s*(на оплату|№|-\s*фактур)"), 3),
+        (re.compile(r"платежн\w* поручени"), 3),
+        (re.compile(r"к оплате|итого"), 2),
+        (re.compile(r"в т\.\s?ч\.\s?ндс|без ндс|\bндс\b"), 1),
+        (re.compile(r"покупател|плательщик|получател"), 1),
+    ],
+    "statement": [
+        (re.compile(r"выписк"), 3),
+        (re.compile(r"реестр (платеж|операц)"), 3),
+        (re.compile(r"остат\w* на (начало|конец)|входящий остаток|исходящий остаток"), 2),
+        (re.compile(r"оборот\w*|дебет|кредит"), 1),
+        (re.compile(r"списан|зачислен|поступлени"), 1),
+    ],
+    "act": [
+        (re.compile(r"\bакт\b"), 3),
+        (re.compile(r"выполненных работ|оказанных услуг|работы выполнены|услуги оказаны"), 3),
+        (re.compile(r"исполнител|заказчик"), 1),
+    ],
+}
+# Признаки нефинансового документа: инструкции, справки, маркетинговые материалы
+IRRELEVANT_RE = re.compile(
+    r"руководство пользовател|инструкци|нажмите|кнопк|меню|вкладк|окно|раздел \d|содержание|оглавление"
+)
+
+DATE_RE = re.compile(r"\b\d{1,2}[./-]\d{1,2}[./-](?:\d{4}|\d{2})\b")
+AMOUNT_RE = re.compile(r"\b\d{1,3}(?:[  ]\d{3})*[.,]\d{2}\b|\b\d+(?:[.,]\d{2})?\s?(?:руб|₽|rub)")
+INN_RE = re.compile(r"(?<!\d)(?:\d{10}|\d{12})(?!\d)")
+
+# Минимальный вес ключевых слов для уверенной метки
+MIN_KEYWORD_SCORE = 3
+
+# Текстовый слой короче — считаем страницу сканом
+MIN_TEXT_LAYER_CHARS = 20
+
+def _pdf_text(path, max_pages, ocr):
+    """Текст первых страниц PDF; без текстового слоя — OCR первой страницы"""
+    pdf = pdfium.PdfDocument(str(path))
+    try:
+        page_count = len(pdf)
+        pages_read = min(page_count, max_pages)
+        text = "\n".join(pdf[index].get_textpage().get_text_range() for index in range(pages_read))
+        if len(text.strip()) >= MIN_TEXT_LAYER_CHARS:
+            return text, "text", page_count, pages_read
+        if not ocr or not page_count:
+            return "", None, page_count, 0
+        image = pdf[0].render(scale=150 / 72).to_pil()
+        return _ocr(image), "ocr", page_count, 1
+    finally:
+        pdf.close()
+
+def pdf_page_count(path):
+    """Число страниц PDF по дереву страниц (без чтения файла в память); None, если не удалось"""
+    if pdfium is None:
+        return None
+    try:
+        pdf = pdfium.PdfDocument(str(path))
+    except Exception:
+        return None
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+def _ocr(image):
+    return pytesseract.image_to_string(image.convert("L"), lang=TRIAGE_OCR_LANG, timeout=TRIAGE_OCR_TIMEOUT)
+
+def document_text(path, max_pages=TRIAGE_MAX_PAGES, ocr=TRIAGE_OCR):
+    """Текст для сортировки: (текст, источник, страниц в документе, страниц прочитано).
+    Источник — text, ocr или None, если текст получить нечем"""
+    path = Path(path)
+    ocr = ocr and pytesseract is not None
+    if path.suffix.lower() == ".pdf":
+        if pdfium is None:
+            return "", None, None, 0
+        return _pdf_text(path, max_pages, ocr)
+    if not ocr:
+        return "", None, 1, 0
+    with Image.open(path) as image:
+        return _ocr(image), "ocr", 1, 1
+
+def estimate_rows(lines):
+    """Число строк-операций: строки с суммой и датой, а если таких нет — со суммой"""
+    with_date = sum(1 for line in lines if AMOUNT_RE.search(line) and DATE_RE.search(line))
+    if with_date > 1:
+        return with_date
+    # Реквизиты операции часто разнесены по строкам: считаем строки с суммами
+    return sum(1 for line in lines if AMOUNT_RE.search(line))
+
+def classify_text(text, page_count=1, pages_read=1):
+    """Метка документа по тексту первых страниц.
+
+    Returns:
+        dict: label, rows (оценка числа транзакций), scores и structure — признаки для отладки
+    """
+    lowered = text.casefold().replace("ё", "е")
+    lines = [line for line in lowered.splitlines() if line.strip()]
+    structure = {
+        "dates": len(DATE_RE.findall(lowered)),
+        "amounts": len(AMOUNT_RE.findall(lowered)),
+        "inns": len(INN_RE.findall(lowered)),
+    }
+    scores = {
+        label: sum(weight for pattern, weight in patterns if pattern.search(lowered))
+        for label, patterns in KEYWORDS.items()
+    }
+    irrelevant_hits = len(IRRELEVANT_RE.findall(lowered))
+    rows = estimate_rows(lines)
+    financial = structure["amounts"] + structure["inns"]
+
+    best = max(scores, key=scores.get)
+    if scores[best] >= MIN_KEYWORD_SCORE and financial > 0:
+        label = best
+    elif structure["amounts"] >= 3 and structure["dates"] >= 3:
+        # Текст без распознаваемых слов (например, из-за шрифта), но со строками операций
+        label = "statement"
+    elif financial >= 2 and structure["dates"] and irrelevant_hits == 0:
+        label = best if scores[best] else "invoice"
+    elif not lines:
+        label = "unknown"
+    elif scores[best] < MIN_KEYWORD_SCORE or irrelevant_hits > financial:
+        label = "irrelevant"
+    else:
+        # Ключевые слова документа есть, но сумм в распознаваемом виде нет (например, без копеек):
+        # irrelevant отклоняется без модели, поэтому решает модель
+        label = "unknown"
+
+    if label == "statement" and page_count and pages_read and page_count > pages_read:
+        # Выписки обычно однородны: экстраполируем число операций на все страницы
+        rows = round(rows * page_count / pages_read)
+    elif label in ("invoice", "act"):
+        rows = max(1, rows)
+    return {"label": label, "rows": rows, "scores": scores, "structure": structure}
+
+def triage_document(path):
+    """Сортировка файла. Ошибки чтения не мешают извлечению: метка unknown"""
+    try:
+        text, source, page_count, pages_read = document_text(path)
+    except Exception as e:
+        logger.warning("Не удалось прочитать %s для сортировки: %s", Path(path).name, e)
+        return {"label": "unknown", "rows": None, "source": None, "error": str(e)}
+    if source is None:
+        return {"label": "unknown", "rows": None, "source": None, "pages": page_count}
+    result = classify_text(text, page_count, pages_read)
+    result.update(source=source, pages=page_count)
+    return result
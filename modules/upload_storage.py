@@ -0,0 +1,85 @@
+"""
+Потоковое сохранение загруженных файлов на диск:
+- Запись частями без чтения файла целиком в память
+- SHA-256 считается по ходу записи
+- Ограничение размера файла
+"""
+import hashlib
+import os
+import uuid
+from pathlib import Path
+
+CHUNK_SIZE = 1024 * 1024
+
+class UploadTooLargeError(Exception):
+    """Файл превышает допустимый размер"""
+
+class StoredUpload:
+    def __init__(self, path, sha256, size):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+
+def reserve_upload_path(upload_dir, filename):
+    """Создаёт пустой файл с незанятым именем (name.pdf, name_1.pdf, name_2.pdf...) и возвращает путь"""
+    path = Path(upload_dir) / filename
+    counter = 1
+    while True:
+        try:
+            with open(path, "x"):
+                return path
+        except FileExistsError:
+            path = Path(upload_dir) / f"{Path(filename).stem}_{counter}{Path(filename).suffix}"
+            counter += 1
+
+class UploadWriter:
+    """Пишет загрузку частями во временный файл, считая хэш и размер.
+
+    Временный файл переименовывается только в commit(), так что обрывы
+    и превышение размера не оставляют мусора в каталоге загрузок.
+    """
+    def __init__(self, upload_dir, filename, max_bytes):
+        os.makedirs(upload_dir, exist_ok=True)
+        self.upload_dir = upload_dir
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.tmp_path = Path(upload_dir) / f".upload-{uuid.uuid4().hex}.part"
+        self.file = open(self.tmp_path, "wb")
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            self.abort()
+            raise UploadTooLargeError(
+                f"Файл превышает допустимый размер {self.max_bytes // (1024 * 1024)} МБ"
+            )
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self):
+        """Завершить запись и переместить файл под постоянным именем"""
+        self.file.close()
+        path = reserve_upload_path(self.upload_dir, self.filename)
+        os.replace(self.tmp_path, path)
+        return StoredUpload(path, self.digest.hexdigest(), self.size)
+
+    def abort(self):
+        """Прервать запись и удалить временный файл"""
+        self.file.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+def save_upload_stream(stream, upload_dir, filename, max_bytes, chunk_size=CHUNK_SIZE):
+    """Сохраняет поток в upload_dir частями и возвращает StoredUpload."""
+    writer = UploadWriter(upload_dir, filename, max_bytes)
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+        return writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
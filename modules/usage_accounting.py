@@ -0,0 +1,235 @@
+"""
+Учёт расхода модели по каждому вызову:
+- Токены запроса и ответа из usage_metadata ответа
+- Байты запроса и ответа, размер и число страниц исходного документа
+- Задержка и стоимость вызова по ценам из конфигурации
+- Сводки по дням, типам файлов, операциям и арендаторам
+- Дневной бюджет арендатора: при превышении вызовы модели отклоняются
+"""
+import contextvars
+import logging
+import secrets
+import sqlite3
+import time
+from threading import Lock
+from config import DB_PATH, MODEL_PRICES, TENANT_DAILY_BUDGET, TENANT_BUDGETS, TENANT_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# Арендатор текущего запроса; выставляется веб-интерфейсом по API-токену (resolve_tenant)
+current_tenant = contextvars.ContextVar('current_tenant', default='default')
+
+def resolve_tenant(token):
+    """Арендатор по API-токену из TENANT_TOKENS; неизвестный или пустой токен — "default".
+
+    Имя арендатора от клиента не принимается: иначе бюджет обходится сменой имени.
+    """
+    if token:
+        for known_token, tenant in TENANT_TOKENS.items():
+            if secrets.compare_digest(token.encode("utf-8"), known_token.encode("utf-8")):
+                return tenant
+    return 'default'
+
+ROLLUP_GROUPS = {
+    'day': 'date(created_at)',
+    'file_type': "COALESCE(file_type, '')",
+    'operation': 'operation',
+    'tenant': 'tenant',
+    'model': 'model',
+}
+
+def contents_size(contents):
+    """Размер содержимого запроса к модели в байтах (встроенные данные — после декодирования base64)"""
+    if contents is None:
+        return 0
+    if isinstance(contents, str):
+        return len(contents.encode('utf-8'))
+    if isinstance(contents, dict):
+        if 'text' in contents:
+            return len(contents['text'].encode('utf-8'))
+        data = contents.get('data')
+        if isinstance(data, bytes):
+            return len(data)
+        if isinstance(data, str):
+            return len(data) * 3 // 4
+        return 0
+    if isinstance(contents, (list, tuple)):
+        return sum(contents_size(part) for part in contents)
+    return 0
+
+def response_token_counts(response):
+    """Токены запроса и ответа из usage_metadata (None, если бэкенд их не сообщил)"""
+    metadata = getattr(response, 'usage_metadata', None)
+    if metadata is None:
+        return None, None
+    return getattr(metadata, 'prompt_token_count', None), getattr(metadata, 'candidates_token_count', None)
+
+def response_text_size(response):
+    try:
+        return len((response.text or '').encode('utf-8'))
+    except (AttributeError, ValueError):
+        # У ответа, заблокированного фильтрами, .text выбрасывает ValueError
+        return 0
+
+class UsageTracker:
+    def __init__(self, db_path, prices=None, daily_budget=0.0, tenant_budgets=None, budget_cache_ttl=5.0):
+        self.db_path = db_path
+        # Цены за 1 млн токенов: модель -> (вход, выход)
+        self.prices = prices or {}
+        # Дневной бюджет по умолчанию и индивидуальные бюджеты арендаторов (0 — без ограничения)
+        self.daily_budget = daily_budget
+        self.tenant_budgets = tenant_budgets or {}
+        self.budget_cache_ttl = budget_cache_ttl
+        self.lock = Lock()
+        # Потраченное сегодня: арендатор -> (сумма, день, время чтения из БД)
+        self.spent_cache = {}
+        self._init_store()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def _init_store(self):
+        """Создание таблицы учёта вызовов"""
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS model_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                tenant TEXT,
+                operation TEXT,
+                model TEXT,
+                document TEXT,
+                file_type TEXT,
+                pages INTEGER,
+                document_bytes INTEGER,
+                request_bytes INTEGER,
+                response_bytes INTEGER,
+                prompt_tokens INTEGER,
+                response_tokens INTEGER,
+                latency_ms INTEGER,
+                cost REAL,
+                status TEXT,
+                error TEXT
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_model_usage_created_at ON model_usage (created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_model_usage_tenant ON model_usage (tenant, created_at)')
+        conn.commit()
+        conn.close()
+
+    def cost(self, model_name, prompt_tokens, response_tokens):
+        """Стоимость вызова в USD по ценам модели"""
+        input_price, output_price = self.prices.get(model_name, (0.0, 0.0))
+        return ((prompt_tokens or 0) * input_price + (response_tokens or 0) * output_price) / 1_000_000
+
+    def record(self, model_name, contents, usage, latency, response=None, error=None):
+        """Записать один вызов модели. Ошибки учёта не прерывают сам вызов"""
+        usage = usage or {}
+        tenant = current_tenant.get()
+        prompt_tokens, response_tokens = response_token_counts(response)
+        cost = self.cost(model_name, prompt_tokens, response_tokens)
+        request_bytes = contents_size(contents) if contents is not None else usage.get('document_bytes', 0)
+        try:
+            conn = self._connect()
+            try:
+                conn.execute('''
+                    INSERT INTO model_usage
+                    (tenant, operation, model, document, file_type, pages, document_bytes, request_bytes,
+                     response_bytes, prompt_tokens, response_tokens, latency_ms, cost, status, error)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    tenant, usage.get('operation', 'other'), model_name, usage.get('document'),
+                    usage.get('file_type'), usage.get('pages'), usage.get('document_bytes'), request_bytes,
+                    response_text_size(response) if response is not None else 0,
+                    prompt_tokens, response_tokens, int(latency * 1000), cost,
+                    'error' if error is not None else 'ok', str(error) if error is not None else None
+                ))
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning("Не удалось записать расход модели: %s", e)
+        with self.lock:
+            cached = self.spent_cache.get(tenant)
+            if cached is not None:
+                self.spent_cache[tenant] = (cached[0] + cost,) + cached[1:]
+
+    def budget_for(self, tenant):
+        return self.tenant_budgets.get(tenant, self.daily_budget)
+
+    def spent_today(self, tenant):
+        """Расход арендатора за текущие сутки (UTC), с кэшированием на budget_cache_ttl"""
+        today = time.strftime('%Y-%m-%d', time.gmtime())
+        now = time.monotonic()
+        with self.lock:
+            cached = self.spent_cache.get(tenant)
+            if cached is not None and cached[1] == today and now - cached[2] < self.budget_cache_ttl:
+                return cached[0]
+        conn = self._connect()
+        try:
+            spent = conn.execute(
+                'SELECT COALESCE(SUM(cost), 0) FROM model_usage WHERE tenant = ? AND created_at >= ?',
+                (tenant, today)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        with self.lock:
+            self.spent_cache[tenant] = (spent, today, now)
+        return spent
+
+    def is_over_budget(self, tenant):
+        budget = self.budget_for(tenant)
+        return budget > 0 and self.spent_today(tenant) >= budget
+
+    def get_rollup(self, group_by='day', days=30, tenant=None):
+        """Сводка расхода за последние days дней по дням, типам файлов, операциям, арендаторам или моделям"""
+        key = ROLLUP_GROUPS[group_by]
+        conditions = ["created_at >= datetime('now', ?)"]
+        params = [f'-{int(days)} days']
+        if tenant:
+            conditions.append('tenant = ?')
+            params.append(tenant)
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute(f'''
+                SELECT {key} AS "group",
+                       COUNT(*) AS calls,
+                       SUM(status = 'error') AS errors,
+                       COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+                       COALESCE(SUM(response_tokens), 0) AS response_tokens,
+                       COALESCE(SUM(request_bytes), 0) AS request_bytes,
+                       COALESCE(SUM(response_bytes), 0) AS response_bytes,
+                       COALESCE(SUM(pages), 0) AS pages,
+                       ROUND(AVG(latency_ms)) AS avg_latency_ms,
+                       MAX(latency_ms) AS max_latency_ms,
+                       COALESCE(SUM(cost), 0) AS cost
+                FROM model_usage
+                WHERE {' AND '.join(conditions)}
+                GROUP BY 1
+                ORDER BY 1
+            ''', params).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+    def get_top_calls(self, limit=20, days=30, order_by='cost'):
+        """Самые дорогие (или медленные) вызовы — кандидаты на оптимизацию промптов"""
+        column = 'latency_ms' if order_by == 'latency' else 'cost'
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute(f'''
+                SELECT * FROM model_usage
+                WHERE created_at >= datetime('now', ?)
+                ORDER BY {column} DESC
+                LIMIT ?
+            ''', (f'-{int(days)} days', limit)).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+# Глобальный учёт расхода модели
+usage_tracker = UsageTracker(
+    DB_PATH, prices=MODEL_PRICES, daily_budget=TENANT_DAILY_BUDGET, tenant_budgets=TENANT_BUDGETS
+)
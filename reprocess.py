@@ -0,0 +1,51 @@
+"""
+Переобработка сохранённых ответов модели без повторного извлечения.
+
+Примеры:
+    python reprocess.py
+    python reprocess.py --dry-run
+    python reprocess.py --file-id 12 --file-id 15
+    python reprocess.py --workers 4 --batch-size 500
+
+Классификация счетов, привязка контрагентов и поиск аномалий пересчитываются
+для всех файлов по ответам модели из raw_extractions. Файлы, загруженные до их
+появления, переобрабатываются по полям уже сохранённых транзакций.
+"""
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from config import REPROCESS_BATCH_SIZE, REPROCESS_WORKERS
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Переобработка архива по сохранённым ответам модели",
+        epilog=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--file-id", type=int, action="append", help="только указанные файлы (можно повторять)")
+    parser.add_argument("-b", "--batch-size", type=int, default=REPROCESS_BATCH_SIZE, help="файлов в одной транзакции БД")
+    parser.add_argument("-w", "--workers", type=int, default=REPROCESS_WORKERS, help="процессов классификации")
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать изменения")
+    args = parser.parse_args()
+
+    from modules.reprocessing import reprocess_extractions
+
+    def progress(summary):
+        print(f"Файлов: {summary['files']}, транзакций: {summary['transactions']}, "
+              f"изменено: {summary['changed']}, {summary['seconds']} с")
+
+    summary = reprocess_extractions(
+        file_ids=args.file_id, batch_size=args.batch_size, workers=args.workers,
+        dry_run=args.dry_run, progress=progress
+    )
+    print(
+        f"\n{'Пробный запуск, изменения не записаны' if args.dry_run else '✅ Переобработка завершена'}\n"
+        f"Файлов: {summary['files']} (по ответам модели: {summary['from_raw']}, по сохранённым полям: {summary['from_rows']})\n"
+        f"Транзакций: {summary['transactions']}, изменено: {summary['changed']}\n"
+        f"Время: {summary['seconds']} с"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+"""
+Общие настройки тестов: модули импортируются из корня репозитория, статистика
+и трейсы не пишутся в data/, модель не вызывается.
+
+Пути в config относительные (data/...), а modules.database создаёт и мигрирует базу
+при импорте, поэтому тесты работают из временного каталога, а не из корня репозитория.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("STATS_BACKEND", "memory")
+os.environ.setdefault("MODEL_BACKEND", "fake")
+os.environ.setdefault("TRACE_SAMPLE_RATE", "0")
+
+_workdir = tempfile.TemporaryDirectory(prefix="accounting-tests-")
+os.makedirs(os.path.join(_workdir.name, "data"))
+os.chdir(_workdir.name)
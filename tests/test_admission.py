@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import time
+import pytest
+from modules.admission import AdmissionController, AdmissionRejected
+
+def test_session_limit_rejected_with_429():
+    controller = AdmissionController(max_concurrent=4, max_per_session=1)
+    with controller.acquire("s1"):
+        with pytest.raises(AdmissionRejected) as error:
+            controller.acquire("s1")
+        assert error.value.status == 429
+        assert error.value.code == 'session_limit'
+        controller.acquire("s2").release()
+    assert controller.per_session == {}
+
+def test_queue_full_rejected_with_503():
+    controller = AdmissionController(max_concurrent=1, queue_size=0)
+    with controller.acquire("s1"):
+        with pytest.raises(AdmissionRejected) as error:
+            controller.acquire("s2")
+        assert (error.value.status, error.value.code) == (503, 'queue_full')
+        assert error.value.retry_after >= 1
+
+def test_queue_timeout_leaves_no_waiter():
+    controller = AdmissionController(max_concurrent=1, queue_timeout=0.05)
+    with controller.acquire("s1"):
+        with pytest.raises(AdmissionRejected) as error:
+            controller.acquire("s2")
+        assert (error.value.status, error.value.code) == (503, 'queue_timeout')
+        assert not controller.waiting
+        assert "s2" not in controller.per_session
+    assert controller.get_stats()['max_wait_seconds'] >= 0.05
+
+def test_queued_request_admitted_after_release():
+    controller = AdmissionController(max_concurrent=1, queue_timeout=5)
+    first = controller.acquire("s1")
+    admitted = []
+    thread = threading.Thread(target=lambda: admitted.append(controller.acquire("s2")))
+    thread.start()
+    while not controller.waiting:
+        time.sleep(0.001)
+    first.release()
+    thread.join(5)
+    assert admitted and controller.active == 1
+    admitted[0].release()
+    assert controller.active == 0 and controller.per_session == {}
+
+def test_async_timeout():
+    controller = AdmissionController(max_concurrent=1, queue_timeout=0.05)
+
+    async def scenario():
+        with controller.acquire("s1"):
+            with pytest.raises(AdmissionRejected) as error:
+                await controller.acquire_async("s2", poll_interval=0.01)
+            assert error.value.code == 'queue_timeout'
+
+    asyncio.run(scenario())
+    assert not controller.waiting and controller.per_session == {}
+
+def test_async_cancellation_dequeues_waiter():
+    controller = AdmissionController(max_concurrent=1, queue_timeout=30)
+
+    async def scenario():
+        first = controller.acquire("s1")
+        cancelled = asyncio.create_task(controller.acquire_async("s2", poll_interval=0.01))
+        await asyncio.sleep(0.05)
+        assert len(controller.waiting) == 1
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert not controller.waiting
+        assert "s2" not in controller.per_session
+        # Отменённый запрос не держит голову очереди: следующий проходит сразу после освобождения
+        follower = asyncio.create_task(controller.acquire_async("s3", poll_interval=0.01))
+        await asyncio.sleep(0.02)
+        first.release()
+        admission = await asyncio.wait_for(follower, 1)
+        admission.release()
+
+    asyncio.run(scenario())
+    assert controller.active == 0 and controller.per_session == {}
@@ -0,0 +1,27 @@
+from modules.anomaly_codes import ANOMALY_CODES, OTHER_ANOMALY_BIT, labels_to_mask, mask_to_labels
+
+def test_round_trip_of_registered_labels():
+    labels = [label for _, label in ANOMALY_CODES.values()]
+    assert mask_to_labels(labels_to_mask(labels)) == labels
+    for label in labels:
+        assert mask_to_labels(labels_to_mask([label])) == [label]
+
+def test_labels_come_back_in_registry_order():
+    labels = [label for _, label in ANOMALY_CODES.values()]
+    assert mask_to_labels(labels_to_mask(list(reversed(labels)))) == labels
+
+def test_unknown_label_maps_to_other():
+    mask = labels_to_mask(["Отсутствует ИНН", "Подозрительное назначение платежа"])
+    assert mask == ANOMALY_CODES['missing_inn'][0] | OTHER_ANOMALY_BIT
+    assert mask_to_labels(mask) == ["Отсутствует ИНН", "Другое"]
+
+def test_empty_values():
+    assert labels_to_mask(None) == 0
+    assert labels_to_mask([]) == 0
+    assert mask_to_labels(0) == []
+    assert mask_to_labels(None) == []
+
+def test_bits_are_unique():
+    bits = [bit for bit, _ in ANOMALY_CODES.values()]
+    assert len(set(bits)) == len(bits)
+    assert OTHER_ANOMALY_BIT not in bits
@@ -0,0 +1,39 @@
+import time
+import pytest
+from modules.conversation_memory import ConversationMemory, SharedConversationStore
+from modules.stats_tracker import SharedStatsStore
+
+@pytest.fixture
+def shared(tmp_path):
+    db_path = str(tmp_path / "stats.db")
+    stats = SharedStatsStore(db_path, cleanup_interval=10 ** 9)
+    store = SharedConversationStore(db_path, user_timeout=60, cleanup_interval=10 ** 9)
+    return stats, store
+
+def test_history_shared_between_workers(shared):
+    stats, store = shared
+    stats.touch_session("s", time.time(), 60)
+    first, second = ConversationMemory(store=store), ConversationMemory(store=store)
+    first.append("s", "Сколько стоит аренда?", "100 000 руб. в месяц.")
+    assert "100 000 руб." in second.history("s")
+
+def test_history_expires_after_offline_even_before_cleanup(shared):
+    stats, store = shared
+    memory = ConversationMemory(store=store)
+    started = time.time() - 300
+    stats.touch_session("s", started, 60)
+    memory.append("s", "вопрос 1", "ответ 1")
+    store_conn = store._connect()
+    store_conn.execute("UPDATE conversations SET updated_at = ?", (started,))
+    store_conn.close()
+    # Пользователь вернулся после перерыва дольше user_timeout; очистка ещё не запускалась
+    stats.touch_session("s", time.time(), 60)
+    assert memory.history("s") == ""
+    memory.append("s", "вопрос 2", "ответ 2")
+    history = memory.history("s")
+    assert "вопрос 2" in history and "вопрос 1" not in history
+
+def test_long_question_keeps_part_of_answer():
+    memory = ConversationMemory(token_budget=200)
+    memory.append("s", "очень длинный вопрос " * 200, "Короткий ответ целиком.")
+    assert memory.history("s").endswith("Короткий ответ целиком.")
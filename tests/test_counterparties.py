@@ -0,0 +1,28 @@
+import pytest
+from modules.counterparties import is_valid_inn, normalize_counterparty_name, normalize_inn
+
+@pytest.mark.parametrize("inn", ["7707083893", "500100732259"])
+def test_valid_inn(inn):
+    assert is_valid_inn(inn)
+
+@pytest.mark.parametrize("inn", [
+    "7707083894",     # неверная контрольная цифра юрлица
+    "500100732250",   # неверная 12-я цифра
+    "500100732269",   # неверная 11-я цифра
+    "770708389",      # 9 цифр
+    "77070838930",    # 11 цифр
+    "77070838a3",
+    "",
+    None,
+])
+def test_invalid_inn(inn):
+    assert not is_valid_inn(inn)
+
+def test_inn_is_checked_after_normalization():
+    assert normalize_inn(" 7707-083-893 ") == "7707083893"
+    assert is_valid_inn(normalize_inn("ИНН 7707083893"))
+    assert normalize_inn(None) == ""
+
+def test_name_variants_normalize_to_same_key():
+    assert normalize_counterparty_name('ООО «Ромашка»') == normalize_counterparty_name("Ромашка ООО")
+    assert normalize_counterparty_name("Общество с ограниченной ответственностью \"Ёлка\"") == "елка"
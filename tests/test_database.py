@@ -0,0 +1,68 @@
+import pytest
+from modules import database
+from modules.counterparties import counterparty_resolver
+
+def transaction(account, counterparty="ООО Ромашка", inn="7707083893", amount=1000.0):
+    return {
+        "ИНН поставщика": inn,
+        "Название контрагента": counterparty,
+        "Сумма": amount,
+        "Дата": "01.02.2024",
+        "Назначение платежа": "Оплата по счёту",
+        "Счет": account,
+    }
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "accounting.db"))
+    counterparty_resolver.clear()
+    database.init_database()
+    yield
+    counterparty_resolver.clear()
+
+def save(transactions):
+    return database.save_file_and_transactions(
+        "scan.pdf", "pdf", transactions, raw_extraction=database.compress_extraction(transactions)
+    )
+
+def accounts(file_id):
+    return [(row['id'], row['account']) for row in database.get_file_transactions(file_id)]
+
+def test_same_row_count_updates_in_place(db):
+    file_id = save([transaction("60"), transaction("62")])
+    before = accounts(file_id)
+    changed = database.replace_file_transactions([(file_id, [transaction("60"), transaction("76")])])
+    assert changed == 1
+    after = accounts(file_id)
+    assert [row_id for row_id, _ in after] == [row_id for row_id, _ in before]
+    assert [account for _, account in after] == ["60", "76"]
+
+def test_dry_run_rolls_back_and_clears_counterparty_cache(db):
+    file_id = save([transaction("60")])
+    before = database.get_file_transactions(file_id)
+    changed = database.replace_file_transactions(
+        [(file_id, [transaction("76", counterparty="ООО Новый", inn="500100732259")])], dry_run=True
+    )
+    assert changed == 1
+    assert database.get_file_transactions(file_id) == before
+    # Контрагент из откатанной транзакции не остался ни в базе, ни в кэше
+    assert database.get_counterparties_page(query="500100732259") == ([], 0)
+    assert counterparty_resolver.cache == {}
+
+def test_row_count_mismatch_recreates_rows(db):
+    file_id = save([transaction("60"), transaction("62")])
+    old_ids = [row_id for row_id, _ in accounts(file_id)]
+    new = [transaction("60"), transaction("62"), transaction("76", amount=5.0)]
+    changed = database.replace_file_transactions([(file_id, new)])
+    assert changed == 3
+    rows = accounts(file_id)
+    assert [account for _, account in rows] == ["60", "62", "76"]
+    assert not set(old_ids) & {row_id for row_id, _ in rows}
+
+def test_error_rolls_back_whole_batch(db):
+    first = save([transaction("60")])
+    second = save([transaction("60")])
+    with pytest.raises(AttributeError):
+        database.replace_file_transactions([(first, [transaction("76")]), (second, [None])])
+    assert accounts(first)[0][1] == "60"
+    assert accounts(second)[0][1] == "60"
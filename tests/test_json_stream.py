@@ -0,0 +1,48 @@
+from modules.json_stream import JsonArrayStreamParser
+
+def feed_all(parser, chunks):
+    objects = []
+    for chunk in chunks:
+        objects.extend(parser.feed(chunk))
+    return objects
+
+def test_objects_split_across_chunks():
+    text = '```json\n[{"a": 1, "b": [1, 2]}, {"c": {"d": "x"}}]\n```'
+    parser = JsonArrayStreamParser()
+    objects = feed_all(parser, [text[i:i + 3] for i in range(0, len(text), 3)])
+    assert objects == [{"a": 1, "b": [1, 2]}, {"c": {"d": "x"}}]
+    assert parser.complete
+    assert parser.objects_parsed == 2
+
+def test_object_returned_in_chunk_that_closes_it():
+    parser = JsonArrayStreamParser()
+    assert parser.feed('[{"a": ') == []
+    assert parser.feed('1}, {"b"') == [{"a": 1}]
+    assert parser.feed(': 2}]') == [{"b": 2}]
+
+def test_escaped_quotes_and_brackets_inside_strings():
+    text = r'[{"name": "ООО \"Ромашка\" {филиал]", "path": "C:\\dir\\"}, {"n": 2}]'
+    parser = JsonArrayStreamParser()
+    # Разрез сразу после обратной косой черты: экранирование переходит через границу фрагментов
+    split = text.index('\\"') + 1
+    objects = feed_all(parser, [text[:split], text[split:]])
+    assert objects == [{"name": 'ООО "Ромашка" {филиал]', "path": "C:\\dir\\"}, {"n": 2}]
+    assert parser.complete
+
+def test_truncated_tail_keeps_complete_objects():
+    parser = JsonArrayStreamParser()
+    objects = feed_all(parser, ['[{"a": 1}, {"b": 2}, {"c": "обрыв'])
+    assert objects == [{"a": 1}, {"b": 2}]
+    assert not parser.complete
+    assert parser.invalid_fragments == []
+
+def test_invalid_object_is_reported_and_skipped():
+    parser = JsonArrayStreamParser()
+    objects = feed_all(parser, ['[{"a": 1,}, {"b": 2}]'])
+    assert objects == [{"b": 2}]
+    assert parser.invalid_fragments == ['{"a": 1,}']
+
+def test_text_after_array_is_ignored_but_kept_raw():
+    parser = JsonArrayStreamParser()
+    assert feed_all(parser, ['[{"a": 1}] и ещё', ' [{"b": 2}]']) == [{"a": 1}]
+    assert parser.raw_text == '[{"a": 1}] и ещё [{"b": 2}]'
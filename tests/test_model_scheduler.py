@@ -0,0 +1,79 @@
+import asyncio
+import re
+import pytest
+from modules.model_scheduler import DEFAULT_WEIGHTS, ModelScheduler, SchedulerTimeout, validate_weights
+
+def grant_order(scheduler, requests):
+    """Порядок допуска запросов [(класс, сессия)], поставленных в очередь при занятом единственном месте"""
+    order = []
+
+    async def call(priority, session):
+        await scheduler.acquire_async(5, priority, session)
+        order.append((priority, session))
+        scheduler.release()
+
+    async def scenario():
+        await scheduler.acquire_async(5, 'batch', 'holder')
+        tasks = [asyncio.create_task(call(priority, session)) for priority, session in requests]
+        await asyncio.sleep(0.01)
+        scheduler.release()
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+
+    asyncio.run(scenario())
+    return order
+
+def test_classes_share_slots_by_weight():
+    scheduler = ModelScheduler(max_concurrent=1)
+    requests = [(priority, f"{priority}-{i}") for i in range(12) for priority in ('batch', 'upload', 'interactive')]
+    first = [priority for priority, _ in grant_order(scheduler, requests)[:12]]
+    assert first[0] == 'interactive'
+    assert first.count('interactive') in (7, 8, 9)
+    assert first.count('upload') in (2, 3, 4)
+    # Пакетная обработка не голодает даже при полной очереди чата
+    assert 'batch' in first
+
+def test_sessions_within_class_are_served_round_robin():
+    scheduler = ModelScheduler(max_concurrent=1)
+    requests = [('upload', 'bulk')] * 5 + [('upload', 'single')]
+    sessions = [session for _, session in grant_order(scheduler, requests)]
+    assert sessions.index('single') == 1
+
+def test_timeout_removes_waiter():
+    scheduler = ModelScheduler(max_concurrent=1)
+    scheduler.acquire(1, 'upload', 's1')
+    with pytest.raises(SchedulerTimeout):
+        scheduler.acquire(0.02, 'interactive', 's2')
+    stats = scheduler.get_stats()
+    assert stats['classes']['interactive']['timed_out'] == 1
+    assert stats['classes']['interactive']['queued'] == 0
+    scheduler.release()
+    assert scheduler.get_stats()['active'] == 0
+
+def test_cancelled_async_waiter_leaves_queue():
+    scheduler = ModelScheduler(max_concurrent=1)
+
+    async def scenario():
+        await scheduler.acquire_async(1, 'upload', 's1')
+        waiter = asyncio.create_task(scheduler.acquire_async(5, 'batch', 's2'))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        scheduler.release()
+
+    asyncio.run(scenario())
+    stats = scheduler.get_stats()
+    assert stats['active'] == 0 and stats['classes']['batch']['queued'] == 0
+
+def test_validate_weights_fills_defaults():
+    assert validate_weights({}) == DEFAULT_WEIGHTS
+    assert validate_weights({'batch': 0.5}) == {**DEFAULT_WEIGHTS, 'batch': 0.5}
+
+@pytest.mark.parametrize("weights, message", [
+    ({'chat': 2}, "неизвестные классы chat"),
+    ({'batch': 0}, "больше нуля (batch)"),
+    ({'upload': -1, 'batch': 1}, "больше нуля (upload)"),
+])
+def test_invalid_weights_fail_when_scheduler_is_built(weights, message):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        ModelScheduler(weights=weights)
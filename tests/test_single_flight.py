@@ -0,0 +1,160 @@
+import sqlite3
+import threading
+import time
+import pytest
+from modules.single_flight import SingleFlight, has_no_errors
+
+class WorkerKilled(BaseException):
+    """Прерывание, которое не наследует Exception (как таймаут воркера или GeneratorExit)"""
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "state.db")
+
+def run_in_thread(fn):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('value', fn()))
+    thread.start()
+    return thread, result
+
+def slow(value, started, release):
+    def fn():
+        started.set()
+        release.wait(5)
+        return value
+    return fn
+
+def wait_for_waiter(db_path, key):
+    for _ in range(500):
+        conn = sqlite3.connect(db_path)
+        count = conn.execute('SELECT COUNT(*) FROM flight_waiters WHERE flight_key = ?', (key,)).fetchone()[0]
+        conn.close()
+        if count:
+            return
+        time.sleep(0.01)
+    raise AssertionError("ожидающий воркер не появился")
+
+def test_follower_in_process_gets_leader_result():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    leader, leader_result = run_in_thread(lambda: flight.do("k", slow([{"a": 1}], started, release)))
+    started.wait(5)
+    follower, follower_result = run_in_thread(lambda: flight.do("k", lambda: [{"own": True}]))
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert follower_result['value'] == leader_result['value'] == [{"a": 1}]
+    assert flight.stats['followers'] == 1
+
+def test_follower_runs_itself_when_leader_is_interrupted():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def interrupted():
+        started.set()
+        release.wait(5)
+        raise WorkerKilled()
+
+    interrupted_leaders = []
+
+    def lead():
+        try:
+            flight.do("k", interrupted)
+        except WorkerKilled:
+            interrupted_leaders.append(True)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait(5)
+    follower, follower_result = run_in_thread(lambda: flight.do("k", lambda: [{"own": True}]))
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert interrupted_leaders == [True]
+    assert follower_result['value'] == [{"own": True}]
+
+def test_result_shared_with_waiting_worker_only(db_path):
+    first = SingleFlight(db_path, poll_interval=0.01, shareable=has_no_errors)
+    second = SingleFlight(db_path, poll_interval=0.01, shareable=has_no_errors)
+    started, release = threading.Event(), threading.Event()
+    leader, _ = run_in_thread(lambda: first.do("k", slow([{"a": 1}], started, release)))
+    started.wait(5)
+    follower, follower_result = run_in_thread(lambda: second.do("k", lambda: [{"own": True}]))
+    wait_for_waiter(db_path, "k")
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert follower_result['value'] == [{"a": 1}]
+    assert second.stats['shared_followers'] == 1
+    # Запрос после завершения не пересекался с работой ведущего — выполняется заново, а не из кэша
+    assert second.do("k", lambda: [{"later": True}]) == [{"later": True}]
+
+def test_error_result_is_not_shared(db_path):
+    first = SingleFlight(db_path, poll_interval=0.01, shareable=has_no_errors)
+    second = SingleFlight(db_path, poll_interval=0.01, shareable=has_no_errors)
+    started, release = threading.Event(), threading.Event()
+    leader, leader_result = run_in_thread(lambda: first.do("k", slow([{"error": "модель недоступна"}], started, release)))
+    started.wait(5)
+    follower, follower_result = run_in_thread(lambda: second.do("k", lambda: [{"own": True}]))
+    wait_for_waiter(db_path, "k")
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert leader_result['value'] == [{"error": "модель недоступна"}]
+    assert follower_result['value'] == [{"own": True}]
+
+def test_has_no_errors():
+    assert has_no_errors([{"a": 1}])
+    assert not has_no_errors([{"a": 1}, {"error": "обрезан"}])
+    assert not has_no_errors({"error": "не удалось"})
+
+def slow_items(items, started, release):
+    def make_iter():
+        started.set()
+        for item in items:
+            release.wait(5)
+            yield item
+    return make_iter
+
+def test_stream_follower_replays_leader_items(db_path):
+    first = SingleFlight(db_path, poll_interval=0.01, shareable=has_no_errors)
+    second = SingleFlight(db_path, poll_interval=0.01, shareable=has_no_errors)
+    started, release = threading.Event(), threading.Event()
+    items = [{"a": 1}, {"b": 2}]
+    leader, leader_result = run_in_thread(lambda: list(first.stream("k", slow_items(items, started, release))))
+    started.wait(5)
+    # Ожидающий в том же процессе и в другом воркере
+    local, local_result = run_in_thread(lambda: list(first.stream("k", lambda: iter([{"own": True}]))))
+    remote, remote_result = run_in_thread(lambda: list(second.stream("k", lambda: iter([{"own": True}]))))
+    wait_for_waiter(db_path, "k")
+    release.set()
+    for thread in (leader, local, remote):
+        thread.join(5)
+    assert leader_result['value'] == local_result['value'] == remote_result['value'] == items
+
+def test_stream_shares_key_with_do():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    leader, _ = run_in_thread(lambda: list(flight.stream("k", slow_items([{"a": 1}], started, release))))
+    started.wait(5)
+    follower, follower_result = run_in_thread(lambda: flight.do("k", lambda: [{"own": True}]))
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert follower_result['value'] == [{"a": 1}]
+
+def test_closed_stream_lets_follower_run_itself(db_path):
+    flight = SingleFlight(db_path, poll_interval=0.01)
+    stream = flight.stream("k", lambda: iter([{"a": 1}, {"b": 2}]))
+    assert next(stream) == {"a": 1}
+    follower, follower_result = run_in_thread(lambda: flight.do("k", lambda: [{"own": True}]))
+    time.sleep(0.05)
+    # Клиент отключился посреди потока
+    stream.close()
+    follower.join(5)
+    assert follower_result['value'] == [{"own": True}]
+    # Межпроцессная блокировка снята
+    assert flight.do("k", lambda: [{"next": True}]) == [{"next": True}]
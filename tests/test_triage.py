@@ -0,0 +1,29 @@
+from modules.triage import classify_text
+
+INVOICE_WITHOUT_KOPECKS = """СЧЕТ-ФАКТУРА N 101 от 1 февраля 2024 г.
+Продавец: ООО Ромашка
+Покупатель: ООО Лютик
+Бумага офисная 2 шт 2700
+Всего к оплате 5400
+"""
+
+def test_invoice_without_kopecks_is_not_rejected():
+    result = classify_text(INVOICE_WITHOUT_KOPECKS)
+    assert result["scores"]["invoice"] >= 3
+    assert result["structure"]["amounts"] + result["structure"]["inns"] == 0
+    assert result["label"] == "unknown"
+
+def test_invoice_with_amounts_is_labelled():
+    text = INVOICE_WITHOUT_KOPECKS.replace("2700", "2 700,00").replace("5400", "5 400,00 руб")
+    assert classify_text(text)["label"] == "invoice"
+
+def test_manual_is_irrelevant():
+    text = "Руководство пользователя\nРаздел 1. Установка\nНажмите кнопку «Далее» в меню"
+    assert classify_text(text)["label"] == "irrelevant"
+
+def test_manual_mentioning_invoice_is_irrelevant():
+    text = "Инструкция: как выставить счёт-фактуру\nОткройте меню, нажмите кнопку «Создать»"
+    assert classify_text(text)["label"] == "irrelevant"
+
+def test_empty_text_is_unknown():
+    assert classify_text("  \n")["label"] == "unknown"
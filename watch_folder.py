@@ -0,0 +1,53 @@
+"""
+Демон приёма документов из папки.
+
+Примеры:
+    python watch_folder.py
+    python watch_folder.py /mnt/scans --workers 4 --settle 5
+    python watch_folder.py /mnt/scans --no-inotify --poll 10
+
+Новые PDF и изображения в папке автоматически извлекаются, классифицируются
+и сохраняются в базу данных. Остановка — Ctrl+C (или SIGTERM): файлы, уже
+взятые в работу, дообрабатываются.
+"""
+import argparse
+import logging
+import signal
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from config import WATCH_FOLDER, WATCH_WORKERS, WATCH_QUEUE_SIZE, WATCH_SETTLE_SECONDS, WATCH_POLL_INTERVAL
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Наблюдение за папкой и обработка новых документов",
+        epilog=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("folder", nargs="?", default=WATCH_FOLDER, help="папка для наблюдения")
+    parser.add_argument("-w", "--workers", type=int, default=WATCH_WORKERS, help="одновременно обрабатываемых файлов")
+    parser.add_argument("--queue-size", type=int, default=WATCH_QUEUE_SIZE, help="размер очереди готовых файлов")
+    parser.add_argument("--settle", type=float, default=WATCH_SETTLE_SECONDS,
+                        help="сколько секунд файл не должен меняться перед обработкой")
+    parser.add_argument("--poll", type=float, default=WATCH_POLL_INTERVAL, help="интервал опроса, сек")
+    parser.add_argument("--no-inotify", action="store_true", help="только опрос папки, без watchdog")
+    parser.add_argument("--retry-failed", action="store_true", help="повторить файлы, завершившиеся ошибкой")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    from modules.folder_watcher import FolderWatcher
+
+    watcher = FolderWatcher(
+        args.folder, max_workers=args.workers, queue_size=args.queue_size,
+        settle_seconds=args.settle, poll_interval=args.poll,
+        use_inotify=not args.no_inotify, retry_failed=args.retry_failed
+    )
+    signal.signal(signal.SIGTERM, lambda *_: watcher.stop())
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+
+if __name__ == "__main__":
+    main()